@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+analyse_exit.py — 交集個股進場後的表現追蹤
+每筆歷史交集（交易日, 代號）視為一次進場：以當天收盤價進場，
+算出之後第 1..N 個交易日的報酬、最大回撤（peak-to-trough）、最大漲幅（相對進場價）
+
+資料：
+  進場紀錄  {dir}/dataset/date=*/part.parquet（export_dataset.py），沒有時讀 {dir} 下的舊 CSV
+  收盤價    data/exit_prices.parquet 快取（stock_id, date, close）；
+            缺的股票 / 日期才用 FinMind 補抓，每檔一次抓整段區間，不會每筆進場各抓一次
+
+所有進場一次組成 (進場數 × N+1) 的價格路徑矩陣，報酬 / 回撤 / 漲幅都是整個矩陣一起算
+
+輸出：
+  exit_tracking_result.csv    每筆進場：ret_k / mdd_k / runup_k（k = 1..N，單位 %）
+  exit_tracking_summary.csv   每個持有天數的平均、中位數、勝率、平均回撤 / 漲幅
+  exit_sweep_result.csv       --sweep：停利 × 停損 × 最長持有天數的出場規則比較
+  output_charts/*.png         需要 matplotlib
+
+用法：
+  python analyse_exit.py --dir ./exports --days 10
+  python analyse_exit.py --days 20 --sweep --tp 3,5,8,10,15 --sl 3,5,8 --workers 4
+  python analyse_exit.py --no-fetch          # 只用快取裡的價格
+"""
+import os
+import sys
+import time
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from export_dataset import load_export_dataset, read_legacy_csvs
+
+PRICE_CACHE = Path("data/exit_prices.parquet")
+OUT_RESULT = Path("exit_tracking_result.csv")
+OUT_SUMMARY = Path("exit_tracking_summary.csv")
+OUT_SWEEP = Path("exit_sweep_result.csv")
+OUT_CHART_DIR = Path("output_charts")
+FINMIND_TOKEN = os.getenv("FINMIND_TOKEN", "")
+
+
+# ════════════════════════════════════════════════════════
+# 進場紀錄
+# ════════════════════════════════════════════════════════
+
+def load_entries(export_dir: Path) -> pd.DataFrame:
+    """回傳 (date, stock_id, stock_name)，date 為 YYYY-MM-DD，依日期、代號排序"""
+    df = load_export_dataset(root=export_dir / "dataset")
+    if df.empty:  # 還沒跑過 export_dataset.py import：直接讀舊 CSV
+        _, latest = read_legacy_csvs(export_dir)
+        frames = [d.assign(date=date) for date, (d, _) in latest.items()]
+        df = pd.concat(frames, ignore_index=True) if frames else df
+    if df.empty:
+        return pd.DataFrame(columns=["date", "stock_id", "stock_name"])
+    df = df[["date", "stock_id", "stock_name"]].astype(str)
+    df["stock_id"] = df["stock_id"].str.strip()
+    df["stock_name"] = df["stock_name"].str.strip()
+    return (df.drop_duplicates(["date", "stock_id"])
+              .sort_values(["date", "stock_id"])
+              .reset_index(drop=True))
+
+
+# ════════════════════════════════════════════════════════
+# 收盤價快取
+# ════════════════════════════════════════════════════════
+
+def load_price_cache() -> pd.DataFrame:
+    if PRICE_CACHE.exists():
+        try:
+            return pd.read_parquet(PRICE_CACHE)
+        except Exception as e:
+            print(f"  ⚠️ {PRICE_CACHE} 讀取失敗：{e}")
+    return pd.DataFrame({"stock_id": pd.Series(dtype=str),
+                         "date": pd.Series(dtype=str),
+                         "close": pd.Series(dtype=float)})
+
+
+def save_price_cache(prices: pd.DataFrame):
+    prices = (prices.drop_duplicates(["stock_id", "date"], keep="last")
+                    .sort_values(["stock_id", "date"])
+                    .reset_index(drop=True))
+    PRICE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = PRICE_CACHE.with_suffix(".tmp")
+    prices.to_parquet(tmp, index=False)
+    os.replace(tmp, PRICE_CACHE)
+
+
+def price_requests(entries: pd.DataFrame, prices: pd.DataFrame, days: int) -> list:
+    """
+    比對快取與需求，回傳 [(stock_id, start, end)]：
+    每檔需要第一次進場日 ~ 最後一次進場後約 days 個交易日；快取已涵蓋的不抓，
+    只缺尾巴的從快取最後一天接著抓
+    """
+    today = datetime.now().strftime("%Y-%m-%d")
+    span = timedelta(days=days * 7 // 5 + 10)  # 交易日 → 日曆天，多抓幾天容納連假
+    need = entries.groupby("stock_id")["date"].agg(["min", "max"])
+    have = prices.groupby("stock_id")["date"].agg(["min", "max"])
+    need = need.join(have, rsuffix="_have")
+    out = []
+    for sid, r in need.iterrows():
+        end = min(today, (datetime.strptime(r["max"], "%Y-%m-%d") + span).strftime("%Y-%m-%d"))
+        if pd.isna(r["min_have"]) or r["min_have"] > r["min"]:
+            out.append((sid, r["min"], end))
+        elif (datetime.strptime(end, "%Y-%m-%d")
+              - datetime.strptime(r["max_have"], "%Y-%m-%d")).days > 3:
+            out.append((sid, (datetime.strptime(r["max_have"], "%Y-%m-%d")
+                              + timedelta(days=1)).strftime("%Y-%m-%d"), end))
+    return out
+
+
+def fetch_finmind(todo: list) -> pd.DataFrame:
+    """FinMind 日收盤價，每檔一個請求；沒裝 FinMind 或抓失敗的略過"""
+    try:
+        from FinMind.data import DataLoader
+    except ImportError:
+        print("  ⚠️ 未安裝 FinMind，只用快取中的價格")
+        return load_price_cache().iloc[0:0]
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        def tqdm(x, **kw):
+            return x
+    api = DataLoader()
+    if FINMIND_TOKEN:
+        api.login_by_token(api_token=FINMIND_TOKEN)
+    frames = []
+    for sid, start, end in tqdm(todo, desc="FinMind"):
+        try:
+            df = api.taiwan_stock_daily(stock_id=sid, start_date=start, end_date=end)
+        except Exception as e:
+            print(f"  ⚠️ {sid} 價格抓取失敗：{e}")
+            continue
+        if df is not None and len(df):
+            frames.append(pd.DataFrame({"stock_id": sid,
+                                        "date": df["date"].astype(str).str[:10],
+                                        "close": pd.to_numeric(df["close"], errors="coerce")}))
+    if not frames:
+        return load_price_cache().iloc[0:0]
+    out = pd.concat(frames, ignore_index=True)
+    return out[out["close"] > 0]
+
+
+def load_prices(entries: pd.DataFrame, days: int, fetch: bool = True) -> pd.DataFrame:
+    """快取 + 補抓缺的部分；有新資料才寫回快取"""
+    prices = load_price_cache()
+    todo = price_requests(entries, prices, days) if fetch else []
+    if todo:
+        print(f"  📥 補抓 {len(todo)} 檔收盤價（快取已有 {prices['stock_id'].nunique()} 檔）")
+        new = fetch_finmind(todo)
+        if len(new):
+            prices = pd.concat([prices, new], ignore_index=True)
+            save_price_cache(prices)
+    return prices.drop_duplicates(["stock_id", "date"], keep="last")
+
+
+# ════════════════════════════════════════════════════════
+# 向量化計算
+# ════════════════════════════════════════════════════════
+
+def price_paths(entries: pd.DataFrame, prices: pd.DataFrame, days: int) -> np.ndarray:
+    """
+    回傳 (len(entries), days+1) 的收盤價路徑，第 0 欄為進場日收盤
+    日期軸為所有股票交易日的聯集；停牌日沿用前一天收盤，最後一筆價格之後與進場日沒價格的為 NaN
+    """
+    wide = prices.pivot(index="date", columns="stock_id", values="close").sort_index()
+    wide = wide.ffill().where(wide.bfill().notna())
+    dates = wide.index.to_numpy(dtype=str)
+    matrix = wide.to_numpy(dtype=float)
+    cols = {sid: j for j, sid in enumerate(wide.columns)}
+
+    col = entries["stock_id"].map(cols).to_numpy(dtype=float)
+    pos = np.searchsorted(dates, entries["date"].to_numpy(dtype=str))
+    ok = ~np.isnan(col) & (pos < len(dates))
+    ok[ok] &= dates[pos[ok]] == entries["date"].to_numpy(dtype=str)[ok]
+
+    paths = np.full((len(entries), days + 1), np.nan)
+    if not ok.any() or not len(dates):
+        return paths
+    idx = pos[ok, None] + np.arange(days + 1)[None, :]
+    inside = idx < len(dates)
+    paths[ok] = np.where(inside, matrix[np.minimum(idx, len(dates) - 1),
+                                        col[ok, None].astype(int)], np.nan)
+    return paths
+
+
+def path_metrics(paths: np.ndarray):
+    """
+    回傳 (ret, mdd, runup)，形狀皆為 (進場數, days)，單位 %：
+      ret[:, k-1]    第 k 天收盤相對進場價的報酬
+      mdd[:, k-1]    前 k 天內從高點（含進場價）回落的最大幅度（≤ 0）
+      runup[:, k-1]  前 k 天內相對進場價的最大漲幅（≥ 0）
+    """
+    entry = paths[:, :1]
+    rel = paths / entry - 1
+    with np.errstate(invalid="ignore"):
+        drawdown = paths / np.maximum.accumulate(paths, axis=1) - 1
+    ret = rel[:, 1:] * 100
+    mdd = np.minimum.accumulate(drawdown, axis=1)[:, 1:] * 100
+    runup = np.maximum.accumulate(rel, axis=1)[:, 1:] * 100  # rel[:, 0] = 0，所以 ≥ 0
+    return ret, mdd, runup
+
+
+def summarize(ret, mdd, runup) -> pd.DataFrame:
+    """每個持有天數一列：樣本數、平均 / 中位數報酬、勝率、平均回撤 / 漲幅"""
+    n = (~np.isnan(ret)).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        win = np.where(n > 0, (ret > 0).sum(axis=0) / n * 100, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # 全 NaN 的天數（資料還不夠）回傳 NaN
+        return pd.DataFrame({
+            "day": np.arange(1, ret.shape[1] + 1),
+            "n": n,
+            "mean_ret": np.nanmean(ret, axis=0),
+            "median_ret": np.nanmedian(ret, axis=0),
+            "p25_ret": np.nanpercentile(ret, 25, axis=0),
+            "p75_ret": np.nanpercentile(ret, 75, axis=0),
+            "win_rate": win,
+            "mean_mdd": np.nanmean(mdd, axis=0),
+            "mean_runup": np.nanmean(runup, axis=0),
+        }).round(2)
+
+
+# ── 出場規則掃描 ───────────────────────────────────────────
+
+_SWEEP_RET = None
+SWEEP_METRICS = ["mean_ret", "median_ret", "win_rate", "avg_days", "hit_tp", "hit_sl"]
+
+
+def _init_sweep(ret):
+    global _SWEEP_RET
+    _SWEEP_RET = ret
+
+
+def evaluate_rule(params):
+    """
+    停利 tp% / 停損 sl% / 最長持有 hold 天：以收盤價判斷，第一個觸及的那天出場，
+    都沒觸及就在第 hold 天收盤出場。只用資料滿 hold 天的進場；一筆都沒有時 n = 0、指標為 NaN
+    """
+    tp, sl, hold = params
+    ret = _SWEEP_RET[:, :hold]
+    ret = ret[~np.isnan(ret).any(axis=1)]
+    if not len(ret):
+        return {"tp": tp, "sl": sl, "hold": hold, "n": 0, **dict.fromkeys(SWEEP_METRICS, np.nan)}
+    hit = (ret >= tp) | (ret <= -sl)
+    first = np.where(hit.any(axis=1), hit.argmax(axis=1), hold - 1)
+    realized = ret[np.arange(len(ret)), first]
+    return {"tp": tp, "sl": sl, "hold": hold, "n": len(ret),
+            "mean_ret": round(float(realized.mean()), 2),
+            "median_ret": round(float(np.median(realized)), 2),
+            "win_rate": round(float((realized > 0).mean() * 100), 2),
+            "avg_days": round(float(first.mean() + 1), 2),
+            "hit_tp": round(float((realized >= tp).mean() * 100), 2),
+            "hit_sl": round(float((realized <= -sl).mean() * 100), 2)}
+
+
+def sweep_rules(ret, tps, sls, days, workers=1) -> pd.DataFrame:
+    grid = list(product(tps, sls, range(1, days + 1)))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep,
+                                 initargs=(ret,)) as pool:
+            rows = list(pool.map(evaluate_rule, grid, chunksize=max(1, len(grid) // (workers * 4))))
+    else:
+        _init_sweep(ret)
+        rows = [evaluate_rule(p) for p in grid]
+    df = pd.DataFrame(rows, columns=["tp", "sl", "hold", "n"] + SWEEP_METRICS)
+    return (df[df["n"] > 0]
+              .sort_values(["mean_ret", "win_rate"], ascending=False)
+              .reset_index(drop=True))
+
+
+# ════════════════════════════════════════════════════════
+# 輸出
+# ════════════════════════════════════════════════════════
+
+def result_frame(entries, paths, ret, mdd, runup) -> pd.DataFrame:
+    days = ret.shape[1]
+    out = entries.rename(columns={"date": "entry_date"}).copy()
+    out["entry_price"] = paths[:, 0]
+    for name, arr in (("ret", ret), ("mdd", mdd), ("runup", runup)):
+        out = out.join(pd.DataFrame(np.round(arr, 2), index=out.index,
+                                    columns=[f"{name}_{k}" for k in range(1, days + 1)]))
+    return out
+
+
+def plot_charts(summary: pd.DataFrame, ret: np.ndarray):
+    """matplotlib 沒裝就略過（圖上用英文標籤，CI 機器沒有中文字型）"""
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("  ⚠️ 未安裝 matplotlib，略過圖表")
+        return
+    OUT_CHART_DIR.mkdir(parents=True, exist_ok=True)
+    d = summary["day"]
+
+    fig, ax = plt.subplots(figsize=(9, 5))
+    ax.fill_between(d, summary["p25_ret"], summary["p75_ret"], alpha=0.2, label="25-75%")
+    ax.plot(d, summary["mean_ret"], marker="o", label="mean")
+    ax.plot(d, summary["median_ret"], marker=".", label="median")
+    ax.axhline(0, color="gray", lw=0.8)
+    ax.set(xlabel="days after entry", ylabel="return (%)", title="Forward return")
+    ax.legend()
+    fig.savefig(OUT_CHART_DIR / "forward_return.png", dpi=120, bbox_inches="tight")
+    plt.close(fig)
+
+    fig, ax = plt.subplots(figsize=(9, 5))
+    ax.plot(d, summary["mean_runup"], marker="o", color="tab:green", label="mean max run-up")
+    ax.plot(d, summary["mean_mdd"], marker="o", color="tab:red", label="mean max drawdown")
+    ax2 = ax.twinx()
+    ax2.bar(d, summary["win_rate"], alpha=0.15, color="tab:blue")
+    ax2.set_ylabel("win rate (%)")
+    ax.set(xlabel="days after entry", ylabel="%", title="Run-up / drawdown / win rate")
+    ax.legend(loc="upper left")
+    fig.savefig(OUT_CHART_DIR / "runup_drawdown.png", dpi=120, bbox_inches="tight")
+    plt.close(fig)
+
+    last = ret[:, -1][~np.isnan(ret[:, -1])]
+    if len(last):
+        fig, ax = plt.subplots(figsize=(9, 5))
+        ax.hist(last, bins=40)
+        ax.axvline(0, color="gray", lw=0.8)
+        ax.set(xlabel="return (%)", ylabel="entries",
+               title=f"Return after {ret.shape[1]} days (n={len(last)})")
+        fig.savefig(OUT_CHART_DIR / f"return_day{ret.shape[1]}_hist.png", dpi=120,
+                    bbox_inches="tight")
+        plt.close(fig)
+    print(f"  🖼️ 圖表：{OUT_CHART_DIR}/")
+
+
+def _float_list(s):
+    return [float(x) for x in s.split(",") if x.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="交集個股進場後表現追蹤")
+    parser.add_argument("--dir", default="./exports", help="匯出目錄（含 dataset/ 或舊 CSV）")
+    parser.add_argument("--days", type=int, default=10, help="追蹤進場後幾個交易日")
+    parser.add_argument("--start", help="只看這天（YYYY-MM-DD）以後的進場")
+    parser.add_argument("--end", help="只看這天（YYYY-MM-DD）以前的進場")
+    parser.add_argument("--no-fetch", action="store_true", help="不補抓價格，只用快取")
+    parser.add_argument("--sweep", action="store_true", help="掃描停利 / 停損 / 持有天數組合")
+    parser.add_argument("--tp", type=_float_list, default=[3, 5, 8, 10, 15], help="停利 %%，逗號分隔")
+    parser.add_argument("--sl", type=_float_list, default=[3, 5, 8, 10], help="停損 %%，逗號分隔")
+    parser.add_argument("--workers", type=int, default=1, help="掃描用的 process 數（1 = 不開 pool）")
+    parser.add_argument("--no-charts", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    t0 = time.perf_counter()
+    entries = load_entries(Path(args.dir))
+    if args.start:
+        entries = entries[entries["date"] >= args.start]
+    if args.end:
+        entries = entries[entries["date"] <= args.end]
+    entries = entries.reset_index(drop=True)
+    if entries.empty:
+        print("❌ 找不到任何進場紀錄")
+        return 1
+    print(f"📋 進場紀錄 {len(entries)} 筆（{entries['stock_id'].nunique()} 檔，"
+          f"{entries['date'].min()} ~ {entries['date'].max()}）")
+
+    prices = load_prices(entries, args.days, fetch=not args.no_fetch)
+    if prices.empty:
+        print("❌ 沒有任何收盤價資料")
+        return 1
+    paths = price_paths(entries, prices, args.days)
+    ret, mdd, runup = path_metrics(paths)
+    missing = int(np.isnan(paths[:, 0]).sum())
+    if missing:
+        print(f"  ⚠️ {missing} 筆進場日沒有收盤價，略過")
+
+    result_frame(entries, paths, ret, mdd, runup).to_csv(OUT_RESULT, index=False,
+                                                          encoding="utf-8-sig")
+    summary = summarize(ret, mdd, runup)
+    summary.to_csv(OUT_SUMMARY, index=False, encoding="utf-8-sig")
+    pd.set_option("display.width", 180)
+    print("\n" + summary.to_string(index=False))
+    print(f"\n💾 {OUT_RESULT}、{OUT_SUMMARY}")
+
+    if args.sweep:
+        sweep = sweep_rules(ret, args.tp, args.sl, args.days, args.workers)
+        if sweep.empty:
+            print("\n⚠️ 沒有任何進場有完整的持有期間資料，略過出場規則比較")
+        else:
+            sweep.to_csv(OUT_SWEEP, index=False, encoding="utf-8-sig")
+            print(f"\n🔎 出場規則（前 10 名，共 {len(sweep)} 組）\n" + sweep.head(10).to_string(index=False))
+            print(f"💾 {OUT_SWEEP}")
+    if not args.no_charts:
+        plot_charts(summary, ret)
+    print(f"\n⏱️ {time.perf_counter() - t0:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
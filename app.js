@@ -1,11 +1,42 @@
+// ════════════════════════════════════════════════════════
+// 資料載入：先讀 data/latest/manifest.json，各頁籤只抓自己要的分片
+// 分片檔名帶內容 hash，可以直接吃瀏覽器 / service worker 快取；
+// 沒有 manifest（或分片載入失敗）時退回整份 latest.json
+// ════════════════════════════════════════════════════════
+
+let _manifest = null;
+const _loadedShards = new Set();
+
+async function fetchJSON(url, opts) {
+  const res = await fetch(url, opts);
+  if (!res.ok) throw new Error(`HTTP ${res.status}`);
+  return res.json();
+}
+
+async function loadShards(names) {
+  if (!_manifest) return _instiData;
+  const todo = names.filter(n => !_loadedShards.has(n));
+  const parts = await Promise.all(todo.map(n => {
+    const shard = _manifest.shards?.[n];
+    return shard ? fetchJSON(`./data/latest/${shard.file}`) : {};
+  }));
+  todo.forEach((n, i) => { Object.assign(_instiData, parts[i]); _loadedShards.add(n); });
+  return _instiData;
+}
+
 async function loadData() {
-  const url = `./data/latest.json?v=${Date.now()}`;
   let data;
 
   try {
-    const res = await fetch(url, { cache: 'no-store' });
-    if (!res.ok) throw new Error(`HTTP ${res.status}`);
-    data = await res.json();
+    try {
+      _manifest = await fetchJSON(`./data/latest/manifest.json?v=${Date.now()}`, { cache: 'no-store' });
+      _instiData = { generated_at_utc: _manifest.generated_at_utc };
+      data = await loadShards(['main', 'ai']);
+    } catch (err) {
+      console.warn('分片載入失敗，改讀 latest.json：', err);
+      _manifest = null;
+      data = await fetchJSON(`./data/latest.json?v=${Date.now()}`, { cache: 'no-store' });
+    }
   } catch (err) {
     console.error('載入 latest.json 失敗：', err);
     const metaEl = document.getElementById('meta');
@@ -206,6 +237,10 @@ let _instiData = null;
 
 function renderInsti() {
   if (!_instiData) return;
+  if (_manifest && !_loadedShards.has('insti')) {
+    loadShards(['insti']).then(renderInsti).catch(err => console.error('載入法人分片失敗：', err));
+    return;
+  }
   const sig    = _instiData.insti_signal || {};
   const mkt    = _instiData.market_insti || {};
   const date   = _instiData.insti_signal_date || sig.date || '';
@@ -353,6 +388,10 @@ loadData();
 function renderWatch() {
   const data = _instiData;
   if (!data) return;
+  if (_manifest && !_loadedShards.has('watch')) {
+    loadShards(['watch']).then(renderWatch).catch(err => console.error('載入追蹤分片失敗：', err));
+    return;
+  }
 
   const watchlist = data.watchlist_summary || data.watchlist || [];
   const genAt = data.generated_at_utc || '';
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench/bench_pipeline.py — fetch_analyze.py 全流程效能基準
+
+不連網：交易所 / 月營收 / RSS 的回應從 fixture 重播（沒錄到的請求改用合成資料），
+Groq 與 yfinance 以假模組取代；每一輪都在新的暫存目錄執行，不會動到 repo 的 data/
+
+repo 沒有附錄好的 fixture（錄製要連網抓真實的交易所資料），預設全部用 SyntheticExchange
+合成：資料量與欄位格式和真實回應相同（上市 1000 檔、上櫃 800 檔），數值是亂數；
+要用真實回應比較，先 --record 錄一份再 --fixtures 重播
+需要 fetch_analyze.py 的相依套件（requests、pandas、pyarrow、feedparser）
+
+用法：
+  python bench/bench_pipeline.py                              # 合成資料，追蹤清單 100 / 1000 / 10000 筆
+  python bench/bench_pipeline.py --sizes 10000 --repeat 3     # 每個規模跑 3 輪取中位數
+  python bench/bench_pipeline.py --fixtures bench/fixtures    # 重播錄好的回應
+  python bench/bench_pipeline.py --record bench/fixtures      # 連網跑一次，把所有回應錄下來
+  python bench/bench_pipeline.py --json bench_result.json     # 另存結果，供前後版本比較
+
+計時階段：
+  trading_dates  找最近交易日
+  top10          各日全市場外資買賣超 + 前10名（冷快取，含抓取）
+  intersection   連續前10名交集（快取已熱，只算計算）
+  insti_signal   外資 + 投信同時買 / 賣超
+  market_amount  BFI82U 大盤法人金額
+  ai             AI 交叉確認（假 Groq，可用 --llm-latency 模擬延遲）
+  watchlist      追蹤清單更新（收盤價、進榜價、journal）
+  payload        寫 latest.json / history
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import importlib.util
+import contextlib
+import statistics
+import types
+from pathlib import Path
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+STAGES = ["trading_dates", "top10", "intersection", "insti_signal",
+          "market_amount", "ai", "watchlist", "payload"]
+TWSE_IDS = [str(1101 + i) for i in range(1000)]
+TPEX_IDS = [str(3105 + i) for i in range(800)]
+
+T86_FIELDS = ["證券代號", "證券名稱", "外陸資買進股數(不含外資自營商)", "外陸資賣出股數(不含外資自營商)",
+              "外陸資買賣超股數(不含外資自營商)", "外資自營商買進股數", "外資自營商賣出股數",
+              "外資自營商買賣超股數", "投信買進股數", "投信賣出股數", "投信買賣超股數",
+              "自營商買賣超股數", "自營商買進股數(自行買賣)", "自營商賣出股數(自行買賣)",
+              "自營商買賣超股數(自行買賣)", "三大法人買賣超股數"]
+
+
+# ════════════════════════════════════════════════════════
+# HTTP 重播
+# ════════════════════════════════════════════════════════
+
+class FakeResponse:
+    def __init__(self, status_code=200, text="", headers=None, url=""):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode("utf-8")
+        self.headers = headers or {}
+        self.url = url
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests
+            raise requests.HTTPError(f"{self.status_code} {self.url}", response=self)
+
+
+def fixture_key(method, url, params=None, data=None):
+    raw = json.dumps([method.upper(), url, sorted((params or {}).items()),
+                      sorted((data or {}).items())], ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+
+
+class FixtureStore:
+    """錄好的回應：{dir}/{key}.json.gz，內容 {method, url, params, status, headers, text}"""
+
+    def __init__(self, root=None):
+        self.root = Path(root) if root else None
+        self.responses = {}
+        if self.root and self.root.exists():
+            for p in self.root.glob("*.json.gz"):
+                doc = json.loads(gzip.decompress(p.read_bytes()))
+                self.responses[p.name[:-len(".json.gz")]] = doc
+
+    def get(self, key):
+        doc = self.responses.get(key)
+        if doc is None:
+            return None
+        return FakeResponse(doc["status"], doc["text"], doc.get("headers"), doc["url"])
+
+    def save(self, method, url, params, data, resp):
+        key = fixture_key(method, url, params, data)
+        doc = {"method": method, "url": url, "params": params, "status": resp.status_code,
+               "headers": {k: v for k, v in resp.headers.items()
+                           if k.lower() in {"etag", "last-modified", "retry-after"}},
+               "text": resp.text}
+        self.root.mkdir(parents=True, exist_ok=True)
+        raw = json.dumps(doc, ensure_ascii=False).encode("utf-8")
+        (self.root / f"{key}.json.gz").write_bytes(gzip.compress(raw, mtime=0))
+
+
+def _fmt(n):
+    return f"{n:,}"
+
+
+def _from_roc(d):
+    y, m, dd = d.split("/")
+    return f"{int(y) + 1911}{m}{dd}"
+
+
+def _is_weekday(date):
+    return datetime.strptime(date, "%Y%m%d").weekday() < 5
+
+
+def _close(stock_id, date):
+    return round(10 + (int(stock_id) % 490) + random.Random(stock_id + date).uniform(-2, 2), 2)
+
+
+def _net(rnd, i, n):
+    """前段代號每天都偏買超，讓交集不會是空的"""
+    return (n - i) * 5_000 * (1 if i % 3 else -1) + rnd.randint(-2_000_000, 2_000_000)
+
+
+class SyntheticExchange:
+    """依 URL 合成交易所 / 月營收 / RSS 回應；週末視為休市"""
+
+    def handle(self, method, url, params=None, data=None):
+        params = params or {}
+        if "/fund/T86" in url:
+            return self.t86(params["date"])
+        if "3itrade_hedge_result" in url:
+            return self.tpex_insti(_from_roc(params["d"]))
+        if "/fund/BFI82U" in url:
+            return {"stat": "OK", "date": params.get("dayDate"), "data": [
+                ["自營商(自行買賣)", "1", "1", "0"], ["投信", "5,000,000,000", "4,000,000,000", "1,000,000,000"],
+                ["外資及陸資(不含外資自營商)", "90,000,000,000", "80,000,000,000", "10,000,000,000"],
+                ["合計", "95,000,000,000", "84,000,000,000", "11,000,000,000"]]}
+        if "holidaySchedule" in url:
+            return {"stat": "ok", "fields": ["日期", "名稱", "說明"], "data": []}
+        if "MI_INDEX" in url:
+            rows = [[i, f"上市{i}", str(_close(i, params["date"]))] for i in TWSE_IDS]
+            return {"stat": "OK", "tables": [{"fields": ["證券代號", "證券名稱", "收盤價"], "data": rows}]}
+        if "stk_quote_result" in url:
+            date = _from_roc(params["d"])
+            return {"aaData": [[i, f"上櫃{i}", str(_close(i, date))] for i in TPEX_IDS]}
+        if "t187ap05_L" in url or "t187ap05_O" in url:
+            ids = TWSE_IDS if "t187ap05_L" in url else TPEX_IDS
+            now = datetime.now()
+            month = (now.replace(day=1) - timedelta(days=1))
+            period = f"{month.year - 1911}{month.month:02d}"
+            return [{"資料年月": period, "公司代號": i, "公司名稱": f"公司{i}",
+                     "營業收入-當月營收": str(1_000_000 + int(i) * 37),
+                     "營業收入-上月比較增減(%)": "3.21", "營業收入-去年同月增減(%)": "12.5",
+                     "累計營業收入-前期比較增減(%)": "8.8", "備註": "-"} for i in ids]
+        if "rss" in url or "feed" in url:
+            rnd = random.Random(url)
+            items = "".join(
+                f"<item><title><![CDATA[上市{rnd.choice(TWSE_IDS[:50])} 營收成長 訂單能見度佳 {k}]]></title></item>"
+                for k in range(40))
+            return f"<rss><channel><title><![CDATA[feed]]></title>{items}</channel></rss>"
+        return None
+
+    def t86(self, date):
+        if not _is_weekday(date):
+            return {"stat": "很抱歉，沒有符合條件的資料!"}
+        rnd = random.Random("T" + date)
+        rows = []
+        for i, sid in enumerate(TWSE_IDS):
+            net = _net(rnd, i, len(TWSE_IDS))
+            buy = max(net, 0) + rnd.randint(0, 3_000_000)
+            rows.append([sid, f"上市{sid}  ", _fmt(buy), _fmt(buy - net), _fmt(net), "0", "0", "0",
+                         "0", "0", _fmt(rnd.randint(-300_000, 300_000)),
+                         _fmt(rnd.randint(-100_000, 100_000)), "0", "0", "0", "0"])
+        return {"stat": "OK", "fields": T86_FIELDS, "data": rows}
+
+    def tpex_insti(self, date):
+        if not _is_weekday(date):
+            return {"aaData": []}
+        rnd = random.Random("P" + date)
+        rows = []
+        for i, sid in enumerate(TPEX_IDS):
+            net = _net(rnd, i, len(TPEX_IDS)) // 2
+            buy = max(net, 0) + rnd.randint(0, 2_000_000)
+            r = [sid, f"上櫃{sid}"] + ["0"] * 22
+            r[7], r[8], r[9] = _fmt(buy), _fmt(buy - net), _fmt(net)
+            r[12], r[15] = _fmt(rnd.randint(-200_000, 200_000)), _fmt(rnd.randint(-50_000, 50_000))
+            rows.append(r)
+        return {"aaData": rows}
+
+
+class Replayer:
+    """SESSION.request 的替身：先找錄好的 fixture，沒有再用合成資料；記錄每個請求"""
+
+    def __init__(self, store, synthetic, latency=0.0):
+        self.store = store
+        self.synthetic = synthetic
+        self.latency = latency
+        self.calls = 0
+        self.recorded_hits = 0
+        self.misses = []
+
+    def __call__(self, method, url, params=None, data=None, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        resp = self.store.get(fixture_key(method, url, params, data))
+        if resp is not None:
+            self.recorded_hits += 1
+            return resp
+        body = self.synthetic.handle(method, url, params, data)
+        if body is None:
+            self.misses.append(url)
+            return FakeResponse(404, "not found", url=url)
+        text = body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)
+        return FakeResponse(200, text, url=url)
+
+
+class Recorder:
+    """連網模式：照常送出請求並把回應存成 fixture"""
+
+    def __init__(self, real_request, store):
+        self.real_request = real_request
+        self.store = store
+        self.calls = 0
+
+    def __call__(self, method, url, params=None, data=None, **kwargs):
+        self.calls += 1
+        resp = self.real_request(method, url, params=params, data=data, **kwargs)
+        self.store.save(method, url, params, data, resp)
+        return resp
+
+
+# ════════════════════════════════════════════════════════
+# Groq / yfinance 假模組
+# ════════════════════════════════════════════════════════
+
+def install_fake_modules(llm_latency=0.0):
+    import re
+
+    def verdict(ticker):
+        return {"ticker": ticker, "name": "", "verdict": "謹慎觀察", "confidence": "中",
+                "reasons": ["營收年增", "訂單能見度佳"], "warning": None,
+                "next_check": "下月營收", "data_quality": "有限"}
+
+    class Completions:
+        def create(self, messages, **kwargs):
+            if llm_latency:
+                time.sleep(llm_latency)
+            prompt = messages[-1]["content"]
+            tickers = re.findall(r"外資連續兩天買超：(\S+)", prompt)
+            if "JSON 陣列" in prompt:
+                content = json.dumps([verdict(t) for t in tickers], ensure_ascii=False)
+            else:
+                content = json.dumps(verdict(tickers[0] if tickers else ""), ensure_ascii=False)
+            message = types.SimpleNamespace(content=content)
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+    class Groq:
+        def __init__(self, api_key=None):
+            self.chat = types.SimpleNamespace(completions=Completions())
+
+    groq = types.ModuleType("groq")
+    groq.Groq = Groq
+    sys.modules["groq"] = groq
+
+    def download(symbols, period="5d", group_by="ticker", **kwargs):
+        symbols = [symbols] if isinstance(symbols, str) else list(symbols)
+        today = datetime.now()
+        idx = pd.DatetimeIndex([today - timedelta(days=k) for k in range(4, -1, -1)]).normalize()
+        known = set(TWSE_IDS)
+        frames = {}
+        for sym in symbols:
+            sid, _, sfx = sym.partition(".")
+            if (sfx == "TW") != (sid in known):
+                continue  # 後綴和市場不符：yfinance 會回空資料
+            closes = [_close(sid, d.strftime("%Y%m%d")) for d in idx]
+            frames[sym] = pd.DataFrame({"Close": closes}, index=idx)
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, axis=1)  # 與新版 yfinance 相同：單檔也是兩層欄位
+
+    yf = types.ModuleType("yfinance")
+    yf.download = download
+    sys.modules["yfinance"] = yf
+
+
+# ════════════════════════════════════════════════════════
+# 執行一輪
+# ════════════════════════════════════════════════════════
+
+def import_pipeline():
+    """每一輪重新載入 fetch_analyze，讓模組層級的快取都是冷的"""
+    if str(REPO_ROOT) not in sys.path:
+        sys.path.insert(0, str(REPO_ROOT))
+    spec = importlib.util.spec_from_file_location("fetch_analyze", REPO_ROOT / "fetch_analyze.py")
+    fa = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(fa)
+    return fa
+
+
+def seed_watchlist(fa, size):
+    """合成 size 筆追蹤紀錄：代號輪流取自全市場，進榜日散在最近 TRACK_DAYS 個平日"""
+    from watchlist_store import compact_watchlist
+    days, d = [], fa.NOW_TPE - timedelta(days=1)
+    while len(days) < fa.TRACK_DAYS:
+        if d.weekday() < 5:
+            days.append(d.strftime("%Y-%m-%d"))
+        d -= timedelta(days=1)
+    days.reverse()
+    universe = TWSE_IDS + TPEX_IDS
+    ids = [universe[i % len(universe)] for i in range(size)]
+    entry_dates = [days[(i // len(universe)) % len(days)] for i in range(size)]
+    entries = pd.DataFrame({
+        "stock_id": ids,
+        "stock_name": [f"股{s}" for s in ids],
+        "entry_date": entry_dates,
+        "entry_price": [_close(s, e.replace("-", "")) for s, e in zip(ids, entry_dates)],
+    }).drop_duplicates(["stock_id", "entry_date"]).reset_index(drop=True)
+    first = entries.groupby("stock_id")["entry_date"].min()
+    prices = pd.DataFrame([(s, day, _close(s, day.replace("-", "")))
+                           for s, start in first.items() for day in days if day >= start],
+                          columns=["stock_id", "date", "close"])
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        compact_watchlist(entries, prices)
+    return len(entries)
+
+
+def run_once(size, args, store):
+    workdir = Path(tempfile.mkdtemp(prefix="bench_"))
+    prev = os.getcwd()
+    os.chdir(workdir)
+    try:
+        return _run_stages(size, args, store)
+    finally:
+        os.chdir(prev)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _run_stages(size, args, store):
+    fa = import_pipeline()
+    if args.record:
+        http = Recorder(fa.SESSION.request, store)
+    else:
+        http = Replayer(store, SyntheticExchange(), latency=args.http_latency)
+        if not args.real_limits:  # 量的是程式本身，不是主機限流的等待
+            fa.HOST_LIMITS = {}
+            fa.DEFAULT_HOST_LIMIT = (64, 1e9)
+    fa.SESSION.request = http
+    n_entries = seed_watchlist(fa, size)
+
+    timings, requests_by_stage = {}, {}
+    out = sys.stdout if args.verbose else open(os.devnull, "w")
+
+    @contextlib.contextmanager
+    def stage(name):
+        calls, t0 = http.calls, time.perf_counter()
+        with contextlib.redirect_stdout(out):
+            yield
+        timings[name] = time.perf_counter() - t0
+        requests_by_stage[name] = http.calls - calls
+
+    with stage("trading_dates"):
+        dates = fa.find_recent_trading_dates(days=args.days, lookback=30)
+    with stage("top10"):
+        fa.run_parallel(fa.get_daily_top10, dates[:args.days])
+    with stage("intersection"):
+        result, tops = fa.get_consecutive_top10(days=args.days)
+    latest = dates[0]
+    with stage("insti_signal"):
+        three = fa.get_insti_signal(latest, top_n=10)
+    frames = three.pop("_frames", [])
+    with stage("market_amount"):
+        market = fa.get_market_insti_amount(latest, frames)
+    with stage("ai"):
+        ai = fa.run_ai_cross_check(result)
+    with stage("watchlist"):
+        watchlist = fa.update_watchlist(result)
+    with stage("payload"):
+        fa.write_json_payload(result, tops, ai, three, market, watchlist)
+
+    info = {"entries": n_entries, "intersection": int(len(result)),
+            "requests": http.calls, "misses": sorted(set(getattr(http, "misses", [])))}
+    return timings, requests_by_stage, info
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fetch_analyze.py 全流程效能基準")
+    parser.add_argument("--sizes", default="100,1000,10000", help="追蹤清單筆數，逗號分隔")
+    parser.add_argument("--repeat", type=int, default=1, help="每個規模跑幾輪（取中位數）")
+    parser.add_argument("--days", type=int, default=2, help="連續天數（同 DAYS）")
+    parser.add_argument("--fixtures", help="重播錄好的回應（目錄）")
+    parser.add_argument("--record", help="連網跑一次並把回應錄到這個目錄")
+    parser.add_argument("--http-latency", type=float, default=0.0, help="每個請求模擬延遲（秒）")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="每次 LLM 呼叫模擬延遲（秒）")
+    parser.add_argument("--real-limits", action="store_true", help="保留每個主機的限流設定")
+    parser.add_argument("--json", help="結果另存 JSON")
+    parser.add_argument("--verbose", action="store_true", help="顯示 fetch_analyze 的輸出")
+    args = parser.parse_args()
+
+    os.environ.setdefault("GROQ_API_KEY", "bench")
+    os.environ.setdefault("GROQ_RPM", "1000000")
+    install_fake_modules(llm_latency=args.llm_latency)
+    store = FixtureStore(args.record or args.fixtures)
+    sizes = [int(x) for x in args.sizes.split(",")]
+    if args.record:
+        sizes, args.repeat = sizes[:1], 1
+
+    report = {"generated_at": datetime.now().isoformat(timespec="seconds"),
+              "days": args.days, "repeat": args.repeat,
+              "fixtures": len(store.responses), "sizes": {}}
+    for size in sizes:
+        runs = [run_once(size, args, store) for _ in range(args.repeat)]
+        info = runs[-1][2]
+        sec = {s: statistics.median(r[0][s] for r in runs) for s in STAGES}
+        reqs = runs[-1][1]
+        report["sizes"][size] = {"stages": {s: {"sec": round(sec[s], 4), "requests": reqs[s]}
+                                            for s in STAGES},
+                                 "total_sec": round(sum(sec.values()), 4), **info}
+        print(f"\n追蹤清單 {info['entries']:,} 筆，交集 {info['intersection']} 檔"
+              f"（{args.repeat} 輪中位數）")
+        print(f"  {'stage':<15}{'sec':>10}{'requests':>10}")
+        for s in STAGES:
+            print(f"  {s:<15}{sec[s]:>10.3f}{reqs[s]:>10}")
+        print(f"  {'total':<15}{sum(sec.values()):>10.3f}{info['requests']:>10}")
+        if info["misses"]:
+            print(f"  ⚠️ 沒有 fixture 也無法合成：{', '.join(info['misses'])}")
+    if args.record:
+        print(f"\n[OK] 已錄下 {len(list(Path(args.record).glob('*.json.gz')))} 個回應到 {args.record}")
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"[OK] 寫入 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,15 @@
 # -*- coding: utf-8 -*-
 """
 watchlist_module.py — 追蹤名單模組
-可獨立使用或整合進 fetch_analyze.py
+可單獨執行或整合進 fetch_analyze.py，但不是可搬到別的專案的獨立模組：
+儲存層 watchlist_store.py 在 repo 根目錄，資料路徑（data/...）也以 repo 根目錄為準，
+必須在本 repo 內、從根目錄執行
 
-使用方式（獨立執行）:
-  python watchlist_module.py              # 更新所有追蹤股票收盤價
-  python watchlist_module.py --add 2303 聯電 84.0 2026-05-05  # 手動加入
-  python watchlist_module.py --remove 2303 2026-04-23          # 手動移除
-  python watchlist_module.py --list                             # 列出清單
+使用方式（在 repo 根目錄執行）:
+  python claudecode_pkg/watchlist_module.py                                   # 更新所有追蹤股票收盤價
+  python claudecode_pkg/watchlist_module.py add 2303 聯電 84.0 2026-05-05     # 手動加入
+  python claudecode_pkg/watchlist_module.py remove 2303 2026-04-23            # 手動移除
+  python claudecode_pkg/watchlist_module.py list                              # 列出清單
 """
 import os, json, math, time, argparse
 import pandas as pd
@@ -19,6 +21,11 @@ TPE_TZ   = timezone(timedelta(hours=8))
 NOW_TPE  = datetime.now(TPE_TZ)
 TRACK_DAYS = 10
 
+# 儲存層與 fetch_analyze.py 共用（repo 根目錄的 watchlist_store.py，離開本 repo 無法使用）
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from watchlist_store import load_watchlist, save_watchlist
+
 import requests
 SESSION = requests.Session()
 SESSION.headers.update({"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"})
@@ -27,16 +34,37 @@ SESSION.headers.update({"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)
 # 進榜股票追蹤（10天漲跌幅監控）
 # ════════════════════════════════════════════════════════
 
-OUT_WATCHLIST = Path("data/watchlist.json")
+SYMBOLS_PATH = Path("data/symbols.json")  # fetch_analyze.py 維護的代號目錄
 TRACK_DAYS = 10  # 追蹤天數
 
+_SYMBOLS = None
+
+
+def load_symbol_directory() -> dict:
+    """載入代號目錄（每次執行只讀一次檔）；還沒產生或檔案損壞時為空目錄"""
+    global _SYMBOLS
+    if _SYMBOLS is None:
+        try:
+            _SYMBOLS = json.loads(SYMBOLS_PATH.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            _SYMBOLS = {}
+    return _SYMBOLS
+
+
+def yf_suffix(ticker: str) -> str:
+    """依代號目錄決定 .TW / .TWO；目錄沒有的才用代號猜"""
+    entry = load_symbol_directory().get(ticker)
+    if entry:
+        return ".TWO" if entry["market"] == "TPEx" else ".TW"
+    return ".TWO" if ticker.startswith("00") and len(ticker) == 5 else ".TW"
+
 
 def get_close_price(ticker: str) -> float | None:
     """抓當日收盤價，優先用 yfinance，fallback 用 TWSE"""
     # ── 方法一：yfinance（GH Actions 環境最穩）──
     try:
         import yfinance as yf
-        suffix = ".TWO" if ticker.startswith("00") and len(ticker) == 5 else ".TW"
+        suffix = yf_suffix(ticker)
         t = yf.Ticker(ticker + suffix)
         hist = t.history(period="5d")
         if not hist.empty:
@@ -90,23 +118,6 @@ def get_close_price(ticker: str) -> float | None:
     return None
 
 
-def load_watchlist() -> list:
-    """載入追蹤清單"""
-    if OUT_WATCHLIST.exists():
-        try:
-            return json.loads(OUT_WATCHLIST.read_text(encoding="utf-8"))
-        except Exception:
-            pass
-    return []
-
-
-def save_watchlist(items: list):
-    OUT_WATCHLIST.parent.mkdir(parents=True, exist_ok=True)
-    OUT_WATCHLIST.write_text(
-        json.dumps(items, ensure_ascii=False, indent=2), encoding="utf-8"
-    )
-
-
 def update_watchlist(result_df) -> list:
     """
     1. 載入現有追蹤清單
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+export_dataset.py — 交集結果的分區資料集
+取代每次執行都多一個的 exports/外資連續前10名交集_{timestamp}.csv
+
+檔案：
+  exports/dataset/date=YYYY-MM-DD/part.parquet   以交易日（day1_date）分區，一天一個檔
+欄位與舊 CSV 相同（stock_id, stock_name, day1_rank, day1_net_buy, day1_date, ...,
+total_net_buy, avg_net_buy），另加 generated_at（寫入時間，TPE）
+同一交易日重跑時整個分區換掉，不會重複
+
+用法：
+  python export_dataset.py import [--remove]    # 把舊 CSV 匯入（同交易日取最後一次執行），--remove 匯入後刪除
+  python export_dataset.py show [--start 2026-01-01] [--end 2026-03-31]
+"""
+import os
+import re
+import sys
+import argparse
+import pandas as pd
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+
+TPE_TZ = timezone(timedelta(hours=8))
+EXPORT_DIR = Path("exports")
+EXPORT_DATASET_DIR = EXPORT_DIR / "dataset"
+LEGACY_CSV_GLOB = "外資連續前10名交集_*.csv"
+
+
+def _partition_path(date: str, root: Path = EXPORT_DATASET_DIR) -> Path:
+    return root / f"date={date}" / "part.parquet"
+
+
+def write_export_partition(result: pd.DataFrame, generated_at: str = None) -> Path:
+    """把一次執行的交集結果寫成 day1_date 那天的分區（已存在就覆蓋）"""
+    date = str(result["day1_date"].iloc[0])
+    df = result.copy()
+    df["stock_id"] = df["stock_id"].astype(str).str.strip()
+    df["stock_name"] = df["stock_name"].astype(str).str.strip()
+    df["generated_at"] = generated_at or datetime.now(TPE_TZ).strftime("%Y-%m-%d %H:%M")
+    path = _partition_path(date)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+    return path
+
+
+def export_dates(root: Path = EXPORT_DATASET_DIR) -> list:
+    return sorted(p.name[5:] for p in root.glob("date=*") if (p / "part.parquet").exists())
+
+
+def load_export_dataset(start: str = None, end: str = None,
+                        root: Path = EXPORT_DATASET_DIR) -> pd.DataFrame:
+    """讀取分區（日期 YYYY-MM-DD，含頭尾），多一欄 date；天數不同的分區欄位會自動對齊"""
+    frames = [pd.read_parquet(_partition_path(d, root)).assign(date=d)
+              for d in export_dates(root)
+              if (not start or d >= start) and (not end or d <= end)]
+    if not frames:
+        return pd.DataFrame(columns=["date", "stock_id", "stock_name"])
+    df = pd.concat(frames, ignore_index=True)
+    return df[["date"] + [c for c in df.columns if c != "date"]]
+
+
+def read_legacy_csvs(src: Path = EXPORT_DIR):
+    """讀舊 CSV，回傳 (檔案清單, {交易日: (DataFrame, generated_at)})；同一交易日以檔名時間戳最新的為準"""
+    latest = {}
+    files = sorted(src.glob(LEGACY_CSV_GLOB))
+    for path in files:  # 檔名 _{yyyymmdd}_{hhmm} 排序即執行先後
+        try:
+            df = pd.read_csv(path, dtype={"stock_id": str}, encoding="utf-8-sig")
+        except Exception as e:
+            print(f"  ⚠️ {path} 讀取失敗：{e}")
+            continue
+        if df.empty or "day1_date" not in df.columns:
+            continue
+        stamp = re.search(r"_(\d{8})_(\d{4})\.csv$", path.name)
+        generated_at = (datetime.strptime("".join(stamp.groups()), "%Y%m%d%H%M")
+                        .strftime("%Y-%m-%d %H:%M") if stamp else "")
+        latest[str(df["day1_date"].iloc[0])] = (df, generated_at)
+    return files, latest
+
+
+def import_csv_exports(src: Path = EXPORT_DIR, remove: bool = False) -> int:
+    """舊 CSV → 分區（已存在的同日分區會被覆蓋）。回傳寫入的分區數"""
+    files, latest = read_legacy_csvs(src)
+    for df, generated_at in latest.values():
+        write_export_partition(df, generated_at)
+    print(f"  📦 匯入 {len(files)} 個 CSV → {len(latest)} 個交易日分區（{EXPORT_DATASET_DIR}）")
+    if remove:
+        for path in files:
+            path.unlink()
+        print(f"  🗑️ 已刪除 {len(files)} 個舊 CSV")
+    return len(latest)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="交集結果分區資料集")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("import", help="匯入 exports/ 下的舊 CSV")
+    p.add_argument("--remove", action="store_true", help="匯入後刪除舊 CSV")
+    p = sub.add_parser("show", help="列出資料集內容")
+    p.add_argument("--start", help="YYYY-MM-DD（含）")
+    p.add_argument("--end", help="YYYY-MM-DD（含）")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cmd == "import":
+        import_csv_exports(remove=args.remove)
+        sys.exit(0)
+    pd.set_option("display.width", 200)
+    pd.set_option("display.max_columns", None)
+    pd.set_option("display.unicode.east_asian_width", True)
+    df = load_export_dataset(args.start, args.end)
+    print(df.to_string(index=False) if len(df) else "（沒有符合的紀錄）")
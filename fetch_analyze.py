@@ -5,22 +5,38 @@
 + AI 交叉確認（自動抓取任意股票月營收 + 新聞）
 """
 import os
+import sys
 import math
 import json
 import re
+import gzip
+import hashlib
 import time
+import argparse
+import threading
 import requests
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 from datetime import datetime, timedelta, timezone
 import feedparser
 from groq import Groq
+from watchlist_store import load_watchlist_frames, save_watchlist_frames, returns_matrix
+from history_index import index_history_payload
+from export_dataset import write_export_partition
+import json_io
+from http_client import ResilientClient, CircuitOpenError, backoff_delay, retry_after_seconds
 
 TPE_TZ = timezone(timedelta(hours=8))
 NOW_TPE = datetime.now(TPE_TZ)
 OUT_LATEST = Path("data/latest.json")
 OUT_HISTORY_DIR = Path("data/history")
 OUT_EXPORT_DIR = Path("exports")
+RAW_CACHE_DIR = Path("data/raw")
+SYMBOLS_PATH = Path("data/symbols.json")
 OUT_HISTORY_DIR.mkdir(parents=True, exist_ok=True)
 OUT_EXPORT_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -30,196 +46,782 @@ SESSION.headers.update({
 })
 
 
-def http_get(url, params=None, retries=3, timeout=30):
-    last_err = None
-    for i in range(retries):
+# ════════════════════════════════════════════════════════
+# 執行指標：各階段耗時、每個主機的請求數 / 流量 / 錯誤 / 重試、快取命中
+# 寫進 latest.json 的 run_metrics，並 append 一行到 data/metrics_log.jsonl
+# ════════════════════════════════════════════════════════
+
+METRICS_LOG_PATH = Path("data/metrics_log.jsonl")
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.started_at = datetime.now(TPE_TZ).isoformat(timespec="seconds")
+        self.stages = {}
+        self.hosts = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """累計某階段的耗時（同名階段並行 / 重複執行時相加）"""
+        t0 = time.perf_counter()
         try:
-            r = SESSION.get(url, params=params, timeout=timeout)
-            r.raise_for_status()
-            return r
-        except Exception as e:
-            last_err = e
-            time.sleep(1.2 * (i + 1))
-    raise last_err
+            yield
+        finally:
+            with self.lock:
+                self.stages[name] = round(self.stages.get(name, 0) + time.perf_counter() - t0, 3)
+
+    def _host(self, url):
+        host = urlsplit(url).hostname or url
+        return self.hosts.setdefault(host, {"requests": 0, "errors": 0, "retries": 0,
+                                            "bytes": 0, "seconds": 0.0})
+
+    def record_request(self, url, seconds, nbytes=0, ok=True):
+        with self.lock:
+            h = self._host(url)
+            h["requests"] += 1
+            h["bytes"] += nbytes
+            h["seconds"] = round(h["seconds"] + seconds, 3)
+            if not ok:
+                h["errors"] += 1
+
+    def record_retry(self, url):
+        with self.lock:
+            self._host(url)["retries"] += 1
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            hosts = {h: dict(v) for h, v in sorted(self.hosts.items())}
+            return {
+                "started_at": self.started_at,
+                "elapsed_sec": round(time.perf_counter() - self.started, 3),
+                "stages": dict(self.stages),
+                "requests": sum(v["requests"] for v in hosts.values()),
+                "bytes": sum(v["bytes"] for v in hosts.values()),
+                "hosts": hosts,
+                "counters": dict(sorted(self.counters.items())),
+            }
 
-def to_number(x):
-    if x is None: return 0.0
-    if isinstance(x, (int, float)): return float(x)
-    s = str(x).strip().replace(',', '')
-    if s in {'', '-'}: return 0.0
-    try: return float(s)
-    except: return 0.0
+    def append_log(self, **extra):
+        """每次執行 append 一行 JSON，方便畫長期趨勢"""
+        METRICS_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with METRICS_LOG_PATH.open("ab") as f:
+            f.write(json_io.dumps({**self.snapshot(), **extra}) + b"\n")
 
 
-def get_twse_foreign_data(date):
+METRICS = RunMetrics()
+
+
+# ════════════════════════════════════════════════════════
+# 並行抓取引擎（每個主機限流，取代固定 sleep）
+# ════════════════════════════════════════════════════════
+
+# host: (最大同時連線數, 每秒請求數)
+HOST_LIMITS = {
+    "www.twse.com.tw":          (2, 3.0),
+    "www.tpex.org.tw":          (2, 3.0),
+    "openapi.twse.com.tw":      (1, 1.0),
+    "query1.finance.yahoo.com": (4, 8.0),
+    "tw.stock.yahoo.com":       (2, 4.0),
+    "news.google.com":          (2, 4.0),
+    "technews.tw":              (2, 4.0),
+    "feeds.feedburner.com":     (2, 4.0),
+}
+DEFAULT_HOST_LIMIT = (2, 2.0)
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "8"))
+
+
+class TokenBucket:
+    """Token bucket：平均每秒 rate 次，最多累積 capacity 次突發"""
+
+    def __init__(self, rate, capacity=1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostLimiter:
+    """單一主機的同時連線上限 + 速率限制"""
+
+    def __init__(self, concurrency, rate):
+        self.sem = threading.BoundedSemaphore(concurrency)
+        self.bucket = TokenBucket(rate)
+
+    @contextmanager
+    def slot(self):
+        with self.sem:
+            self.bucket.acquire()
+            yield
+
+
+_HOST_LIMITERS = {}
+_HOST_LIMITERS_LOCK = threading.Lock()
+
+
+def host_limiter(url):
+    host = urlsplit(url).hostname or ""
+    with _HOST_LIMITERS_LOCK:
+        if host not in _HOST_LIMITERS:
+            _HOST_LIMITERS[host] = HostLimiter(*HOST_LIMITS.get(host, DEFAULT_HOST_LIMIT))
+        return _HOST_LIMITERS[host]
+
+
+def throttled_request(method, url, **kwargs):
+    """所有對外 HTTP 都走這裡：依主機排隊限流後才送出"""
+    with host_limiter(url).slot():
+        t0 = time.perf_counter()
+        try:
+            resp = SESSION.request(method, url, **kwargs)
+        except Exception:
+            METRICS.record_request(url, time.perf_counter() - t0, ok=False)
+            raise
+    METRICS.record_request(url, time.perf_counter() - t0, len(resp.content),
+                           resp.status_code < 400)
+    return resp
+
+
+def run_parallel(fn, items, max_workers=FETCH_WORKERS):
+    """以執行緒池並行跑 fn(item)，結果順序與 items 相同"""
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(x) for x in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        return list(pool.map(fn, items))
+
+
+# 重試、退避、Retry-After、每主機熔斷都在 http_client；實際送出仍經過 throttled_request 限流計量
+HTTP = ResilientClient(send=throttled_request, on_retry=METRICS.record_retry,
+                       on_open=lambda url: METRICS.count("circuit_open"))
+
+
+def http_get_json(url, params=None, retries=3, timeout=30):
+    return HTTP.get_json(url, params=params, timeout=timeout, retries=retries)
+
+def to_numbers(s: pd.Series) -> pd.Series:
+    """整欄轉數字：去千分位逗號，空白 / '-' / 無法解析的都當 0"""
+    if pd.api.types.is_numeric_dtype(s):
+        return s.astype(float).fillna(0.0)
+    s = s.astype(str).str.replace(',', '', regex=False).str.strip()
+    return pd.to_numeric(s, errors='coerce').fillna(0.0)
+
+
+# ════════════════════════════════════════════════════════
+# 法人買賣超原始表（每個 (market, date) 每次執行只抓一次）
+# ════════════════════════════════════════════════════════
+
+# 原始表統一欄位（單位：股）；外資 / 三大法人兩種視圖都從這裡投影
+RAW_INSTI_COLUMNS = ["stock_id", "stock_name",
+                     "foreign_buy", "foreign_sell", "foreign_net",
+                     "trust_net", "dealer_net"]
+
+_RAW_INSTI_CACHE = {}  # (market, date) -> DataFrame | None
+_RAW_INSTI_LOCKS = {}
+_RAW_INSTI_LOCKS_LOCK = threading.Lock()
+# TWSE 對休市日回 stat「很抱歉，沒有符合條件的資料!」；只有看到這個才算交易所明確說沒資料，
+# 空的 data、其他 stat（資料還沒出來、被擋）都不算
+TWSE_NO_DATA_STAT = "沒有符合條件的資料"
+_RAW_NO_DATA = set()  # 交易所明確回覆查無資料的 (market, date)
+
+# 交易所約 16:30 後才公布完整法人資料；在此時間之後抓到的就視為定案
+RAW_FINAL_HOUR = 18
+
+
+def _raw_cache_path(market, date):
+    return RAW_CACHE_DIR / market.lower() / f"{date}.json.gz"
+
+
+def _raw_is_final(date, fetched_at):
+    """該日資料在 fetched_at 時是否已定案（之後不會再變）"""
+    final_at = datetime.strptime(date, "%Y%m%d").replace(hour=RAW_FINAL_HOUR, tzinfo=TPE_TZ)
+    return datetime.fromisoformat(fetched_at) >= final_at
+
+
+def fetch_exchange_json(market, date, url, params, has_data):
+    """
+    帶磁碟快取的交易所 JSON 下載：data/raw/{market}/{yyyymmdd}.json.gz
+    已定案的過去日期直接讀檔不連網；當日（未定案）每次都重抓並覆寫。
+    只快取有資料的回應，避免把暫時性的空結果永久記住
+    """
+    path = _raw_cache_path(market, date)
+    if path.exists():
+        try:
+            doc = json.loads(gzip.decompress(path.read_bytes()))
+            if _raw_is_final(date, doc["fetched_at"]):
+                METRICS.count("raw_cache_hits")
+                return doc["payload"]
+        except Exception as e:
+            print(f"⚠️ 快取 {path} 讀取失敗，重新下載: {e}")
+    METRICS.count("raw_cache_misses")
+    data = http_get_json(url, params=params)
+    if has_data(data):
+        doc = {"market": market, "date": date,
+               "fetched_at": datetime.now(TPE_TZ).isoformat(timespec="seconds"),
+               "payload": data}
+        json_io.write_bytes_atomic(path, gzip.compress(json_io.dumps(doc), mtime=0))
+    return data
+
+
+def _fetch_twse_insti_raw(date):
     url = "https://www.twse.com.tw/rwd/zh/fund/T86"
     params = {'date': date, 'selectType': 'ALL', 'response': 'json'}
+    data = fetch_exchange_json("TWSE", date, url, params,
+                               lambda d: bool(d.get('data')))
+    if 'data' not in data or len(data['data']) == 0:
+        if TWSE_NO_DATA_STAT in str(data.get('stat', '')):
+            _RAW_NO_DATA.add(("TWSE", date))
+        return None
+    df = pd.DataFrame(data['data'], columns=data['fields'])
+    df = df[['證券代號', '證券名稱',
+             '外陸資買進股數(不含外資自營商)',
+             '外陸資賣出股數(不含外資自營商)',
+             '外陸資買賣超股數(不含外資自營商)',
+             '投信買賣超股數',
+             '自營商買賣超股數']].copy()
+    df.columns = RAW_INSTI_COLUMNS
+    return df
+
+
+def _fetch_tpex_insti_raw(date):
+    year = int(date[:4]) - 1911
+    date_tw = f"{year}/{date[4:6]}/{date[6:8]}"
+    url = "https://www.tpex.org.tw/web/stock/3insti/daily_trade/3itrade_hedge_result.php"
+    params = {'l': 'zh-tw', 'd': date_tw, 'se': 'AL', 'response': 'json'}
+    data = fetch_exchange_json("TPEx", date, url, params,
+                               lambda d: bool(d.get('aaData')))
+    if 'aaData' not in data or len(data['aaData']) == 0:
+        return None
+    df = pd.DataFrame(data['aaData'])
+    # 欄位：0代號,1名稱,7/8/9外資買/賣/買賣超,12投信買賣超,15自營商買賣超
+    df = df[[0, 1, 7, 8, 9, 12, 15]].copy()
+    df.columns = RAW_INSTI_COLUMNS
+    return df
+
+
+_RAW_INSTI_FETCHERS = {"TWSE": _fetch_twse_insti_raw, "TPEx": _fetch_tpex_insti_raw}
+
+
+def get_insti_raw(market, date):
+    """
+    取得某市場某日的法人買賣超原始表（已轉數字，單位：股）
+    同一次執行中每個 (market, date) 只會打一次網路；
+    非交易日（無資料）也會記住，連線失敗則不記，下次呼叫再試
+    """
+    key = (market, date)
+    with _RAW_INSTI_LOCKS_LOCK:
+        lock = _RAW_INSTI_LOCKS.setdefault(key, threading.Lock())
+    with lock:  # 並行時同一張表只讓一個執行緒去抓
+        if key in _RAW_INSTI_CACHE:
+            METRICS.count("raw_memo_hits")
+        else:
+            df = _RAW_INSTI_FETCHERS[market](date)
+            if df is not None:
+                for col in RAW_INSTI_COLUMNS[2:]:
+                    df[col] = to_numbers(df[col])
+            _RAW_INSTI_CACHE[key] = df
+        return _RAW_INSTI_CACHE[key]
+
+
+def _foreign_view(raw, date, market):
+    df = raw[['stock_id', 'stock_name', 'foreign_buy', 'foreign_sell', 'foreign_net']].copy()
+    df.columns = ['stock_id', 'stock_name', 'buy_shares', 'sell_shares', 'net_shares']
+    df['date'] = date
+    df['market'] = market
+    return df
+
+
+def get_twse_foreign_data(date):
     try:
-        response = http_get(url, params=params)
-        data = response.json()
-        if 'data' not in data or len(data['data']) == 0:
+        raw = get_insti_raw("TWSE", date)
+        if raw is None:
             return None
-        df = pd.DataFrame(data['data'], columns=data['fields'])
-        df = df[['證券代號', '證券名稱',
-                 '外陸資買進股數(不含外資自營商)',
-                 '外陸資賣出股數(不含外資自營商)',
-                 '外陸資買賣超股數(不含外資自營商)']].copy()
-        df.columns = ['stock_id', 'stock_name', 'buy_shares', 'sell_shares', 'net_shares']
-        for col in ['buy_shares', 'sell_shares', 'net_shares']:
-            df[col] = df[col].map(to_number)
-        df['date'] = date
-        df['market'] = 'TWSE'
-        return df
+        return _foreign_view(raw, date, 'TWSE')
     except Exception as e:
         print(f"⚠️ TWSE {date} 查詢失敗: {e}")
         return None
 
 def get_tpex_foreign_data(date):
-    year = int(date[:4]) - 1911
-    date_tw = f"{year}/{date[4:6]}/{date[6:8]}"
-    url = "https://www.tpex.org.tw/web/stock/3insti/daily_trade/3itrade_hedge_result.php"
-    params = {'l': 'zh-tw', 'd': date_tw, 'se': 'AL', 'response': 'json'}
     try:
-        response = http_get(url, params=params)
-        data = response.json()
-        if 'aaData' not in data or len(data['aaData']) == 0:
+        raw = get_insti_raw("TPEx", date)
+        if raw is None:
             return None
-        df = pd.DataFrame(data['aaData'])
-        df = df[[0, 1, 7, 8, 9]].copy()
-        df.columns = ['stock_id', 'stock_name', 'buy_shares', 'sell_shares', 'net_shares']
-        for col in ['buy_shares', 'sell_shares', 'net_shares']:
-            df[col] = df[col].map(to_number)
-        df['date'] = date
-        df['market'] = 'TPEx'
-        return df
+        return _foreign_view(raw, date, 'TPEx')
     except Exception as e:
         print(f"⚠️ TPEx {date} 查詢失敗: {e}")
         return None
 
-def get_daily_top10(date):
-    all_data = []
-    df_twse = get_twse_foreign_data(date)
-    if df_twse is not None: all_data.append(df_twse)
-    time.sleep(0.3)
-    df_tpex = get_tpex_foreign_data(date)
-    if df_tpex is not None: all_data.append(df_tpex)
+# ════════════════════════════════════════════════════════
+# 代號目錄（stock_id → 市場 / 名稱 / 上市狀態）
+# 外資買賣超表沒有證券類別，所以不記 ETF；is_etf 仍依代號前綴判斷
+# ════════════════════════════════════════════════════════
+
+# last_seen 只在超過這個天數才更新，避免每天整個檔案都變動
+SYMBOL_SEEN_REFRESH_DAYS = 30
+SYMBOL_INACTIVE_DAYS = 90
+YF_SUFFIX = {"TWSE": ".TW", "TPEx": ".TWO"}
+
+_SYMBOLS = None
+_SYMBOLS_LOCK = threading.Lock()
+
+
+def load_symbol_directory() -> dict:
+    """載入代號目錄（每次執行只讀一次檔）"""
+    global _SYMBOLS
+    with _SYMBOLS_LOCK:
+        if _SYMBOLS is None:
+            try:
+                _SYMBOLS = json.loads(SYMBOLS_PATH.read_text(encoding="utf-8"))
+            except Exception:
+                _SYMBOLS = {}
+        return _SYMBOLS
+
+
+def update_symbol_directory(df):
+    """
+    用外資買賣超表的 market 欄增量更新代號目錄並存檔
+    只有新代號、市場或名稱改變、last_seen 過舊時才會寫檔
+    """
+    symbols = load_symbol_directory()
+    date = str(df["date"].iloc[0])
+    changed = False
+    with _SYMBOLS_LOCK:
+        for stock_id, name, market in zip(df["stock_id"], df["stock_name"], df["market"]):
+            stock_id, name = str(stock_id).strip(), str(name).strip()
+            entry = symbols.get(stock_id)
+            if (entry and entry["market"] == market and entry["name"] == name
+                    and (datetime.strptime(date, "%Y%m%d")
+                         - datetime.strptime(entry["last_seen"], "%Y%m%d")).days
+                    < SYMBOL_SEEN_REFRESH_DAYS):
+                continue
+            if entry and entry["last_seen"] > date:  # 回補舊日期時不要覆蓋較新的資訊
+                continue
+            symbols[stock_id] = {"market": market, "name": name,
+                                 "status": "listed",
+                                 "last_seen": date}
+            changed = True
+        cutoff = (datetime.strptime(date, "%Y%m%d")
+                  - timedelta(days=SYMBOL_INACTIVE_DAYS)).strftime("%Y%m%d")
+        for entry in symbols.values():
+            if entry["status"] == "listed" and entry["last_seen"] < cutoff:
+                entry["status"] = "inactive"
+                changed = True
+        if changed:
+            json_io.write_json(SYMBOLS_PATH, symbols, sort_keys=True)
+
+
+def symbol_market(stock_id):
+    """回傳 'TWSE' / 'TPEx'，目錄裡沒有則回傳 None"""
+    entry = load_symbol_directory().get(stock_id)
+    return entry["market"] if entry else None
+
+
+def get_daily_net(date):
+    """全市場（上市 + 上櫃）某日外資買賣超，依代號彙總；非交易日回傳 None"""
+    frames = run_parallel(lambda fetch: fetch(date),
+                          [get_twse_foreign_data, get_tpex_foreign_data])
+    all_data = [df for df in frames if df is not None]
     if not all_data: return None
     combined = pd.concat(all_data, ignore_index=True)
-    daily_result = combined.groupby(['stock_id', 'stock_name'], as_index=False).agg(
+    update_symbol_directory(combined)
+    return combined.groupby(['stock_id', 'stock_name'], as_index=False).agg(
         buy_shares=('buy_shares', 'sum'),
         sell_shares=('sell_shares', 'sum'),
         net_shares=('net_shares', 'sum')
     )
+
+
+def _daily_top10(daily_result):
+    # 淨買超股數相同時代號小的在前，與 topn_rank 的名次一致
     daily_top10 = daily_result.sort_values(
-        'net_shares', ascending=False).head(10).reset_index(drop=True)
+        ['net_shares', 'stock_id'], ascending=[False, True]).head(10).reset_index(drop=True)
     daily_top10['買入_張'] = (daily_top10['buy_shares'] / 1000).round(0).astype(int)
     daily_top10['賣出_張'] = (daily_top10['sell_shares'] / 1000).round(0).astype(int)
     daily_top10['淨買超_張'] = (daily_top10['net_shares'] / 1000).round(0).astype(int)
     return daily_top10
 
-def find_recent_trading_dates(days=2, lookback=20):
-    trading_dates = []
-    check_date = NOW_TPE
+
+def get_daily_top10(date):
+    daily_result = get_daily_net(date)
+    return None if daily_result is None else _daily_top10(daily_result)
+
+# ════════════════════════════════════════════════════════
+# 交易日曆（data/trading_calendar.json）
+# 已知交易日 / 休市日記在本地，只有日曆答不出來的日子（通常是今天）才連網探測
+# ════════════════════════════════════════════════════════
+
+TRADING_CALENDAR_PATH = Path("data/trading_calendar.json")
+HOLIDAY_SCHEDULE_URL = "https://www.twse.com.tw/rwd/zh/holidaySchedule/holidaySchedule"
+_CALENDAR = None
+_CALENDAR_LOCK = threading.Lock()
+_HOLIDAY_TRIED = set()  # 本次執行已下載過（含失敗 / 尚未公布）的年度
+
+
+def _seed_trading_dates() -> set:
+    """已有的 history 檔名與 TWSE 原始快取都是確定的交易日"""
+    dates = {p.stem for p in OUT_HISTORY_DIR.glob("*.json") if p.stem.isdigit()}
+    dates |= {p.name[:8] for p in (RAW_CACHE_DIR / "twse").glob("*.json.gz")}
+    return dates
+
+
+def load_trading_calendar() -> dict:
+    """{"trading": set, "closed": set, "holiday_years": set}，每次執行只讀一次檔"""
+    global _CALENDAR
+    with _CALENDAR_LOCK:
+        if _CALENDAR is None:
+            try:
+                doc = json.loads(TRADING_CALENDAR_PATH.read_text(encoding="utf-8"))
+            except Exception:
+                doc = {}
+            _CALENDAR = {"trading": set(doc.get("trading", [])) | _seed_trading_dates(),
+                         "closed": set(doc.get("closed", [])),
+                         "holiday_years": set(doc.get("holiday_years", []))}
+            _CALENDAR["closed"] -= _CALENDAR["trading"]
+        return _CALENDAR
+
+
+def _save_trading_calendar(cal):
+    json_io.write_json(TRADING_CALENDAR_PATH, {k: sorted(v) for k, v in cal.items()})
+
+
+def _fetch_holiday_schedule(year):
+    """TWSE 年度休市日期表，回傳休市日 set；下載失敗回傳 None"""
+    try:
+        data = http_get_json(HOLIDAY_SCHEDULE_URL,
+                             params={"date": f"{year}0101", "response": "json"})
+    except Exception as e:
+        print(f"⚠️ {year} 休市日期表下載失敗: {e}")
+        return None
+    closed = set()
+    for row in data.get("data") or []:
+        name = str(row[1]) if len(row) > 1 else ""
+        if "開始交易" in name or "最後交易" in name:
+            continue  # 春節前最後交易日、新年開始交易日本身照常交易
+        parts = re.findall(r"\d+", str(row[0]))
+        if len(parts) < 3:
+            continue
+        y = int(parts[0])
+        y = y + 1911 if y < 1911 else y  # 民國年
+        closed.add(f"{y:04d}{int(parts[1]):02d}{int(parts[2]):02d}")
+    return closed or None
+
+
+def ensure_holiday_schedule(years):
+    """日曆裡還沒有的年度，下載休市日期表補進去"""
+    cal = load_trading_calendar()
+    for year in sorted(set(years) - cal["holiday_years"] - _HOLIDAY_TRIED):
+        _HOLIDAY_TRIED.add(year)
+        closed = _fetch_holiday_schedule(year)
+        if closed is None:
+            continue
+        with _CALENDAR_LOCK:
+            cal["closed"] |= closed - cal["trading"]
+            cal["holiday_years"].add(year)
+            _save_trading_calendar(cal)
+        print(f"🗓️ 已載入 {year} 年休市日 {len(closed)} 天")
+
+
+def trading_day_status(date):
+    """True / False：日曆可直接回答；None：需要探測"""
+    cal = load_trading_calendar()
+    if date in cal["trading"]:
+        return True
+    if date in cal["closed"] or datetime.strptime(date, "%Y%m%d").weekday() >= 5:
+        return False
+    return None
+
+
+def _probe_trading_day(date):
+    """
+    用 T86 探測某日是否開市，結果寫回日曆
+    這張表之後 get_daily_top10 也會用到（同一次執行共用快取），所以不算多打；
+    只有資料已定案、且 TWSE 明確回覆查無資料時才記成休市（例如颱風假）。
+    空回應、晚公布、連線失敗都只當作本次沒資料，日曆不記，下次執行再探測
+    """
+    METRICS.count("calendar_probes")
+    try:
+        ok = get_insti_raw("TWSE", date) is not None
+    except Exception as e:
+        print(f"⚠️ TWSE {date} 查詢失敗: {e}")
+        return False
+    closed = (not ok and ("TWSE", date) in _RAW_NO_DATA
+              and _raw_is_final(date, datetime.now(TPE_TZ).isoformat()))
+    if ok or closed:
+        cal = load_trading_calendar()
+        with _CALENDAR_LOCK:
+            cal["trading" if ok else "closed"].add(date)
+            _save_trading_calendar(cal)
+    return ok
+
+
+def find_recent_trading_dates(days=2, lookback=20, end=None):
+    """從 end（YYYYMMDD，預設今天）往前找最近 days 個交易日，新的在前"""
+    end = datetime.strptime(end, '%Y%m%d') if end else NOW_TPE
+    candidates = [(end - timedelta(days=i)).strftime('%Y%m%d') for i in range(lookback)]
+    ensure_holiday_schedule({int(d[:4]) for d in candidates})
     print("🔍 尋找最近的交易日...")
-    for _ in range(lookback):
-        date_str = check_date.strftime('%Y%m%d')
-        df_twse = get_twse_foreign_data(date_str)
-        if df_twse is not None and len(df_twse) > 0:
+    trading_dates = []
+    for date_str in candidates:
+        status = trading_day_status(date_str)
+        if status is None:
+            status = _probe_trading_day(date_str)
+        if status:
             trading_dates.append(date_str)
             print(f"   ✓ {date_str[:4]}-{date_str[4:6]}-{date_str[6:]}")
             if len(trading_dates) >= days:
                 break
-        check_date -= timedelta(days=1)
-        time.sleep(0.2)
     return trading_dates
 
-def get_consecutive_top10(days=2):
+def get_consecutive_top10(days=2, end=None):
     print("=" * 70)
     print("🚀 外資連續買超前10名交集分析")
     print("=" * 70)
-    print(f"📅 {NOW_TPE.strftime('%Y-%m-%d %H:%M')} (Asia/Taipei)\n")
-    trading_dates = find_recent_trading_dates(days=days, lookback=30)
+    if end:
+        print(f"📅 截至 {end[:4]}-{end[4:6]}-{end[6:]}（回補）\n")
+    else:
+        print(f"📅 {NOW_TPE.strftime('%Y-%m-%d %H:%M')} (Asia/Taipei)\n")
+    with METRICS.stage("trading_dates"):
+        trading_dates = find_recent_trading_dates(days=days, lookback=30, end=end)
     if len(trading_dates) < days:
         print(f"❌ 只找到 {len(trading_dates)} 個交易日，需要 {days} 個")
         return None
     print(f"\n📊 分析最近 {days} 個交易日...\n")
+    dates = trading_dates[:days]
     daily_top10_list = []
-    for i, date in enumerate(trading_dates[:days], 1):
+    with METRICS.stage("top10"):
+        nets = run_parallel(get_daily_net, dates)
+    for i, (date, daily_result) in enumerate(zip(dates, nets), 1):
         formatted_date = f"{date[:4]}-{date[4:6]}-{date[6:]}"
         print(f"⏳ 取得第 {i} 天前10名: {formatted_date}")
-        daily_top10 = get_daily_top10(date)
-        if daily_top10 is not None:
+        if daily_result is not None:
+            daily_top10 = _daily_top10(daily_result)
             daily_top10['rank_date'] = formatted_date
             daily_top10_list.append(daily_top10)
             print(f"   ✓ 前10名: {', '.join(daily_top10['stock_name'].head(5).tolist())}...")
         else:
             print(f"   ✗ 無法取得資料")
             return None
-        time.sleep(0.3)
+    with METRICS.stage("intersection"):
+        panel = pd.concat([_panel_rows(d, net) for d, net in zip(dates, nets)], ignore_index=True)
+        save_net_panel(panel)
+        wide = net_panel_wide(panel)
+        rank = topn_rank(panel).iloc[::-1]  # 新的在前，與 day1, day2... 對齊
+        worst = rank.fillna(np.inf).cummax()  # 第 1~i 天中最差的名次
+
     print(f"\n🔍 尋找連續 {days} 天都在前10名的個股...")
-    common_stocks = set(daily_top10_list[0]['stock_id'])
     for i in range(1, days):
-        common_stocks &= set(daily_top10_list[i]['stock_id'])
-        print(f"   第 1-{i+1} 天交集: {len(common_stocks)} 檔")
-    if not common_stocks:
+        print(f"   第 1-{i+1} 天交集: {int((worst.iloc[i] <= 10).sum())} 檔")
+    hits = worst.columns[(worst.iloc[days - 1] <= 10).to_numpy()]
+    if len(hits) == 0:
         print(f"❌ 沒有個股連續 {days} 天都在前10名")
         return pd.DataFrame(), daily_top10_list
-    print(f"\n✅ 找到 {len(common_stocks)} 檔\n")
-    result_list = []
-    for stock_id in common_stocks:
-        stock_name = daily_top10_list[0].loc[
-            daily_top10_list[0]['stock_id'] == stock_id, 'stock_name'].values[0]
-        stock_info = {'stock_id': stock_id, 'stock_name': stock_name}
-        total_net_buy = 0
-        for i, daily_data in enumerate(daily_top10_list, 1):
-            stock_row = daily_data[daily_data['stock_id'] == stock_id]
-            if len(stock_row) > 0:
-                rank = int((daily_data['淨買超_張'] >= stock_row.iloc[0]['淨買超_張']).sum())
-                net_buy = int(stock_row.iloc[0]['淨買超_張'])
-                stock_info[f'day{i}_rank'] = rank
-                stock_info[f'day{i}_net_buy'] = net_buy
-                stock_info[f'day{i}_date'] = daily_data.iloc[0]['rank_date']
-                total_net_buy += net_buy
-        stock_info['total_net_buy'] = int(total_net_buy)
-        stock_info['avg_net_buy'] = float(total_net_buy / days)
-        result_list.append(stock_info)
-    result = pd.DataFrame(result_list).sort_values(
-        'total_net_buy', ascending=False).reset_index(drop=True)
+    print(f"\n✅ 找到 {len(hits)} 檔\n")
+    names = daily_top10_list[0].set_index("stock_id")["stock_name"]
+    net = wide.iloc[::-1][hits]
+    result = pd.DataFrame({'stock_id': hits, 'stock_name': names.reindex(hits).to_numpy()})
+    for i, daily_top10 in enumerate(daily_top10_list, 1):
+        result[f'day{i}_rank'] = rank[hits].iloc[i - 1].astype(int).to_numpy()
+        result[f'day{i}_net_buy'] = net.iloc[i - 1].astype(int).to_numpy()
+        result[f'day{i}_date'] = daily_top10['rank_date'].iloc[0]
+    result['total_net_buy'] = net.sum().astype(int).to_numpy()
+    result['avg_net_buy'] = result['total_net_buy'] / days
+    result = result.sort_values('total_net_buy', ascending=False).reset_index(drop=True)
     return result, daily_top10_list
 
 
+# ════════════════════════════════════════════════════════
+# 外資買賣超面板（dates × stocks）與 K 天連續前 N 名掃描
+# data/panel/net_buy_{yyyymm}.parquet：(date, stock_id, stock_name, net_buy 張, net_shares 股)
+# ════════════════════════════════════════════════════════
+
+NET_PANEL_DIR = Path("data/panel")
+NET_PANEL_COLUMNS = ["date", "stock_id", "stock_name", "net_buy", "net_shares"]
+_NET_PANEL_LOCK = threading.Lock()  # 回補時多個日期並行，同一個月份檔會被同時讀改寫
+
+
+def _panel_rows(date, daily_result):
+    df = pd.DataFrame({
+        "date": date,
+        "stock_id": daily_result["stock_id"].astype(str).str.strip(),
+        "stock_name": daily_result["stock_name"].astype(str).str.strip(),
+        "net_buy": (daily_result["net_shares"] / 1000).round(0).astype(int),
+        "net_shares": daily_result["net_shares"].astype("int64"),
+    })
+    return df.drop_duplicates(["date", "stock_id"], keep="first")
+
+
+def _net_panel_path(month):
+    return NET_PANEL_DIR / f"net_buy_{month}.parquet"
+
+
+def load_net_panel(months) -> pd.DataFrame:
+    """讀取指定月份（yyyymm）的面板，長表格式"""
+    frames = [pd.read_parquet(_net_panel_path(m)) for m in sorted(set(months))
+              if _net_panel_path(m).exists()]
+    if not frames:
+        return pd.DataFrame({c: pd.Series(dtype=int if c.startswith("net_") else str)
+                             for c in NET_PANEL_COLUMNS})
+    return pd.concat(frames, ignore_index=True)
+
+
+def save_net_panel(rows: pd.DataFrame):
+    """把已定案日期的資料併進對應月份的檔案（當天未定案的資料不存）"""
+    now = datetime.now(TPE_TZ).isoformat()
+    final = rows["date"].map(lambda d: _raw_is_final(d, now))
+    rows = rows[final]
+    for month, part in rows.groupby(rows["date"].str[:6]):
+        path = _net_panel_path(month)
+        with _NET_PANEL_LOCK:
+            if path.exists():
+                old = pd.read_parquet(path)
+                if set(part["date"]) <= set(old["date"]):
+                    continue
+                part = pd.concat([old, part], ignore_index=True)
+            part = (part.drop_duplicates(["date", "stock_id"], keep="last")
+                        .sort_values(["date", "stock_id"])
+                        .reset_index(drop=True))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            part.to_parquet(tmp, index=False)
+            os.replace(tmp, path)
+
+
+def ensure_net_panel(start: str, end: str, workers: int = FETCH_WORKERS) -> pd.DataFrame:
+    """回傳 start ~ end 的面板；缺的交易日並行補抓後存檔"""
+    ensure_holiday_schedule(range(int(start[:4]), int(end[:4]) + 1))
+    today = NOW_TPE.strftime("%Y%m%d")
+    dates = [d.strftime("%Y%m%d") for d in pd.date_range(start, min(end, today))]
+    dates = [d for d in dates if trading_day_status(d) is not False]
+    panel = load_net_panel(d[:6] for d in dates)
+    panel = panel[panel["date"].between(start, end)]
+    missing = sorted(set(dates) - set(panel["date"]))
+    if missing:
+        print(f"📥 面板缺 {len(missing)} 天，補抓中...")
+        nets = run_parallel(get_daily_net, missing, max_workers=workers)
+        fresh = [_panel_rows(d, net) for d, net in zip(missing, nets) if net is not None]
+        if fresh:
+            fresh = pd.concat(fresh, ignore_index=True)
+            save_net_panel(fresh)
+            panel = pd.concat([panel, fresh], ignore_index=True)
+    return panel.reset_index(drop=True)
+
+
+def net_panel_wide(panel: pd.DataFrame) -> pd.DataFrame:
+    """長表 → dates（舊到新）× stock_id 的淨買超矩陣，當天沒資料為 NaN"""
+    return panel.pivot(index="date", columns="stock_id", values="net_buy").sort_index()
+
+
+def topn_rank(panel: pd.DataFrame) -> pd.DataFrame:
+    """
+    每天全市場淨買超名次，形狀與 net_panel_wide 相同
+    用原始股數排名，同股數時代號小的名次在前（method="first" 依欄位順序，欄位即代號排序），
+    與 _daily_top10 的前10名完全一致；張數四捨五入後相同的不會一起被擠出前10名
+    """
+    shares = panel.pivot(index="date", columns="stock_id", values="net_shares").sort_index()
+    return shares.rank(axis=1, method="first", ascending=False)
+
+
+def scan_topn(panel: pd.DataFrame, ks, ns) -> pd.DataFrame:
+    """
+    一次算出所有 (K, N) 組合：每個結束日中，連續 K 天都在前 N 名的個股
+    名次只算一次；每個 K 取 K 天內最差名次（rolling max），
+    之後每個 N 只是門檻比較
+    回傳欄位：k, n, date, stock_id, stock_name, worst_rank, total_net_buy, avg_net_buy
+    """
+    wide = net_panel_wide(panel)
+    rank = topn_rank(panel).fillna(np.inf)
+    names = panel.drop_duplicates("stock_id", keep="last").set_index("stock_id")["stock_name"]
+    out = []
+    for k in sorted(set(ks)):
+        worst = rank.rolling(k).max()
+        total = wide.fillna(0).rolling(k).sum()
+        for n in sorted(set(ns)):
+            hit = (worst <= n).to_numpy()
+            di, si = np.nonzero(hit)
+            if len(di) == 0:
+                continue
+            out.append(pd.DataFrame({
+                "k": k, "n": n,
+                "date": wide.index.to_numpy()[di],
+                "stock_id": wide.columns.to_numpy()[si],
+                "worst_rank": worst.to_numpy()[di, si].astype(int),
+                "total_net_buy": total.to_numpy()[di, si].astype(int),
+            }))
+    if not out:
+        return pd.DataFrame(columns=["k", "n", "date", "stock_id", "stock_name",
+                                     "worst_rank", "total_net_buy", "avg_net_buy"])
+    hits = pd.concat(out, ignore_index=True)
+    hits.insert(4, "stock_name", names.reindex(hits["stock_id"]).to_numpy())
+    hits["avg_net_buy"] = hits["total_net_buy"] / hits["k"]
+    return hits
+
+
+def run_topn_scan(start, end, ks, ns, out=None, workers=FETCH_WORKERS):
+    """CLI：掃描區間內所有 (K, N) 組合並印出摘要，out 給定時另存完整命中清單"""
+    # 往前多抓幾天，讓區間第一天也能算滿 K 天
+    lead = (datetime.strptime(start, "%Y%m%d") - timedelta(days=max(ks) * 2 + 10)).strftime("%Y%m%d")
+    panel = ensure_net_panel(lead, end, workers=workers)
+    if panel.empty:
+        print("❌ 區間內沒有資料")
+        return None
+    hits = scan_topn(panel, ks, ns)
+    hits = hits[hits["date"].between(start, end)].reset_index(drop=True)
+    n_days = panel.loc[panel["date"].between(start, end), "date"].nunique()
+    print(f"\n📊 {start} ~ {end}，{n_days} 個交易日")
+    print(f"{'K':>3} {'N':>4} {'命中':>6} {'有命中天數':>10} {'平均每天':>8}")
+    for k in sorted(set(ks)):
+        for n in sorted(set(ns)):
+            sub = hits[(hits["k"] == k) & (hits["n"] == n)]
+            print(f"{k:>3} {n:>4} {len(sub):>6} {sub['date'].nunique():>10} "
+                  f"{len(sub) / max(n_days, 1):>8.2f}")
+    if out:
+        Path(out).parent.mkdir(parents=True, exist_ok=True)
+        hits.to_csv(out, index=False, encoding="utf-8-sig")
+        print(f"[OK] 寫入 {out}")
+    return hits
+
+
 
 # ════════════════════════════════════════════════════════
 # 三大法人買賣超（同時買超篩選）
 # ════════════════════════════════════════════════════════
 
+def _3insti_view(raw, date):
+    df = raw[["stock_id", "stock_name", "foreign_net", "trust_net", "dealer_net"]].copy()
+    # 轉為張（÷1000）
+    for col in ["foreign_net", "trust_net", "dealer_net"]:
+        df[col] = (df[col] / 1000).round(0)
+    df["total_net"] = df["foreign_net"] + df["trust_net"] + df["dealer_net"]
+    df["date"] = date
+    return df
+
+
 def get_3insti_twse(date: str) -> pd.DataFrame:
     """從證交所抓三大法人買賣超（外資、投信、自營商）"""
-    url = "https://www.twse.com.tw/rwd/zh/fund/T86"
-    params = {"date": date, "selectType": "ALL", "response": "json"}
     try:
-        resp = http_get(url, params=params)
-        data = resp.json()
-        if "data" not in data or not data["data"]:
+        raw = get_insti_raw("TWSE", date)
+        if raw is None:
             return pd.DataFrame()
-        df = pd.DataFrame(data["data"], columns=data["fields"])
-        # 取出三大法人欄位
-        cols_need = [
-            "證券代號", "證券名稱",
-            "外陸資買賣超股數(不含外資自營商)",
-            "投信買賣超股數",
-            "自營商買賣超股數",
-        ]
-        df = df[cols_need].copy()
-        df.columns = ["stock_id", "stock_name", "foreign_net", "trust_net", "dealer_net"]
-        for col in ["foreign_net", "trust_net", "dealer_net"]:
-            df[col] = df[col].map(to_number)
-        # 轉為張（÷1000）
-        for col in ["foreign_net", "trust_net", "dealer_net"]:
-            df[col] = (df[col] / 1000).round(0)
-        df["total_net"] = df["foreign_net"] + df["trust_net"] + df["dealer_net"]
-        df["date"] = date
-        return df
+        return _3insti_view(raw, date)
     except Exception as e:
         print(f"⚠️ 三大法人 TWSE {date} 失敗: {e}")
         return pd.DataFrame()
@@ -227,26 +829,11 @@ def get_3insti_twse(date: str) -> pd.DataFrame:
 
 def get_3insti_tpex(date: str) -> pd.DataFrame:
     """從櫃買中心抓三大法人買賣超"""
-    year = int(date[:4]) - 1911
-    date_tw = f"{year}/{date[4:6]}/{date[6:8]}"
-    url = "https://www.tpex.org.tw/web/stock/3insti/daily_trade/3itrade_hedge_result.php"
-    params = {"l": "zh-tw", "d": date_tw, "se": "AL", "response": "json"}
     try:
-        resp = http_get(url, params=params)
-        data = resp.json()
-        if "aaData" not in data or not data["aaData"]:
+        raw = get_insti_raw("TPEx", date)
+        if raw is None:
             return pd.DataFrame()
-        df = pd.DataFrame(data["aaData"])
-        # 欄位：0代號,1名稱,7外資買賣超,10投信買賣超,13自營商買賣超
-        df = df[[0, 1, 9, 12, 15]].copy()
-        df.columns = ["stock_id", "stock_name", "foreign_net", "trust_net", "dealer_net"]
-        for col in ["foreign_net", "trust_net", "dealer_net"]:
-            df[col] = df[col].map(to_number)
-        for col in ["foreign_net", "trust_net", "dealer_net"]:
-            df[col] = (df[col] / 1000).round(0)
-        df["total_net"] = df["foreign_net"] + df["trust_net"] + df["dealer_net"]
-        df["date"] = date
-        return df
+        return _3insti_view(raw, date)
     except Exception as e:
         print(f"⚠️ 三大法人 TPEx {date} 失敗: {e}")
         return pd.DataFrame()
@@ -269,7 +856,7 @@ def get_market_insti_amount(date: str, frames: list = None) -> dict:
 
     # ── 方法一：直接抓 BFI82U（金額表，單位：元）──
     try:
-        resp = requests.get(
+        data = HTTP.get_json(
             "https://www.twse.com.tw/rwd/zh/fund/BFI82U",
             params={"dayDate": date, "type": "day", "response": "json"},
             headers={
@@ -279,8 +866,6 @@ def get_market_insti_amount(date: str, frames: list = None) -> dict:
             },
             timeout=15,
         )
-        resp.raise_for_status()
-        data = resp.json()
         if data.get("stat") != "OK":
             raise ValueError(f"stat={data.get('stat')}")
         rows = data.get("data", [])
@@ -336,14 +921,9 @@ def get_insti_signal(date: str, top_n: int = 10) -> dict:
     回傳 {"buy": [...], "sell": [...], "date": date}
     """
     print(f"  📊 抓取法人資料 {date}...")
-    frames = []
-    df_twse = get_3insti_twse(date)
-    if not df_twse.empty:
-        frames.append(df_twse)
-    time.sleep(0.3)
-    df_tpex = get_3insti_tpex(date)
-    if not df_tpex.empty:
-        frames.append(df_tpex)
+    frames = [df for df in run_parallel(lambda fetch: fetch(date),
+                                        [get_3insti_twse, get_3insti_tpex])
+              if not df.empty]
 
     if not frames:
         return {"buy": [], "sell": [], "date": date}
@@ -357,17 +937,11 @@ def get_insti_signal(date: str, top_n: int = 10) -> dict:
     combined["ft_net"] = combined["foreign_net"] + combined["trust_net"]
 
     def to_records(df):
-        out = []
-        for _, r in df.iterrows():
-            out.append({
-                "stock_id":    r["stock_id"],
-                "stock_name":  r["stock_name"].strip(),
-                "foreign_net": int(r["foreign_net"]),
-                "trust_net":   int(r["trust_net"]),
-                "ft_net":      int(r["ft_net"]),
-                "date":        date,
-            })
-        return out
+        out = df[["stock_id", "stock_name", "foreign_net", "trust_net", "ft_net"]].astype(
+            {"foreign_net": int, "trust_net": int, "ft_net": int})
+        out["stock_name"] = out["stock_name"].str.strip()
+        out["date"] = date
+        return out.to_dict("records")
 
     # 外資 + 投信同時買超（兩者皆 > 0）
     buy_mask  = (combined["foreign_net"] > 0) & (combined["trust_net"] > 0)
@@ -385,47 +959,138 @@ def get_insti_signal(date: str, top_n: int = 10) -> dict:
 def is_etf(ticker):
     return ticker.startswith("00") or ticker.startswith("006")
 
+# ════════════════════════════════════════════════════════
+# 月營收表（data/revenue.parquet）
+# 上市 / 上櫃每月營業收入彙總表整張下載後存成結構化表格，個股查詢都從這裡讀；
+# 營收一個月才更新一次，表裡已有上個月資料時整晚都不需要連 MOPS
+# ════════════════════════════════════════════════════════
+
+REVENUE_TABLE_PATH = Path("data/revenue.parquet")
+REVENUE_SOURCES = {
+    "TWSE": "https://openapi.twse.com.tw/v1/opendata/t187ap05_L",
+    "TPEx": "https://www.tpex.org.tw/openapi/v1/mopsfe_t187ap05_O",
+}
+REVENUE_REFRESH_HOURS = float(os.getenv("REVENUE_REFRESH_HOURS", "12"))
+REVENUE_COLUMNS = ["stock_id", "period", "market", "revenue", "mom", "yoy",
+                   "cum_yoy", "note", "fetched_at"]
+_REVENUE = None
+_REVENUE_REFRESHED = False
+_REVENUE_LOCK = threading.Lock()
+
+
+def _roc_period(value):
+    """'11509' → '2026-09'"""
+    s = str(value).strip()
+    return f"{int(s[:-2]) + 1911}-{s[-2:]}"
+
+
+def _revenue_number(series):
+    return pd.to_numeric(series.astype(str).str.replace(",", "").str.strip(), errors="coerce")
+
+
+def _download_revenue(market):
+    """下載單一市場的月營收彙總表，轉成 REVENUE_COLUMNS"""
+    rows = http_get_json(REVENUE_SOURCES[market])
+    df = pd.DataFrame(rows)
+    if df.empty:
+        return None
+    return pd.DataFrame({
+        "stock_id": df["公司代號"].astype(str).str.strip(),
+        "period": df["資料年月"].map(_roc_period),
+        "market": market,
+        "revenue": _revenue_number(df["營業收入-當月營收"]),
+        "mom": _revenue_number(df["營業收入-上月比較增減(%)"]),
+        "yoy": _revenue_number(df["營業收入-去年同月增減(%)"]),
+        "cum_yoy": _revenue_number(df["累計營業收入-前期比較增減(%)"]),
+        "note": df.get("備註", pd.Series("", index=df.index)).astype(str).str.strip(),
+        "fetched_at": datetime.now(TPE_TZ).isoformat(timespec="seconds"),
+    })
+
+
+def load_revenue_table():
+    """每次執行只讀一次檔"""
+    global _REVENUE
+    if _REVENUE is None:
+        try:
+            _REVENUE = pd.read_parquet(REVENUE_TABLE_PATH)
+        except Exception:
+            _REVENUE = pd.DataFrame(columns=REVENUE_COLUMNS)
+    return _REVENUE
+
+
+def refresh_revenue_table():
+    """
+    重新下載兩個市場的彙總表併進本地表（同一 (代號, 期間) 以新的為準）
+    單一市場下載失敗只略過該市場，它的舊資料照樣保留在表裡
+    """
+    global _REVENUE, _REVENUE_REFRESHED
+    _REVENUE_REFRESHED = True
+
+    def download(market):
+        try:
+            return _download_revenue(market)
+        except Exception as e:
+            print(f"⚠️ {market} 月營收彙總表下載失敗，沿用舊資料: {e}")
+            return None
+
+    frames = [df for df in run_parallel(download, list(REVENUE_SOURCES))
+              if df is not None]
+    if not frames:
+        return load_revenue_table()
+    table = pd.concat([load_revenue_table()] + frames, ignore_index=True)
+    table = (table.drop_duplicates(["stock_id", "period"], keep="last")
+                  .sort_values(["stock_id", "period"])
+                  .reset_index(drop=True))
+    REVENUE_TABLE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    table.to_parquet(REVENUE_TABLE_PATH, index=False)
+    _REVENUE = table
+    print(f"📑 月營收表已更新：{len(table)} 筆，最新期間 {table['period'].max()}")
+    return table
+
+
+def get_revenue(ticker, period):
+    """
+    回傳 ticker 最新一期營收（dict），表裡還沒有 period 這期且上次下載已超過
+    REVENUE_REFRESH_HOURS 時，先重新下載一次（整次執行最多一次）
+    """
+    with _REVENUE_LOCK:
+        table = load_revenue_table()
+        rows = table[table["stock_id"] == ticker]
+        if (rows.empty or rows["period"].max() < period) and not _REVENUE_REFRESHED:
+            last = table["fetched_at"].max() if len(table) else None
+            stale = (last is None or datetime.now(TPE_TZ) - datetime.fromisoformat(last)
+                     >= timedelta(hours=REVENUE_REFRESH_HOURS))
+            if stale:
+                table = refresh_revenue_table()
+                rows = table[table["stock_id"] == ticker]
+    if rows.empty:
+        return None
+    return rows.sort_values("period").iloc[-1].to_dict()
+
+
+def _pct(x):
+    return "—" if pd.isna(x) else f"{x:+.2f}%"
+
+
 def fetch_mops_revenue(ticker):
     if is_etf(ticker):
         return "ETF 無月營收資料（追蹤指數）"
     now = datetime.now()
     year, month = (now.year - 1, 12) if now.month == 1 else (now.year, now.month - 1)
     try:
-        resp = requests.post(
-            "https://mopsov.twse.com.tw/mops/web/t05st10_ifrs",
-            data={"encodeURIComponent": 1, "step": 1, "firstin": 1,
-                  "co_id": ticker, "year": year - 1911, "month": str(month)},
-            timeout=12, headers={"User-Agent": "Mozilla/5.0"}
-        )
-        text = re.sub(r'<[^>]+>', ' ', resp.text)
-        text = re.sub(r'\s+', ' ', text).strip()
-        if len(text) < 100 or "查無資料" in text:
-            return "MOPS 查無資料"
-        results = [f"期間：{year}-{month:02d}"]
-        nums = []
-        for n in re.findall(r'[\d,]{5,}', text):
-            try:
-                val = int(n.replace(',', ''))
-                if 1_000_000 < val < 10_000_000_000:
-                    nums.append(val)
-            except Exception:
-                pass
-        if nums:
-            results.append(f"當月營收：{nums[0]:,} 千元（{nums[0]/1e6:.1f} 億）")
-        pcts = re.findall(r'[-+]?\d+\.?\d*\s*%', text)
-        if pcts:
-            results.append(f"成長率：{pcts[0]}")
-        elif len(nums) >= 3 and nums[2] > 0:
-            yoy = (nums[0] - nums[2]) / nums[2] * 100
-            results.append(f"YoY（估算）：{yoy:+.1f}%")
-        kws = ["庫存調整", "客戶調整", "GB200", "AI伺服器", "液冷", "匯率", "NVL72"]
-        found = [k for k in kws if k in text]
-        if found:
-            results.append(f"備註：{'、'.join(found)}")
-        results.append(f"原始節錄：{text[:400]}")
-        return "\n".join(results)
+        rev = get_revenue(ticker, f"{year}-{month:02d}")
     except Exception as e:
         return f"MOPS 連線失敗：{e}"
+    if rev is None or pd.isna(rev["revenue"]):
+        return "MOPS 查無資料"
+    results = [f"期間：{rev['period']}",
+               f"當月營收：{rev['revenue']:,.0f} 千元（{rev['revenue'] / 1e5:.1f} 億）",
+               f"月增率：{_pct(rev['mom'])}",
+               f"年增率：{_pct(rev['yoy'])}",
+               f"累計年增率：{_pct(rev['cum_yoy'])}"]
+    if rev["note"] and rev["note"] not in {"-", "nan", "None"}:
+        results.append(f"備註：{rev['note']}")
+    return "\n".join(results)
 
 RSS_SOURCES = [
     {"name": "Reuters",    "url": "https://news.google.com/rss/search?q=when:24h+allinurl:reuters.com&ceid=US:en&hl=en-US&gl=US"},
@@ -439,91 +1104,249 @@ RSS_SOURCES = [
     {"name": "中央社國際", "url": "https://feeds.feedburner.com/rsscna/intworld"},
 ]
 
+# ════════════════════════════════════════════════════════
+# 新聞索引：每個 RSS 每次執行只抓一次，所有個股共用
+# data/news_headlines.json 記錄每個來源的標題、首次看到時間與 ETag / Last-Modified，
+# 下次執行用條件式 GET，沒更新（304）就直接用存下來的標題
+# ════════════════════════════════════════════════════════
+
+NEWS_STORE_PATH = Path("data/news_headlines.json")
+NEWS_STALE_HOURS = 24     # 抓取失敗時，多舊以內的已存標題還可以用
+NEWS_INDEX_MAX_KEY = 8    # 索引涵蓋 2~8 字的子字串，更長的關鍵字改用掃描
+_NEWS_INDEX = None
+_NEWS_INDEX_LOCK = threading.Lock()
+
+
+def _parse_titles(text):
+    # 嘗試 CDATA 格式（RSS 2.0）
+    titles = re.findall(r'<title><!\[CDATA\[(.*?)\]\]></title>', text)
+    # 若無 CDATA，嘗試一般格式
+    if not titles:
+        titles = re.findall(r'<title>(.*?)</title>', text)
+    return [re.sub(r'<[^>]+>', '', t).strip() for t in titles[1:30]]  # 跳過 feed 標題
+
+
+def _fetch_feed(source, state):
+    """抓單一 RSS，回傳新的 state：{etag, last_modified, fetched_at, items}"""
+    now = datetime.now(TPE_TZ)
+    headers = {"User-Agent": "Mozilla/5.0"}
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+    try:
+        resp = HTTP.get(source["url"], timeout=8, headers=headers, retries=2)
+        if resp.status_code == 304:
+            METRICS.count("news_not_modified")
+            return {**state, "fetched_at": now.isoformat(timespec="seconds")}
+    except Exception:
+        fetched_at = state.get("fetched_at")
+        if fetched_at and now - datetime.fromisoformat(fetched_at) < timedelta(hours=NEWS_STALE_HOURS):
+            return state
+        return {}
+    first_seen = {it["title"]: it["first_seen"] for it in state.get("items", [])}
+    stamp = now.isoformat(timespec="seconds")
+    return {"etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "fetched_at": stamp,
+            "items": [{"title": t, "first_seen": first_seen.get(t, stamp)}
+                      for t in _parse_titles(resp.text)]}
+
+
+class NewsIndex:
+    """
+    所有來源的標題依來源、原順序排成一列，
+    並把每則標題的 2~NEWS_INDEX_MAX_KEY 字子字串對應到標題位置（倒排索引），
+    查代號 / 名稱 / 名稱前兩字都是一次 dict 查詢
+    """
+
+    def __init__(self, items):
+        self.items = items  # [(來源名稱, 標題)]
+        self.index = {}
+        for pos, (_, title) in enumerate(items):
+            for n in range(2, NEWS_INDEX_MAX_KEY + 1):
+                for i in range(len(title) - n + 1):
+                    self.index.setdefault(title[i:i + n], set()).add(pos)
+
+    def lookup(self, keywords, limit=6):
+        hits = set()
+        for k in keywords:
+            if 2 <= len(k) <= NEWS_INDEX_MAX_KEY:
+                hits |= self.index.get(k, set())
+            else:
+                hits |= {pos for pos, (_, t) in enumerate(self.items) if k in t}
+        results = []
+        for pos in sorted(hits):
+            line = f"[{self.items[pos][0]}] {self.items[pos][1]}"
+            if line not in results:
+                results.append(line)
+        return results[:limit]
+
+
+def build_news_index():
+    """並行抓所有 RSS（可用時走條件式 GET），存回 NEWS_STORE_PATH 並建索引"""
+    try:
+        store = json.loads(NEWS_STORE_PATH.read_text(encoding="utf-8"))
+    except Exception:
+        store = {}
+    states = run_parallel(lambda src: _fetch_feed(src, store.get(src["url"], {})),
+                          RSS_SOURCES)
+    store = {src["url"]: st for src, st in zip(RSS_SOURCES, states) if st}
+    json_io.write_json(NEWS_STORE_PATH, store)
+    items = [(src["name"], it["title"]) for src, st in zip(RSS_SOURCES, states)
+             for it in st.get("items", [])]
+    print(f"📰 新聞索引：{len(store)}/{len(RSS_SOURCES)} 個來源，{len(items)} 則標題")
+    return NewsIndex(items)
+
+
+def get_news_index():
+    """每次執行只建一次"""
+    global _NEWS_INDEX
+    with _NEWS_INDEX_LOCK:
+        if _NEWS_INDEX is None:
+            _NEWS_INDEX = build_news_index()
+        return _NEWS_INDEX
+
+
 def search_news(ticker, name):
-    """掃描多個 RSS 來源，找包含股票關鍵字的新聞"""
-    keywords = [ticker, name, name[:2]]
-    results = []
-    for source in RSS_SOURCES:
-        try:
-            resp = requests.get(source["url"], timeout=8,
-                                headers={"User-Agent": "Mozilla/5.0"})
-            # 嘗試 CDATA 格式（RSS 2.0）
-            titles = re.findall(r'<title><!\[CDATA\[(.*?)\]\]></title>', resp.text)
-            # 若無 CDATA，嘗試一般格式
-            if not titles:
-                titles = re.findall(r'<title>(.*?)</title>', resp.text)
-            for t in titles[1:30]:  # 跳過 feed 標題
-                t = re.sub(r'<[^>]+>', '', t).strip()
-                if any(k in t for k in keywords) and t not in results:
-                    results.append(f"[{source['name']}] {t}")
-        except Exception:
-            pass
-        time.sleep(0.3)
-    return "\n".join(results[:6]) if results else "無近期相關新聞"
+    """在新聞索引中找包含股票關鍵字的標題"""
+    results = get_news_index().lookup([ticker, name, name[:2]])
+    return "\n".join(results) if results else "無近期相關新聞"
+
+# Groq 免費額度以每分鐘請求數計，用 token bucket 取代每檔之間固定 sleep；
+# 同時在飛的 LLM 請求另有上限，多檔股票並行時也不會一次灌爆
+GROQ_RPM = float(os.getenv("GROQ_RPM", "30"))
+GROQ_CONCURRENCY = int(os.getenv("GROQ_CONCURRENCY", "2"))
+GROQ_LIMITER = HostLimiter(GROQ_CONCURRENCY, GROQ_RPM / 60)
+GROQ_RETRIES = 4
+GROQ_URL = "https://api.groq.com"  # 只用來在執行指標裡歸類主機
+AI_WORKERS = int(os.getenv("AI_WORKERS", "4"))
+
+
+def _rate_limit_wait(exc):
+    """429 時回傳伺服器要求的 Retry-After 秒數（沒給則 0）；不是 429 回傳 None"""
+    resp = getattr(exc, "response", None)
+    status = getattr(exc, "status_code", None) or getattr(resp, "status_code", None)
+    if status != 429:
+        return None
+    return retry_after_seconds(getattr(resp, "headers", None)) or 0.0
+
 
-def call_groq(client, prompt):
-    for attempt in range(3):
+def call_groq(client, prompt, label="", array=False, max_tokens=600):
+    """
+    回傳模型輸出中的 JSON 字串（array=True 時取 [...]，否則取 {...}）；全部失敗回傳空字串
+    連線 / API 錯誤用完重試會記入 Groq 的熔斷計數，熔斷後其餘股票直接走 fallback
+    """
+    api_error = False
+    for attempt in range(GROQ_RETRIES):
         try:
-            resp = client.chat.completions.create(
-                model="qwen/qwen3-32b",
-                messages=[
-                    {"role": "system", "content": "你是台灣股票分析師。只輸出純 JSON，繁體中文，不要有任何其他文字。"},
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=0.3,
-                max_tokens=600,
-            )
+            HTTP.breaker.check(GROQ_URL)
+        except CircuitOpenError:
+            return ""
+        try:
+            with GROQ_LIMITER.slot():
+                t0 = time.perf_counter()
+                try:
+                    resp = client.chat.completions.create(
+                        model="qwen/qwen3-32b",
+                        messages=[
+                            {"role": "system", "content": "你是台灣股票分析師。只輸出純 JSON，繁體中文，不要有任何其他文字。"},
+                            {"role": "user", "content": prompt},
+                        ],
+                        temperature=0.3,
+                        max_tokens=max_tokens,
+                    )
+                except Exception:
+                    METRICS.record_request(GROQ_URL, time.perf_counter() - t0, ok=False)
+                    raise
             raw = resp.choices[0].message.content.strip()
+            METRICS.record_request(GROQ_URL, time.perf_counter() - t0,
+                                   len(raw.encode("utf-8")))
+            HTTP.breaker.success(GROQ_URL)
+            api_error = False
             raw = re.sub(r'<think>.*?</think>', '', raw, flags=re.DOTALL).strip()
             raw = re.sub(r'^```(?:json)?\s*', '', raw)
             raw = re.sub(r'\s*```$', '', raw).strip()
-            start, end = raw.find("{"), raw.rfind("}") + 1
+            opening, closing = ("[", "]") if array else ("{", "}")
+            start, end = raw.find(opening), raw.rfind(closing) + 1
             if start == -1 or end == 0:
                 raise ValueError(f"找不到 JSON：{raw[:100]}")
             return raw[start:end]
         except Exception as e:
-            print(f"    ⚠️ 第{attempt+1}次失敗：{e}")
-            if attempt < 2:
-                time.sleep(5)
+            print(f"    ⚠️ {label}第{attempt+1}次失敗：{e}")
+            api_error = not isinstance(e, ValueError)  # ValueError 是模型輸出格式問題，主機沒掛
+            if attempt < GROQ_RETRIES - 1:
+                METRICS.record_retry(GROQ_URL)
+                wait = backoff_delay(attempt)
+                retry_after = _rate_limit_wait(e)
+                if retry_after is not None:  # 被限流：至少等到伺服器要求的時間
+                    wait = max(wait, retry_after)
+                time.sleep(wait)
+    if api_error and HTTP.breaker.failure(GROQ_URL):
+        METRICS.count("circuit_open")
     return ""
 
-def ai_analyze_one(ticker, name, net_buy):
-    groq_key = os.environ.get("GROQ_API_KEY", "")
-    if not groq_key:
-        return {"ticker": ticker, "name": name, "verdict": "謹慎觀察",
-                "confidence": "低", "reasons": ["未設定 GROQ_API_KEY"],
-                "warning": None, "next_check": "設定 API Key",
-                "data_quality": "不足", "net_buy_lots": net_buy}
+# ════════════════════════════════════════════════════════
+# AI 判斷快取（data/ai_cache.json）
+# 同一檔股票的營收、新聞標題、prompt 版本都沒變時，沿用上次的判斷不再呼叫 LLM
+# ════════════════════════════════════════════════════════
 
-    client = Groq(api_key=groq_key)
-    etf = is_etf(ticker)
+AI_CACHE_PATH = Path("data/ai_cache.json")
+AI_CACHE_TTL_DAYS = float(os.getenv("AI_CACHE_TTL_DAYS", "3"))
+AI_PROMPT_VERSION = "1"  # 修改 prompt（AI_RULES 等）或模型時要遞增，舊快取才會失效
+_AI_CACHE = None
+_AI_CACHE_LOCK = threading.Lock()
 
-    if etf:
-        print(f"    📦 ETF，搜尋新聞...")
-        earnings = "此為 ETF，追蹤指數，無月營收。"
-    else:
-        print(f"    🌐 抓取 MOPS 月營收...")
-        earnings = fetch_mops_revenue(ticker)
 
-    print(f"    📰 搜尋近期新聞...")
-    news = search_news(ticker, name)
-    time.sleep(1)
+def _digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
 
-    etf_note = ("ETF，不適用財報分析，根據新聞判斷追蹤標的走勢。"
-                if etf else "一般股票，根據月營收和新聞判斷基本面。")
 
-    prompt = f"""外資連續兩天買超：{ticker} {name}（{'ETF' if etf else '股票'}）
-合計買超：{net_buy:,} 張
-{etf_note}
+def ai_cache_key(ticker, earnings, news):
+    """(代號, 營收期間與數字, 新聞標題 hash, prompt 版本)"""
+    revenue = "\n".join(line for line in earnings.splitlines()
+                        if not line.startswith("原始節錄"))
+    titles = "\n".join(sorted(news.splitlines()))
+    return f"{ticker}|{_digest(revenue)}|{_digest(titles)}|v{AI_PROMPT_VERSION}"
 
-【月營收】
-{earnings[:500]}
 
-【近期新聞】
-{news}
+def _load_ai_cache():
+    global _AI_CACHE
+    if _AI_CACHE is None:
+        try:
+            _AI_CACHE = json.loads(AI_CACHE_PATH.read_text(encoding="utf-8"))
+        except Exception:
+            _AI_CACHE = {}
+    return _AI_CACHE
 
-只輸出純 JSON：
-{{
+
+def ai_cache_get(key):
+    """未過期的快取判斷；沒有或已過期回傳 None"""
+    with _AI_CACHE_LOCK:
+        hit = _load_ai_cache().get(key)
+    age = datetime.now(TPE_TZ) - datetime.fromisoformat(hit["cached_at"]) if hit else None
+    if not hit or age >= timedelta(days=AI_CACHE_TTL_DAYS):
+        METRICS.count("ai_cache_misses")
+        return None
+    METRICS.count("ai_cache_hits")
+    return hit["result"]
+
+
+def ai_cache_put(key, result):
+    """寫入一筆判斷，順便清掉過期的項目"""
+    now = datetime.now(TPE_TZ)
+    cutoff = (now - timedelta(days=AI_CACHE_TTL_DAYS)).isoformat(timespec="seconds")
+    with _AI_CACHE_LOCK:
+        cache = _load_ai_cache()
+        cache[key] = {"cached_at": now.isoformat(timespec="seconds"), "result": result}
+        for k in [k for k, v in cache.items() if v["cached_at"] < cutoff]:
+            del cache[k]
+        json_io.write_json(AI_CACHE_PATH, cache)
+
+
+AI_BATCH_SIZE = int(os.getenv("AI_BATCH_SIZE", "5"))  # 1 = 每檔各自一個請求
+
+AI_VERDICT_SCHEMA = """{{
   "ticker": "{ticker}",
   "name": "{name}",
   "verdict": "建議買進 或 可以買進 或 謹慎觀察 或 不建議",
@@ -532,9 +1355,9 @@ def ai_analyze_one(ticker, name, net_buy):
   "warning": "最大風險（50字內）或null",
   "next_check": "下次確認時間點（10字內）",
   "data_quality": "充足 或 有限 或 不足"
-}}
+}}"""
 
-【reasons 嚴格規則】
+AI_RULES = """【reasons 嚴格規則】
 - 絕對禁止說「外資連2日買超」「外資連續買超」「外資大買」「外資持續買超」任何外資買超相關語句
   因為這個列表裡每支股票都符合這個條件，說了等於廢話
 - 必須根據月營收數字、新聞內容、產業趨勢說具體理由
@@ -545,25 +1368,153 @@ def ai_analyze_one(ticker, name, net_buy):
 ETF → 根據追蹤標的走勢、近期殖利率水準、大盤環境判斷
 股票 → 財報年增顯著 + 新聞正面 → 建議買進；資料不足 → 謹慎觀察
 confidence：資料充足且理由明確→高；有部分資料→中；資料不足→低
+"""
+
+AI_VERDICT_KEYS = {"verdict", "confidence", "reasons"}
+
 
+def _ai_fallback(inp, reason, warning, etf=True):
+    result = {"ticker": inp["ticker"], "name": inp["name"], "verdict": "謹慎觀察",
+              "confidence": "低", "reasons": [reason],
+              "warning": warning, "next_check": "手動確認",
+              "data_quality": "不足", "net_buy_lots": inp["net_buy"]}
+    if etf:
+        result["is_etf"] = inp["etf"]
+    return result
+
+
+def ai_gather_inputs(ticker, name, net_buy):
+    """抓 MOPS 月營收、查新聞索引，並算出快取 key"""
+    etf = is_etf(ticker)
+    if etf:
+        print(f"    [{ticker}] 📦 ETF，搜尋新聞...")
+        earnings = "此為 ETF，追蹤指數，無月營收。"
+    else:
+        print(f"    [{ticker}] 🌐 抓取 MOPS 月營收...")
+        earnings = fetch_mops_revenue(ticker)
+    print(f"    [{ticker}] 📰 搜尋近期新聞...")
+    news = search_news(ticker, name)
+    return {"ticker": ticker, "name": name, "net_buy": net_buy, "etf": etf,
+            "earnings": earnings, "news": news,
+            "cache_key": ai_cache_key(ticker, earnings, news)}
+
+
+def _stock_section(inp):
+    etf = inp["etf"]
+    etf_note = ("ETF，不適用財報分析，根據新聞判斷追蹤標的走勢。"
+                if etf else "一般股票，根據月營收和新聞判斷基本面。")
+    return f"""外資連續兩天買超：{inp['ticker']} {inp['name']}（{'ETF' if etf else '股票'}）
+合計買超：{inp['net_buy']:,} 張
+{etf_note}
+
+【月營收】
+{inp['earnings'][:500]}
+
+【近期新聞】
+{inp['news']}
+"""
+
+
+def _single_prompt(inp):
+    schema = AI_VERDICT_SCHEMA.format(ticker=inp["ticker"], name=inp["name"])
+    return f"""{_stock_section(inp)}
+只輸出純 JSON：
+{schema}
+
+{AI_RULES}
+"""
+
+
+def _batch_prompt(inps):
+    """共用的規則只送一次，各檔的營收 / 新聞依序列出，要求回傳 JSON 陣列"""
+    sections = "\n".join(f"=== 第 {i} 檔 ===\n{_stock_section(inp)}"
+                         for i, inp in enumerate(inps, 1))
+    schema = AI_VERDICT_SCHEMA.format(ticker="代號", name="名稱")
+    return f"""以下共 {len(inps)} 檔股票，請逐檔獨立判斷。
+
+{sections}
+只輸出純 JSON 陣列，每檔一個物件、順序與上面相同，共 {len(inps)} 個：
+[
+{schema},
+...
+]
+
+{AI_RULES}
 """
 
-    raw_json = call_groq(client, prompt)
+
+def _ai_cached(inp):
+    """營收與新聞都沒變時沿用快取的判斷，沒有快取回傳 None"""
+    cached = ai_cache_get(inp["cache_key"])
+    if not cached:
+        return None
+    print(f"    [{inp['ticker']}] ♻️ 營收與新聞都沒變，沿用快取的 AI 判斷")
+    return {**cached, "net_buy_lots": inp["net_buy"], "is_etf": inp["etf"]}
+
+
+def _finish_verdict(inp, result):
+    ai_cache_put(inp["cache_key"], result)
+    return {**result, "net_buy_lots": inp["net_buy"], "is_etf": inp["etf"]}
+
+
+def ai_analyze_inputs(inp):
+    """單檔一個請求（批次解析失敗時的退路）"""
+    groq_key = os.environ.get("GROQ_API_KEY", "")
+    client = Groq(api_key=groq_key)
+    raw_json = call_groq(client, _single_prompt(inp), label=f"[{inp['ticker']}] ")
     if not raw_json:
-        return {"ticker": ticker, "name": name, "verdict": "謹慎觀察",
-                "confidence": "低", "reasons": ["AI 回傳解析失敗"],
-                "warning": "請手動查閱", "next_check": "手動確認",
-                "data_quality": "不足", "net_buy_lots": net_buy, "is_etf": etf}
+        return _ai_fallback(inp, "AI 回傳解析失敗", "請手動查閱")
     try:
         result = json.loads(raw_json)
     except Exception as e:
+        return _ai_fallback(inp, "JSON 解析失敗", str(e)[:40])
+    return _finish_verdict(inp, result)
+
+
+def ai_analyze_batch(inps):
+    """
+    多檔合併成一個請求，回傳的 JSON 陣列依代號拆回各檔；
+    整批解析失敗、或某檔缺漏 / 格式不對的，改用單檔請求重問
+    """
+    if len(inps) == 1:
+        return [ai_analyze_inputs(inps[0])]
+    client = Groq(api_key=os.environ.get("GROQ_API_KEY", ""))
+    tickers = "、".join(inp["ticker"] for inp in inps)
+    raw_json = call_groq(client, _batch_prompt(inps), label=f"[批次 {tickers}] ",
+                         array=True, max_tokens=600 * len(inps))
+    try:
+        items = json.loads(raw_json) if raw_json else []
+    except Exception as e:
+        print(f"    ⚠️ [批次 {tickers}] JSON 解析失敗，改逐檔分析：{e}")
+        items = []
+    by_ticker = {str(it.get("ticker", "")).strip(): it for it in items
+                 if isinstance(it, dict) and AI_VERDICT_KEYS <= it.keys()}
+    out = []
+    for inp in inps:
+        result = by_ticker.get(inp["ticker"])
+        out.append(_finish_verdict(inp, result) if result else ai_analyze_inputs(inp))
+    return out
+
+
+def ai_analyze_one(ticker, name, net_buy):
+    groq_key = os.environ.get("GROQ_API_KEY", "")
+    if not groq_key:
         return {"ticker": ticker, "name": name, "verdict": "謹慎觀察",
-                "confidence": "低", "reasons": ["JSON 解析失敗"],
-                "warning": str(e)[:40], "next_check": "手動確認",
-                "data_quality": "不足", "net_buy_lots": net_buy, "is_etf": etf}
-    result["net_buy_lots"] = net_buy
-    result["is_etf"] = etf
-    return result
+                "confidence": "低", "reasons": ["未設定 GROQ_API_KEY"],
+                "warning": None, "next_check": "設定 API Key",
+                "data_quality": "不足", "net_buy_lots": net_buy}
+    inp = ai_gather_inputs(ticker, name, net_buy)
+    return _ai_cached(inp) or ai_analyze_batch([inp])[0]
+
+def _print_verdict(result):
+    icon = {"建議買進": "✅", "謹慎觀察": "⚠️", "不建議": "❌"}.get(
+        result.get("verdict", ""), "❓")
+    lines = [f"\n  📊 {result.get('ticker')} {result.get('name')}"
+             f"（買超 {result.get('net_buy_lots', 0):,} 張）",
+             f"    {icon} {result.get('verdict')} "
+             f"（信心：{result.get('confidence')}，資料：{result.get('data_quality')}）"]
+    lines += [f"       · {r}" for r in result.get("reasons", [])]
+    print("\n".join(lines))
 
 def run_ai_cross_check(result_df):
     if result_df is None or len(result_df) == 0:
@@ -571,44 +1522,128 @@ def run_ai_cross_check(result_df):
     print("\n" + "=" * 55)
     print("🤖 AI 交叉確認（MOPS + Google News）")
     print("=" * 55)
-    analyses = []
-    for _, row in result_df.iterrows():
-        ticker = str(row["stock_id"])
-        name = str(row["stock_name"])
-        net_buy = int(row.get("total_net_buy", 0))
-        print(f"\n  📊 {ticker} {name}（買超 {net_buy:,} 張）")
-        result = ai_analyze_one(ticker, name, net_buy)
-        icon = {"建議買進": "✅", "謹慎觀察": "⚠️", "不建議": "❌"}.get(
-            result.get("verdict", ""), "❓")
-        print(f"    {icon} {result.get('verdict')} "
-              f"（信心：{result.get('confidence')}，資料：{result.get('data_quality')}）")
-        for r in result.get("reasons", []):
-            print(f"       · {r}")
-        analyses.append(result)
-        time.sleep(3)
+    items = [(str(r["stock_id"]), str(r["stock_name"]), int(r.get("total_net_buy", 0)))
+             for r in result_df.to_dict("records")]
+    if not os.environ.get("GROQ_API_KEY", ""):
+        analyses = [ai_analyze_one(*item) for item in items]
+        for result in analyses:
+            _print_verdict(result)
+        print(f"\n✅ AI 分析完成，共 {len(analyses)} 檔")
+        return analyses
+    get_news_index()  # 先把所有 RSS 抓好，個股之間共用
+
+    def gather(item):
+        try:
+            return ai_gather_inputs(*item)
+        except Exception as e:
+            ticker, name, net_buy = item
+            return {"ticker": ticker, "name": name, "net_buy": net_buy, "error": e}
+
+    # 1) 各檔 MOPS / 新聞並行抓；沒變的直接用快取
+    inputs = run_parallel(gather, items, max_workers=AI_WORKERS)
+    analyses = [None] * len(inputs)
+    pending = []
+    for i, inp in enumerate(inputs):
+        if "error" in inp:
+            analyses[i] = _ai_fallback(inp, "AI 分析失敗", str(inp["error"])[:40], etf=False)
+            continue
+        analyses[i] = _ai_cached(inp)
+        if analyses[i] is None:
+            pending.append(i)
+
+    # 2) 其餘的每 AI_BATCH_SIZE 檔合成一個 LLM 請求，各批並行；
+    #    LLM 由 GROQ_LIMITER 控制並行數與速率，單批失敗不影響其他批
+    size = max(AI_BATCH_SIZE, 1)
+    batches = [pending[j:j + size] for j in range(0, len(pending), size)]
+
+    def analyze(batch):
+        try:
+            return ai_analyze_batch([inputs[i] for i in batch])
+        except Exception as e:
+            return [_ai_fallback(inputs[i], "AI 分析失敗", str(e)[:40]) for i in batch]
+
+    for batch, results in zip(batches, run_parallel(analyze, batches, max_workers=AI_WORKERS)):
+        for i, result in zip(batch, results):
+            analyses[i] = result
+    for result in analyses:
+        _print_verdict(result)
     print(f"\n✅ AI 分析完成，共 {len(analyses)} 檔")
     return analyses
 
-def write_json_payload(result_df, daily_top10_list, ai_analyses=None, three_insti=None, market_insti=None, watchlist=None):
+# ════════════════════════════════════════════════════════
+# 前端分片（data/latest/）
+# latest.json 依儀表板區塊拆成壓縮過的小檔，檔名帶內容 hash，內容沒變檔名就不變，
+# 前端與 service worker 可以永久快取；manifest.json 記錄每個區塊目前對應的檔案
+# 另外預先產生 .gz（有裝 brotli 時再加 .br），給支援靜態壓縮檔的主機直接送
+# ════════════════════════════════════════════════════════
+
+LATEST_SHARD_DIR = Path("data/latest")
+LATEST_MANIFEST = LATEST_SHARD_DIR / "manifest.json"
+LATEST_SHARDS = {
+    "main": ["mode", "timezone", "params", "trading_dates", "count_intersection", "stocks"],
+    "ai": ["ai_analysis", "ai_analysis_time"],
+    "insti": ["insti_signal", "insti_signal_date", "market_insti"],
+    "watch": ["watchlist_summary"],
+}  # generated_at_utc 放在 manifest，否則每次重跑所有分片 hash 都會變
+
+
+def write_latest_shards(payload: dict, names=None):
+    """
+    寫 names（預設全部）區塊的分片並更新 manifest，其他區塊沿用上一版 manifest；
+    只保留這次與上一版 manifest 用到的分片（剛載入舊 manifest 的頁面還拿得到）
+    """
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    try:
+        previous = json_io.loads(LATEST_MANIFEST.read_bytes())
+    except Exception:
+        previous = {}
+    old_shards = previous.get("shards", {})
+
+    shards = dict(old_shards)
+    for name in names or LATEST_SHARDS:
+        raw = json_io.dumps({k: payload.get(k) for k in LATEST_SHARDS[name]})
+        path = LATEST_SHARD_DIR / f"{name}.{hashlib.sha1(raw).hexdigest()[:16]}.json"
+        if not path.exists():  # 檔名帶 hash：已存在就是同一份內容
+            json_io.write_bytes_atomic(path, raw)
+            json_io.write_bytes_atomic(f"{path}.gz", gzip.compress(raw, compresslevel=9, mtime=0))
+            if brotli:
+                json_io.write_bytes_atomic(f"{path}.br", brotli.compress(raw, quality=11))
+        shards[name] = {"file": path.name, "bytes": len(raw),
+                        "gzip_bytes": Path(f"{path}.gz").stat().st_size}
+
+    keep = {s["file"] for s in shards.values()} | {s.get("file") for s in old_shards.values()}
+    for f in LATEST_SHARD_DIR.glob("*.json*"):
+        if f != LATEST_MANIFEST and f.name.split(".json")[0] + ".json" not in keep:
+            f.unlink()
+    json_io.write_json(LATEST_MANIFEST, {
+        "generated_at_utc": payload.get("generated_at_utc") or previous.get("generated_at_utc"),
+        "shards": shards,
+    }, pretty=False)
+    total = sum(s["bytes"] for s in shards.values())
+    print(f"[OK] 寫入 {LATEST_SHARD_DIR}/（{len(shards)} 個分片，{total:,} bytes）")
+
+def write_json_payload(result_df, daily_top10_list, ai_analyses=None, three_insti=None, market_insti=None, watchlist=None, write_latest=True):
     trading_dates = [d.iloc[0]['rank_date'] for d in daily_top10_list]
     stocks = []
-    for _, r in result_df.iterrows():
-        item = {
-            "stock_id": r["stock_id"],
-            "stock_name": r["stock_name"],
-            "total_net_buy": int(r["total_net_buy"]),
-            "avg_net_buy": float(r["avg_net_buy"]),
-            "per_day": {}
-        }
-        i = 1
-        while f"day{i}_date" in r:
-            item["per_day"][f"day{i}"] = {
-                "date": r[f"day{i}_date"],
-                "rank": int(r[f"day{i}_rank"]),
-                "net_buy_lots": int(r[f"day{i}_net_buy"])
-            }
-            i += 1
-        stocks.append(item)
+    if len(result_df) > 0:
+        stocks = result_df[["stock_id", "stock_name", "total_net_buy", "avg_net_buy"]].astype(
+            {"total_net_buy": int, "avg_net_buy": float}).to_dict("records")
+        n_days = 0
+        while f"day{n_days + 1}_date" in result_df.columns:
+            n_days += 1
+        # 每天一張 (date, rank, net_buy_lots) 表，整欄轉型後再逐筆組回 per_day
+        per_day = [
+            result_df[[f"day{i}_date", f"day{i}_rank", f"day{i}_net_buy"]]
+            .set_axis(["date", "rank", "net_buy_lots"], axis=1)
+            .astype({"rank": int, "net_buy_lots": int})
+            .to_dict("records")
+            for i in range(1, n_days + 1)
+        ]
+        for j, item in enumerate(stocks):
+            item["per_day"] = {f"day{i}": per_day[i - 1][j] for i in range(1, n_days + 1)}
     payload = {
         "mode": "intersection_top10_per_day",
         "generated_at_utc": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
@@ -622,205 +1657,386 @@ def write_json_payload(result_df, daily_top10_list, ai_analyses=None, three_inst
         "insti_signal": three_insti or {},
         "insti_signal_date": trading_dates[0] if trading_dates else "",
         "market_insti": market_insti or {},
-        "watchlist_summary": _build_watchlist_summary(watchlist or []),
     }
-    OUT_LATEST.parent.mkdir(parents=True, exist_ok=True)
-    OUT_LATEST.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-    print(f"[OK] 寫入 {OUT_LATEST}")
+    if write_latest:
+        payload["run_metrics"] = METRICS.snapshot()
+    # 放在最後一個 key：無交易日時 json_io.patch_last_key 只需改寫這一段
+    payload["watchlist_summary"] = _build_watchlist_summary(watchlist)
     last_trade = trading_dates[0].replace('-', '')
     out_history = OUT_HISTORY_DIR / f"{last_trade}.json"
-    out_history.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-    print(f"[OK] 寫入 {out_history}")
+    targets = [OUT_LATEST, out_history] if write_latest else [out_history]
+    data = json_io.write_json(targets, payload)  # 只編碼一次，兩個檔案內容相同
+    for path in targets:
+        print(f"[OK] 寫入 {path}")
+    if write_latest:
+        write_latest_shards(payload)
+    try:
+        index_history_payload(last_trade, payload, data)
+    except Exception as e:
+        print(f"⚠️ history 索引更新失敗（可用 python history_index.py sync 補）: {e}")
+
+
+# ════════════════════════════════════════════════════════
+# 歷史回補（指定日期區間，多日並行）
+# ════════════════════════════════════════════════════════
+
+# 並行回補會同時寫到的共用檔案：面板（_NET_PANEL_LOCK）、原始快取（每個檔原子寫入，
+# 同一張表由 get_insti_raw 的鎖保證只抓一次）、交易日曆 / 代號目錄 / history 索引（各自的鎖 + 原子寫入）
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "4"))
+
+
+def backfill_one(date: str, days: int = 2, force: bool = False) -> str:
+    """
+    重算單日的交集 / 法人訊號 / 大盤金額，寫 data/history/{date}.json
+    （不含 AI 分析與追蹤清單；不動 latest.json）
+    回傳 "ok" / "skip" / "holiday" / "fail"；例外也記成 "fail"，不影響其他日期
+    """
+    out_history = OUT_HISTORY_DIR / f"{date}.json"
+    if out_history.exists() and not force:
+        return "skip"
+    try:
+        return _backfill_one(date, days)
+    except Exception as e:
+        print(f"  ⚠️ {date} 回補發生錯誤: {e}")
+        return "fail"
+
+
+def _backfill_one(date, days):
+    result_data = get_consecutive_top10(days=days, end=date)
+    if result_data is None:
+        return "fail"
+    result, daily_top10_list = result_data
+    if daily_top10_list[0].iloc[0]["rank_date"].replace("-", "") != date:
+        return "holiday"  # 找到的最近交易日不是這天
+    three_insti = get_insti_signal(date, top_n=10)
+    frames = three_insti.pop("_frames", [])
+    market_insti = get_market_insti_amount(date, frames)
+    write_json_payload(result, daily_top10_list, three_insti=three_insti,
+                       market_insti=market_insti, write_latest=False)
+    return "ok"
+
+
+def backfill_history(start: str, end: str, days: int = 2,
+                     workers: int = BACKFILL_WORKERS, force: bool = False) -> dict:
+    """回補 start ~ end（YYYYMMDD，含頭尾）每個交易日；已存在的檔案預設跳過"""
+    ensure_holiday_schedule(range(int(start[:4]), int(end[:4]) + 1))
+    dates = [d.strftime("%Y%m%d") for d in pd.date_range(start, end)]
+    dates = [d for d in dates if trading_day_status(d) is not False]
+    pending = [d for d in dates
+               if force or not (OUT_HISTORY_DIR / f"{d}.json").exists()]
+    print(f"🗂️ 回補 {start} ~ {end}：可能的交易日 {len(dates)} 天，待處理 {len(pending)} 天"
+          f"（{workers} 個 worker）")
+    statuses = run_parallel(lambda d: backfill_one(d, days=days, force=force),
+                            pending, max_workers=workers)
+    counts = {}
+    for date, status in zip(pending, statuses):
+        counts[status] = counts.get(status, 0) + 1
+        if status == "fail":
+            print(f"  ⚠️ {date} 回補失敗")
+    print(f"✅ 回補完成：{counts}")
+    return counts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="外資連續買超前10名交集分析")
+    sub = parser.add_subparsers(dest="cmd")
+    p_bf = sub.add_parser("backfill", help="回補指定日期區間的 data/history/{date}.json")
+    p_bf.add_argument("start", help="起始日 YYYYMMDD")
+    p_bf.add_argument("end", nargs="?", default=NOW_TPE.strftime("%Y%m%d"),
+                      help="結束日 YYYYMMDD（預設今天）")
+    p_bf.add_argument("--workers", type=int, default=BACKFILL_WORKERS,
+                      help=f"同時處理的日期數（預設 {BACKFILL_WORKERS}）")
+    p_bf.add_argument("--force", action="store_true", help="已存在的檔案也重算")
+    p_sc = sub.add_parser("scan", help="掃描區間內各種「連續 K 天前 N 名」組合")
+    p_sc.add_argument("start", help="起始日 YYYYMMDD")
+    p_sc.add_argument("end", nargs="?", default=NOW_TPE.strftime("%Y%m%d"),
+                      help="結束日 YYYYMMDD（預設今天）")
+    p_sc.add_argument("--k", default="2,3,5", help="連續天數，逗號分隔（預設 2,3,5）")
+    p_sc.add_argument("--n", default="10,20,30", help="前 N 名，逗號分隔（預設 10,20,30）")
+    p_sc.add_argument("--out", help="完整命中清單 CSV 路徑")
+    p_sc.add_argument("--workers", type=int, default=FETCH_WORKERS,
+                      help=f"補抓面板時同時處理的日期數（預設 {FETCH_WORKERS}）")
+    return parser.parse_args(argv)
 
 
 # ════════════════════════════════════════════════════════
 # 進榜股票追蹤（10天漲跌幅監控）
 # ════════════════════════════════════════════════════════
 
-OUT_WATCHLIST = Path("data/watchlist.json")
+# 儲存格式（快照 + append-only journal）見 watchlist_store.py
 TRACK_DAYS = 10  # 追蹤天數
 
 
-def get_close_price(ticker: str) -> float | None:
-    """抓當日收盤價，優先用 yfinance，fallback 用 TWSE"""
-    # ── 方法一：yfinance（GH Actions 環境最穩）──
+YF_BATCH_SIZE = 100  # 每次 yf.download 的代號數
+
+
+def _valid_price(x):
     try:
-        import yfinance as yf
-        # 先試 .TW（上市），失敗再試 .TWO（上櫃）
-        for suffix in [".TW", ".TWO"]:
-            try:
-                t = yf.Ticker(ticker + suffix)
-                hist = t.history(period="5d")
-                if not hist.empty:
-                    raw = float(hist["Close"].iloc[-1])
-                    if not math.isnan(raw) and raw > 0:
-                        price = round(raw, 2)
-                        print(f"    [yfinance] {ticker}{suffix}: {price}")
-                        return price
-            except Exception:
-                continue
-    except Exception as e:
-        print(f"    [yfinance] {ticker} 失敗：{e}")
+        price = float(str(x).replace(",", ""))
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(price) or price <= 0:
+        return None
+    return round(price, 2)
+
 
-    # ── 方法二：TWSE STOCK_DAY（當月資料）──
+def _yf_batch_close(symbols: list) -> dict:
+    """一次 yf.download 多檔，回傳 {symbol: 最後一筆收盤價}"""
+    import yfinance as yf
+    yf_url = "https://query1.finance.yahoo.com"
+    HTTP.breaker.check(yf_url)  # yfinance 自帶 session，只共用熔斷狀態
+    with host_limiter(yf_url).slot():
+        t0 = time.perf_counter()
+        try:
+            hist = yf.download(symbols, period="5d", group_by="ticker",
+                               auto_adjust=False, progress=False, threads=True)
+        except Exception:
+            METRICS.record_request(yf_url, time.perf_counter() - t0, ok=False)
+            if HTTP.breaker.failure(yf_url):
+                METRICS.count("circuit_open")
+            raise
+    METRICS.record_request(yf_url, time.perf_counter() - t0)
+    HTTP.breaker.success(yf_url)
+    out = {}
+    if hist is None or hist.empty:
+        return out
+    for sym in symbols:
+        try:
+            # group_by="ticker" 時新版 yfinance 連單檔都是 (ticker, 欄位) 兩層欄位
+            closes = (hist[sym]["Close"] if isinstance(hist.columns, pd.MultiIndex)
+                      else hist["Close"]).dropna()
+        except KeyError:
+            continue
+        if not closes.empty:
+            price = _valid_price(closes.iloc[-1])
+            if price:
+                out[sym] = price
+    return out
+
+
+def _find_table(data: dict, *need):
+    """在 TWSE / TPEx 回應中找出包含指定欄位的表，回傳 (fields, rows)"""
+    tables = list(data.get("tables") or [])
+    for k in data:  # 舊版格式：fields9 / data9
+        if k.startswith("fields"):
+            tables.append({"fields": data[k], "data": data.get("data" + k[6:], [])})
+    for t in tables:
+        fields = t.get("fields") or []
+        if all(n in fields for n in need):
+            return fields, t.get("data") or []
+    return None, []
+
+
+def get_twse_close_table(date: str) -> dict:
+    """證交所 MI_INDEX：全市場（上市）每日收盤價 {stock_id: close}"""
     try:
-        yyyymm = NOW_TPE.strftime("%Y%m") + "01"
-        r = SESSION.get(
-            "https://www.twse.com.tw/rwd/zh/afterTrading/STOCK_DAY",
-            params={"stockNo": ticker, "date": yyyymm, "response": "json"},
-            timeout=10,
-            headers={"Referer": "https://www.twse.com.tw/"}
+        data = http_get_json(
+            "https://www.twse.com.tw/rwd/zh/afterTrading/MI_INDEX",
+            params={"date": date, "type": "ALLBUT0999", "response": "json"},
         )
-        d = r.json()
-        rows = d.get("data", [])
-        if rows:
-            price_str = rows[-1][6].replace(",", "")
-            price = float(price_str)
-            if not math.isnan(price) and price > 0:
-                print(f"    [TWSE] {ticker}: {price}")
-                return price
+        fields, rows = _find_table(data, "證券代號", "收盤價")
+        if not fields:
+            return {}
+        i_id, i_close = fields.index("證券代號"), fields.index("收盤價")
+        out = {}
+        for row in rows:
+            price = _valid_price(re.sub(r"<[^>]+>", "", str(row[i_close])))
+            if price:
+                out[str(row[i_id]).strip()] = price
+        return out
     except Exception as e:
-        print(f"    [TWSE] {ticker} 失敗：{e}")
+        print(f"    [TWSE MI_INDEX] {date} 失敗：{e}")
+        return {}
+
 
-    # ── 方法三：TPEx（上櫃股票）──
+def get_tpex_close_table(date: str) -> dict:
+    """櫃買中心每日收盤行情：全市場（上櫃）{stock_id: close}"""
+    roc_date = f"{int(date[:4]) - 1911}/{date[4:6]}/{date[6:]}"
     try:
-        roc_date = f"{NOW_TPE.year - 1911}/{NOW_TPE.strftime('%m/%d')}"
-        r = SESSION.get(
+        data = http_get_json(
             "https://www.tpex.org.tw/web/stock/aftertrading/daily_close_quotes/stk_quote_result.php",
-            params={"l": "zh-tw", "d": roc_date, "se": "AL", "s": "0,asc",
-                    "o": "json", "q": ticker},
-            timeout=10
+            params={"l": "zh-tw", "d": roc_date, "se": "AL", "s": "0,asc", "o": "json"},
         )
-        d = r.json()
-        rows = d.get("aaData", [])
-        if rows:
-            price = float(rows[0][2].replace(",", ""))
-            print(f"    [TPEx] {ticker}: {price}")
-            return price
+        rows = data.get("aaData") or next(
+            (t.get("data") for t in data.get("tables") or [] if t.get("data")), [])
+        # 欄位：0代號,1名稱,2收盤
+        out = {}
+        for row in rows:
+            price = _valid_price(row[2])
+            if price:
+                out[str(row[0]).strip()] = price
+        return out
     except Exception as e:
-        print(f"    [TPEx] {ticker} 失敗：{e}")
+        print(f"    [TPEx 收盤] {date} 失敗：{e}")
+        return {}
 
-    print(f"    ⚠️ {ticker} 所有方法均失敗")
-    return None
 
+def get_close_prices(tickers) -> dict:
+    """
+    批次抓收盤價，回傳 {ticker: price}
+    1. yfinance 分批 download（.TW / .TWO 一起送，代號先去重）
+    2. 缺的用證交所 MI_INDEX + 櫃買每日收盤表補（各一個請求涵蓋全市場，查最近的交易日）
+    """
+    tickers = sorted(set(tickers))
+    prices = {}
+    if not tickers:
+        return prices
 
-def load_watchlist() -> list:
-    """載入追蹤清單"""
-    if OUT_WATCHLIST.exists():
-        try:
-            return json.loads(OUT_WATCHLIST.read_text(encoding="utf-8"))
-        except Exception:
-            pass
-    return []
+    # 代號目錄已知市場的直接用對應後綴，未知的 .TW / .TWO 都送
+    markets = {t: symbol_market(t) for t in tickers}
+
+    # ── 方法一：yfinance 批次（GH Actions 環境最穩）──
+    try:
+        for i in range(0, len(tickers), YF_BATCH_SIZE):
+            chunk = tickers[i:i + YF_BATCH_SIZE]
+            symbols = [t + sfx for t in chunk
+                       for sfx in ([YF_SUFFIX[markets[t]]] if markets[t] else (".TW", ".TWO"))]
+            closes = _yf_batch_close(symbols)
+            for t in chunk:
+                # 先用 .TW（上市），沒有再用 .TWO（上櫃）
+                price = closes.get(t + ".TW") or closes.get(t + ".TWO")
+                if price:
+                    prices[t] = price
+        print(f"    [yfinance] 批次取得 {len(prices)}/{len(tickers)} 檔")
+    except Exception as e:
+        print(f"    [yfinance] 批次失敗：{e}")
+
+    # ── 方法二：交易所全市場收盤表 ──
+    missing = [t for t in tickers if t not in prices]
+    if missing:
+        # 週末 / 假日當天的收盤表是空的：改查日曆中最近的交易日
+        recent = find_recent_trading_dates(days=1, lookback=15)
+        date = recent[0] if recent else NOW_TPE.strftime("%Y%m%d")
+        need = {markets[t] for t in missing}
+        fetchers = [fetch for market, fetch in (("TWSE", get_twse_close_table),
+                                                ("TPEx", get_tpex_close_table))
+                    if None in need or market in need]
+        tables = {}
+        for table in run_parallel(lambda fetch: fetch(date), fetchers):
+            tables.update(table)
+        for t in missing:
+            price = tables.get(t)
+            if price:
+                prices[t] = price
+        print(f"    [交易所收盤表] 補上 {len(missing) - sum(t not in prices for t in missing)}"
+              f"/{len(missing)} 檔")
+
+    for t in tickers:
+        if t not in prices:
+            print(f"    ⚠️ {t} 所有方法均失敗")
+    return prices
 
 
-def save_watchlist(items: list):
-    OUT_WATCHLIST.parent.mkdir(parents=True, exist_ok=True)
-    OUT_WATCHLIST.write_text(
-        json.dumps(items, ensure_ascii=False, indent=2), encoding="utf-8"
-    )
+def get_close_price(ticker: str) -> float | None:
+    """抓單檔當日收盤價（get_close_prices 的單檔版本）"""
+    return get_close_prices([ticker]).get(ticker)
 
 
-def update_watchlist(result_df) -> list:
+def update_watchlist(result_df):
     """
     1. 載入現有追蹤清單
     2. 加入今日進榜的新股票（若已在清單就跳過）
-    3. 更新每筆的當日收盤價和漲跌幅
-    4. 存檔並回傳（永久保留，前端只顯示10天內）
+    3. 更新每檔的當日收盤價，補上還沒有的進榜價
+    4. 存檔並回傳 (entries, prices)（永久保留，前端只顯示10天內）
     """
     today_str = NOW_TPE.strftime("%Y-%m-%d")
-    watchlist = load_watchlist()
-
-    # 今日進榜的股票
-    new_stocks = []
-    if result_df is not None and len(result_df) > 0:
-        for _, row in result_df.iterrows():
-            new_stocks.append({
-                "stock_id":   str(row["stock_id"]),
-                "stock_name": str(row["stock_name"]).strip(),
-            })
+    entries, prices = load_watchlist_frames()
 
     # 加入新進榜股票（用 stock_id + entry_date 作唯一鍵，同股票不同進榜日都保留）
-    existing_keys = {(w["stock_id"], w["entry_date"]) for w in watchlist}
-    for s in new_stocks:
-        key = (s["stock_id"], today_str)
-        if key not in existing_keys:
-            print(f"  📌 新增追蹤：{s['stock_id']} {s['stock_name']} ({today_str})")
-            watchlist.append({
-                "stock_id":     s["stock_id"],
-                "stock_name":   s["stock_name"],
-                "entry_date":   today_str,
-                "entry_price":  None,
-                "prices":       {},
-                "pct_changes":  {},
-            })
-
-    # 更新收盤價
-    print(f"\n  📈 更新追蹤清單收盤價（共 {len(watchlist)} 檔）...")
-    for item in watchlist:
-        ticker = item["stock_id"]
-        if today_str in item.get("prices", {}):
-            continue  # 今天已更新過
-        price = get_close_price(ticker)
-        if price:
-            item.setdefault("prices", {})[today_str] = price
-            if item.get("entry_price") is None:
-                item["entry_price"] = price
-            # 計算漲跌幅
-            entry = item["entry_price"]
-            if entry and entry > 0:
-                pct = round((price - entry) / entry * 100, 2)
-                if not math.isnan(pct):
-                    item.setdefault("pct_changes", {})[today_str] = pct
-            pct_val = item.get("pct_changes", {}).get(today_str)
-            if isinstance(pct_val, float):
-                print(f"    {ticker} {item['stock_name']}: {price} 元 ({pct_val:+.2f}%)")
+    if result_df is not None and len(result_df) > 0:
+        new = pd.DataFrame({
+            "stock_id":    result_df["stock_id"].astype(str).to_numpy(),
+            "stock_name":  result_df["stock_name"].astype(str).str.strip().to_numpy(),
+            "entry_date":  today_str,
+            "entry_price": None,
+        })
+        existing = set(zip(entries["stock_id"], entries["entry_date"]))
+        new = new[[(sid, today_str) not in existing for sid in new["stock_id"]]]
+        for sid, name in zip(new["stock_id"], new["stock_name"]):
+            print(f"  📌 新增追蹤：{sid} {name} ({today_str})")
+        entries = pd.concat([entries, new], ignore_index=True)
+
+    # 更新收盤價（同代號只抓一次，整批下載）
+    print(f"\n  📈 更新追蹤清單收盤價（共 {len(entries)} 檔）...")
+    done = set(prices.loc[prices["date"] == today_str, "stock_id"])
+    close_prices = get_close_prices(set(entries["stock_id"]) - done)
+    if close_prices:
+        prices = pd.concat([prices, pd.DataFrame({
+            "stock_id": list(close_prices),
+            "date":     today_str,
+            "close":    list(close_prices.values()),
+        })], ignore_index=True)
+
+    # 進榜價 = 進榜日起第一筆收盤價
+    entries["entry_price"] = entries["entry_price"].astype(float)
+    missing = entries["entry_price"].isna().to_numpy()
+    if missing.any() and len(prices):
+        _, closes, _ = returns_matrix(entries, prices)
+        has_price = ~np.isnan(closes)
+        first = np.where(has_price.any(axis=1),
+                         closes[np.arange(len(entries)), has_price.argmax(axis=1)], np.nan)
+        entries.loc[missing, "entry_price"] = first[missing]
+
+    if close_prices:
+        dates, closes, pcts = returns_matrix(entries, prices)
+        col = int(np.searchsorted(dates, today_str))
+        for i in np.flatnonzero(entries["stock_id"].isin(close_prices).to_numpy()):
+            pct = pcts[i, col]
+            sid, name = entries.at[i, "stock_id"], entries.at[i, "stock_name"]
+            if np.isnan(pct):
+                print(f"    {sid}: {closes[i, col]} 元")
             else:
-                print(f"    {ticker}: {price} 元")
-        time.sleep(0.5)
+                print(f"    {sid} {name}: {closes[i, col]} 元 ({pct:+.2f}%)")
 
     # 全部保留，不清除（前端只顯示10天內）
-    save_watchlist(watchlist)
-    print(f"  ✅ 追蹤清單已更新，共 {len(watchlist)} 檔")
-    return watchlist
-
-
-def _build_watchlist_summary(watchlist: list) -> list:
-    """從完整 watchlist 建立摘要寫入 latest.json"""
-    from datetime import datetime as dt
-    today = NOW_TPE.date()
-    summary = []
-    for item in watchlist:
-        pcts   = item.get("pct_changes", {})
-        prices = item.get("prices", {})
-        sorted_dates = sorted(pcts.keys())
-        if not sorted_dates:
-            continue
-        latest_date  = sorted_dates[-1]
-        latest_pct   = pcts[latest_date]
-        latest_price = prices.get(latest_date)
-        try:
-            entry_dt = dt.strptime(item["entry_date"], "%Y-%m-%d").date()
-            days = (today - entry_dt).days
-        except Exception:
-            days = 0
-        summary.append({
-            "stock_id":    item["stock_id"],
-            "stock_name":  item["stock_name"],
-            "entry_date":  item["entry_date"],
-            "entry_price": item.get("entry_price"),
-            "latest_price": latest_price,
-            "latest_pct":  latest_pct,
-            "latest_date": latest_date,
-            "days_tracked": days,
-        })
+    save_watchlist_frames(entries, prices)
+    print(f"  ✅ 追蹤清單已更新，共 {len(entries)} 檔")
+    return entries, prices
+
+
+def _build_watchlist_summary(watchlist) -> list:
+    """從完整 watchlist (entries, prices) 一次算出摘要寫入 latest.json"""
+    if not watchlist or len(watchlist[0]) == 0:
+        return []
+    entries, prices = watchlist
+    dates, closes, pcts = returns_matrix(entries, prices)
+    if not len(dates):
+        return []
+    has_pct = ~np.isnan(pcts)
+    # 每列最後一個有漲跌幅的欄位
+    last = len(dates) - 1 - has_pct[:, ::-1].argmax(axis=1)
+    rows = np.arange(len(entries))
+    entry_dt = pd.to_datetime(entries["entry_date"], format="%Y-%m-%d", errors="coerce")
+    days = (pd.Timestamp(NOW_TPE.date()) - entry_dt).dt.days.fillna(0).astype(int)
+    summary = pd.DataFrame({
+        "stock_id":     entries["stock_id"],
+        "stock_name":   entries["stock_name"],
+        "entry_date":   entries["entry_date"],
+        "entry_price":  entries["entry_price"].astype(float),
+        "latest_price": closes[rows, last],
+        "latest_pct":   pcts[rows, last],
+        "latest_date":  dates[last],
+        "days_tracked": days,
+    })
     # 只輸出10天內的到 latest.json（完整歷史留在 watchlist.json）
-    summary = [s for s in summary if s["days_tracked"] <= 10]
-    summary.sort(key=lambda x: x["entry_date"], reverse=True)
-    return summary
+    summary = summary[has_pct.any(axis=1) & (summary["days_tracked"] <= TRACK_DAYS)]
+    summary = summary.sort_values("entry_date", ascending=False, kind="stable")
+    return summary.to_dict("records")
 
 if __name__ == "__main__":
+    args = parse_args()
     days = int(os.getenv("DAYS", "2"))
+    if args.cmd == "backfill":
+        backfill_history(args.start, args.end, days=days,
+                         workers=args.workers, force=args.force)
+        sys.exit(0)
+    if args.cmd == "scan":
+        run_topn_scan(args.start, args.end,
+                      ks=[int(x) for x in args.k.split(",")],
+                      ns=[int(x) for x in args.n.split(",")],
+                      out=args.out, workers=args.workers)
+        sys.exit(0)
+
     result_data = get_consecutive_top10(days=days)
 
     if result_data is not None:
@@ -840,23 +2056,16 @@ if __name__ == "__main__":
             display['第2天排名'] = result.get('day2_rank', pd.NA)
             display['第2天買超(張)'] = result.get('day2_net_buy', pd.NA)
             display['合計買超(張)'] = result['total_net_buy'].astype(int)
-            display['排名變化'] = display.apply(
-                lambda row: (
-                    "→" if pd.isna(row['第2天排名']) else
-                    (f"↑{abs(int(row['第2天排名']) - int(row['第1天排名']))}"
-                     if int(row['第2天排名']) < int(row['第1天排名'])
-                     else (f"↓{int(row['第2天排名']) - int(row['第1天排名'])}"
-                           if int(row['第2天排名']) > int(row['第1天排名']) else "→"))
-                ), axis=1
-            )
+            delta = pd.to_numeric(display['第2天排名'], errors='coerce') - display['第1天排名']
+            steps = delta.abs().fillna(0).astype(int).astype(str)
+            display['排名變化'] = np.select([delta < 0, delta > 0],
+                                        ["↑" + steps, "↓" + steps], default="→")
             pd.set_option('display.unicode.east_asian_width', True)
             pd.set_option('display.max_columns', None)
             pd.set_option('display.width', 180)
             print("\n" + display.to_string())
-            timestamp = NOW_TPE.strftime('%Y%m%d_%H%M')
-            csv_path = OUT_EXPORT_DIR / f'外資連續前10名交集_{timestamp}.csv'
-            result.to_csv(csv_path, index=False, encoding='utf-8-sig')
-            print(f"\n💾 CSV: {csv_path}")
+            export_path = write_export_partition(result, NOW_TPE.strftime('%Y-%m-%d %H:%M'))
+            print(f"\n💾 匯出: {export_path}")
             print(f"✅ 連續進榜: {len(result)} 檔")
             print(f"📊 總買超: {int(display['合計買超(張)'].sum()):,} 張")
             common_ids = set(result['stock_id'])
@@ -864,50 +2073,72 @@ if __name__ == "__main__":
                 date = daily_data.iloc[0]['rank_date']
                 print(f"\n【第 {i} 天】{date}")
                 print("-" * 70)
-                for rank, (_, row) in enumerate(daily_data.iterrows(), 1):
-                    is_common = "⭐" if row['stock_id'] in common_ids else "  "
-                    print(f"   {is_common} {rank:2d}. {row['stock_name']:8s} "
-                          f"({row['stock_id']}) - 買超 {row['淨買超_張']:>8,} 張")
+                rows = zip(daily_data['stock_id'], daily_data['stock_name'], daily_data['淨買超_張'])
+                for rank, (stock_id, stock_name, lots) in enumerate(rows, 1):
+                    is_common = "⭐" if stock_id in common_ids else "  "
+                    print(f"   {is_common} {rank:2d}. {stock_name:8s} "
+                          f"({stock_id}) - 買超 {lots:>8,} 張")
         else:
             print("❌ 沒有個股連續兩天都在前10名")
 
-        ai_analyses = run_ai_cross_check(
-            result if result is not None else pd.DataFrame()
-        )
-
-        # ── 三大法人同時買超 ──
         latest_date = daily_top10_list[0].iloc[0]["rank_date"].replace("-", "") if daily_top10_list else ""
-        three_insti = {}
-        market_insti = {}
-        if latest_date:
-            three_insti  = get_insti_signal(str(latest_date), top_n=10)
+
+        def insti_stage():
+            """三大法人同時買超 + 大盤法人金額"""
+            if not latest_date:
+                return {}, {}
+            with METRICS.stage("insti_signal"):
+                three_insti = get_insti_signal(str(latest_date), top_n=10)
             frames = three_insti.pop("_frames", [])
-            market_insti = get_market_insti_amount(str(latest_date), frames)
-
-        # ── 追蹤清單更新 ──
-        watchlist = update_watchlist(result if result is not None else pd.DataFrame())
-
-        write_json_payload(
-            result if result is not None else pd.DataFrame(),
-            daily_top10_list,
-            ai_analyses,
-            three_insti,
-            market_insti,
-            watchlist,
-        )
+            with METRICS.stage("market_amount"):
+                return three_insti, get_market_insti_amount(str(latest_date), frames)
+
+        def timed(name, fn, *a):
+            with METRICS.stage(name):
+                return fn(*a)
+
+        # AI（MOPS/RSS/Groq）、法人（TWSE/TPEx）、追蹤清單（Yahoo）打的是不同主機，並行執行
+        result_or_empty = result if result is not None else pd.DataFrame()
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            ai_future = pool.submit(timed, "ai", run_ai_cross_check, result_or_empty)
+            insti_future = pool.submit(insti_stage)
+            watchlist_future = pool.submit(timed, "watchlist", update_watchlist, result_or_empty)
+            ai_analyses = ai_future.result()
+            three_insti, market_insti = insti_future.result()
+            watchlist = watchlist_future.result()
+
+        with METRICS.stage("payload"):
+            write_json_payload(
+                result if result is not None else pd.DataFrame(),
+                daily_top10_list,
+                ai_analyses,
+                three_insti,
+                market_insti,
+                watchlist,
+            )
+        METRICS.append_log(status="ok", trading_date=latest_date,
+                           intersection=int(len(result_or_empty)))
     else:
         print("❌ 分析失敗")
         print("\n  ⏳ 更新追蹤清單（無交易資料）...")
         try:
             watchlist = update_watchlist(pd.DataFrame())
+            summary = _build_watchlist_summary(watchlist)
             if OUT_LATEST.exists():
-                old_payload = json.loads(OUT_LATEST.read_text(encoding="utf-8"))
-                old_payload["watchlist_summary"] = _build_watchlist_summary(watchlist)
-                old_payload.pop("watchlist", None)
-                OUT_LATEST.write_text(
-                    json.dumps(old_payload, ensure_ascii=False, indent=2), encoding="utf-8")
+                if not json_io.patch_last_key(OUT_LATEST, "watchlist_summary", summary):
+                    # 舊版 latest.json 的 key 順序不同：整份改寫一次，之後就能直接 patch
+                    old_payload = json_io.loads(OUT_LATEST.read_bytes())
+                    old_payload.pop("watchlist", None)
+                    old_payload.pop("watchlist_summary", None)
+                    old_payload["watchlist_summary"] = summary
+                    json_io.write_json(OUT_LATEST, old_payload)
+                if LATEST_MANIFEST.exists():
+                    write_latest_shards({"watchlist_summary": summary}, names=["watch"])
+                else:  # 還沒有分片（例如剛部署後的週末）：從 latest.json 一次建齊，前端才不會拿到空的 main / ai
+                    write_latest_shards(json_io.loads(OUT_LATEST.read_bytes()))
                 print("  ✅ latest.json watchlist_summary 已更新")
         except Exception as e:
             print(f"  ⚠️ 追蹤清單更新失敗：{e}")
+        METRICS.append_log(status="no_data")
 
     print("\n✨ 查詢完成!")
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+history_index.py — data/history/{yyyymmdd}.json 的彙總索引
+fetch_analyze.py 每寫一天的 history 就順手更新；跨日查詢不必再逐檔解析 JSON
+
+檔案（data/history_index/，每張表一個 parquet，日期一律 yyyymmdd）：
+  stocks.parquet        (date, stock_id)        連續前 10 名交集
+  insti_signal.parquet  (date, side, stock_id)  外資 + 投信買 / 賣超前幾名，side = buy / sell
+  ai_analysis.parquet   (date, stock_id)        AI 判斷
+  market_insti.parquet  (date)                  大盤法人買賣金額（億元）
+  files.parquet         (date, sha1)            已索引的 history 檔與內容雜湊，sync 用來找出新增 / 修改的檔案
+                                                （不用 mtime：checkout 會重設 mtime，同一秒內的修改也分不出來）
+
+同一天重寫 history 時，該日的舊列整批換掉，不會重複
+
+用法：
+  python history_index.py sync                          # 只補索引沒有或檔案有改過的日期
+  python history_index.py rebuild                       # 全部重建
+  python history_index.py stock 2330 [--table insti_signal] [--start 20260101] [--end 20260331]
+  python history_index.py count [--table stocks] [--side buy] [--start ...] [--end ...] [--top 20]
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import threading
+import pandas as pd
+from pathlib import Path
+
+HISTORY_DIR = Path("data/history")
+HISTORY_INDEX_DIR = Path("data/history_index")
+
+INDEX_COLUMNS = {
+    "stocks": {"date": str, "stock_id": str, "stock_name": str, "days": int,
+               "total_net_buy": int, "avg_net_buy": float,
+               "day1_rank": int, "day1_net_buy": int, "worst_rank": int},
+    "insti_signal": {"date": str, "side": str, "rank": int, "stock_id": str, "stock_name": str,
+                     "foreign_net": int, "trust_net": int, "ft_net": int},
+    "ai_analysis": {"date": str, "stock_id": str, "stock_name": str, "verdict": str,
+                    "confidence": str, "data_quality": str, "reasons": str, "warning": str,
+                    "next_check": str, "net_buy_lots": int, "is_etf": bool},
+    "market_insti": {"date": str, "unit": str, "foreign_buy": float, "foreign_sell": float,
+                     "foreign_net": float, "trust_buy": float, "trust_sell": float,
+                     "trust_net": float},
+    "files": {"date": str, "sha1": str},
+}
+QUERY_TABLES = [t for t in INDEX_COLUMNS if t != "files"]
+_INDEX_LOCK = threading.Lock()  # 回補時多個執行緒會同時寫
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def _index_path(table):
+    return HISTORY_INDEX_DIR / f"{table}.parquet"
+
+
+def _empty(table) -> pd.DataFrame:
+    return pd.DataFrame({c: pd.Series(dtype=t) for c, t in INDEX_COLUMNS[table].items()})
+
+
+def _frame(table, rows) -> pd.DataFrame:
+    """rows（dict list）→ 欄位與型別固定的表；缺的數字補 0、字串補空白"""
+    if not rows:
+        return _empty(table)
+    df = pd.DataFrame(rows).reindex(columns=list(INDEX_COLUMNS[table]))
+    for col, t in INDEX_COLUMNS[table].items():
+        if t is str:
+            df[col] = df[col].fillna("").astype(str).str.strip()
+        elif t is bool:
+            df[col] = df[col].fillna(False).astype(bool)
+        else:
+            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype(t)
+    return df
+
+
+def payload_rows(date: str, payload: dict) -> dict:
+    """單日 payload → {table: DataFrame}"""
+    stocks = []
+    for s in payload.get("stocks") or []:
+        per_day = list((s.get("per_day") or {}).values())
+        ranks = [d.get("rank") or 0 for d in per_day]
+        stocks.append({**s, "date": date, "days": len(per_day),
+                       "day1_rank": ranks[0] if ranks else 0,
+                       "day1_net_buy": per_day[0].get("net_buy_lots") if per_day else 0,
+                       "worst_rank": max(ranks, default=0)})
+
+    signal = payload.get("insti_signal") or {}
+    insti = [{**r, "date": date, "side": side, "rank": i}
+             for side in ("buy", "sell")
+             for i, r in enumerate(signal.get(side) or [], 1)]
+
+    ai = [{**a, "date": date, "stock_id": a.get("ticker"), "stock_name": a.get("name"),
+           "reasons": "；".join(a.get("reasons") or [])}
+          for a in payload.get("ai_analysis") or []]
+
+    market = payload.get("market_insti") or {}
+    return {
+        "stocks": _frame("stocks", stocks),
+        "insti_signal": _frame("insti_signal", insti),
+        "ai_analysis": _frame("ai_analysis", ai),
+        "market_insti": _frame("market_insti", [{**market, "date": date}] if market else []),
+    }
+
+
+def load_index(table: str) -> pd.DataFrame:
+    path = _index_path(table)
+    if path.exists():
+        try:
+            return pd.read_parquet(path)
+        except Exception as e:
+            print(f"  ⚠️ {path} 讀取失敗：{e}")
+    return _empty(table)
+
+
+def _save(table, df):
+    sort = [c for c in ("date", "side", "rank", "stock_id") if c in df.columns]
+    df = df.sort_values(sort).reset_index(drop=True)
+    path = _index_path(table)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def _replace_dates(batches: dict, hashes: dict, drop=()):
+    """batches: {table: 新的列}；hashes: {date: sha1}。這些日期與 drop 的舊列整批換掉"""
+    dates = set(hashes) | set(drop)
+    batches = {**batches, "files": _frame("files", [{"date": d, "sha1": h}
+                                                     for d, h in hashes.items()])}
+    with _INDEX_LOCK:
+        for table, new in batches.items():
+            old = load_index(table)
+            old = old[~old["date"].isin(dates)]
+            _save(table, pd.concat([old, new], ignore_index=True) if len(old) else new)
+
+
+def index_history_payload(date: str, payload: dict, data: bytes):
+    """
+    fetch_analyze 寫完 history/{date}.json 後呼叫：直接用記憶體中的 payload，不必再讀檔
+    data 為寫入檔案的 bytes，用來記內容雜湊
+    """
+    if not _index_path("files").exists():
+        sync_history_index()  # 第一次：連同既有的 history 一起建
+        return
+    _replace_dates(payload_rows(date, payload), {date: content_hash(data)})
+
+
+def sync_history_index(rebuild: bool = False) -> int:
+    """把 history 目錄與索引對齊：新增 / 修改過的檔案重新索引，已刪除的日期移除；回傳處理的檔數"""
+    files = {p.stem: p for p in HISTORY_DIR.glob("*.json") if p.stem.isdigit()}
+    indexed = _empty("files") if rebuild else load_index("files")
+    known = dict(zip(indexed["date"], indexed["sha1"]))
+    gone = set(indexed["date"]) - set(files)
+
+    batches = {t: [] for t in QUERY_TABLES}
+    hashes = {}
+    for d in sorted(files):
+        try:
+            data = files[d].read_bytes()
+        except OSError as e:
+            print(f"  ⚠️ {files[d]} 讀取失敗：{e}")
+            continue
+        digest = content_hash(data)
+        if known.get(d) == digest:
+            continue
+        try:
+            payload = json.loads(data)
+        except ValueError as e:
+            print(f"  ⚠️ {files[d]} 解析失敗：{e}")
+            continue
+        for table, df in payload_rows(d, payload).items():
+            batches[table].append(df)
+        hashes[d] = digest
+    if rebuild:
+        with _INDEX_LOCK:
+            for table in INDEX_COLUMNS:
+                _index_path(table).unlink(missing_ok=True)
+    if hashes or gone or rebuild:
+        _replace_dates({t: pd.concat(dfs, ignore_index=True) if dfs else _empty(t)
+                        for t, dfs in batches.items()}, hashes, drop=gone)
+    print(f"  🗂️ history 索引：處理 {len(hashes)} 天，移除 {len(gone)} 天")
+    return len(hashes)
+
+
+# ── 查詢 ───────────────────────────────────────────────────
+
+def query(table: str = "stocks", stock_id: str = None, start: str = None, end: str = None,
+          side: str = None) -> pd.DataFrame:
+    """依股票代號 / 日期區間（yyyymmdd，含頭尾）/ 買賣方向篩選某張表"""
+    df = load_index(table)
+    mask = pd.Series(True, index=df.index)
+    if stock_id is not None and "stock_id" in df.columns:
+        mask &= df["stock_id"] == str(stock_id)
+    if start:
+        mask &= df["date"] >= start
+    if end:
+        mask &= df["date"] <= end
+    if side and "side" in df.columns:
+        mask &= df["side"] == side
+    return df[mask].reset_index(drop=True)
+
+
+def appearance_counts(table: str = "stocks", start: str = None, end: str = None,
+                      side: str = None) -> pd.DataFrame:
+    """區間內每檔出現幾天（例如這一季進交集幾次），依次數由多到少"""
+    df = query(table, start=start, end=end, side=side)
+    if df.empty:
+        return pd.DataFrame(columns=["stock_id", "stock_name", "days", "first_date", "last_date"])
+    return (df.groupby("stock_id")
+              .agg(stock_name=("stock_name", "last"), days=("date", "nunique"),
+                   first_date=("date", "min"), last_date=("date", "max"))
+              .reset_index()
+              .sort_values(["days", "last_date"], ascending=False)
+              .reset_index(drop=True))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="data/history 彙總索引")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("sync", help="補上新增 / 修改過的 history 檔")
+    sub.add_parser("rebuild", help="全部重建")
+    for name, help_ in (("stock", "列出單一股票的紀錄"), ("count", "統計區間內每檔出現天數")):
+        p = sub.add_parser(name, help=help_)
+        if name == "stock":
+            p.add_argument("stock_id")
+        p.add_argument("--table", choices=QUERY_TABLES, default="stocks")
+        p.add_argument("--side", choices=["buy", "sell"])
+        p.add_argument("--start", help="yyyymmdd（含）")
+        p.add_argument("--end", help="yyyymmdd（含）")
+        if name == "count":
+            p.add_argument("--top", type=int, default=20)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cmd in ("sync", "rebuild"):
+        sync_history_index(rebuild=args.cmd == "rebuild")
+        sys.exit(0)
+    pd.set_option("display.width", 200)
+    pd.set_option("display.unicode.east_asian_width", True)
+    if args.cmd == "stock":
+        df = query(args.table, args.stock_id, args.start, args.end, args.side)
+    else:
+        df = appearance_counts(args.table, args.start, args.end, args.side).head(args.top)
+    print(df.to_string(index=False) if len(df) else "（沒有符合的紀錄）")
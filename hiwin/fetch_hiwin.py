@@ -13,6 +13,7 @@ GitHub Actions 每日自動執行，結果 commit 回 repo。
 
 import json
 import time
+import random
 import requests
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
@@ -40,22 +41,38 @@ SESSION.headers.update({
     )
 })
 
+RETRIES = 3
+
 # ── 抓資料 ───────────────────────────────────────────────────
+# hiwin 是獨立部署的專案（只裝 requests），不依賴上層的 http_client.py；
+# 這裡用同樣的規則：連線失敗 / 逾時 / 429 / 5xx 才重試（指數退避 + jitter），其他錯誤直接放棄
+def get_json(url: str, **kwargs) -> dict:
+    for attempt in range(RETRIES):
+        try:
+            r = SESSION.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            err = e
+        else:
+            if r.status_code < 400:
+                return r.json()  # 不是 JSON 時拋 ValueError，不重試
+            err = requests.HTTPError(f"HTTP {r.status_code}：{url}", response=r)
+            if r.status_code != 429 and r.status_code < 500:
+                raise err
+        if attempt < RETRIES - 1:
+            print(f"  ↻ 第 {attempt+1} 次失敗，重試：{err}")
+            time.sleep(random.uniform(0, 2 * 2 ** attempt))
+    raise err
+
 def fetch_yahoo(symbol: str, range_: str = "35d", interval: str = "1d") -> dict:
     """從 Yahoo Finance Chart API 抓歷史資料"""
     url = f"https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
     params = {"interval": interval, "range": range_}
-    for attempt in range(3):
-        try:
-            r = SESSION.get(url, params=params, timeout=20)
-            r.raise_for_status()
-            data = r.json()
-            result = data["chart"]["result"][0]
-            return result
-        except Exception as e:
-            print(f"  ⚠️  {symbol} 第 {attempt+1} 次失敗：{e}")
-            time.sleep(2 * (attempt + 1))
-    raise RuntimeError(f"無法取得 {symbol} 資料")
+    try:
+        data = get_json(url, params=params, timeout=20)
+        return data["chart"]["result"][0]
+    except (requests.RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+        print(f"  ⚠️  {symbol} 失敗：{e}")
+        raise RuntimeError(f"無法取得 {symbol} 資料") from e
 
 def calc_pct(closes: list, n_days: int) -> float | None:
     """計算最近 n_days 天的漲幅百分比"""
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+http_client.py — 對外 HTTP 的重試 / 熔斷層
+fetch_analyze.py 使用（hiwin/ 是獨立部署的專案，有自己的小型重試函式）
+
+錯誤分類：
+  可重試  連線失敗、逾時、429、5xx   → 指數退避 + full jitter；有 Retry-After 時至少等那麼久
+  不重試  其他 4xx、回應不是 JSON    → 立刻拋出，不浪費時間重試
+
+熔斷：同一主機連續 HTTP_BREAKER_THRESHOLD 次請求（每次都已用完重試）仍失敗，
+      視為主機掛了，本次執行剩下對它的請求直接拋 CircuitOpenError，不再等逾時
+"""
+import os
+import time
+import random
+import threading
+import requests
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "1.0"))
+HTTP_BACKOFF_CAP = float(os.getenv("HTTP_BACKOFF_CAP", "30"))
+HTTP_BREAKER_THRESHOLD = int(os.getenv("HTTP_BREAKER_THRESHOLD", "3"))
+
+
+class FetchError(Exception):
+    """請求失敗；retryable 表示換個時間再試可能會成功"""
+
+    def __init__(self, message, url="", status=None, retryable=False, retry_after=None):
+        super().__init__(message)
+        self.url = url
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(FetchError):
+    """主機已熔斷，本次執行不再對它送請求"""
+
+
+def host_of(url):
+    return urlsplit(url).hostname or url
+
+
+def backoff_delay(attempt, base=2.0, cap=60.0):
+    """指數退避 + full jitter：第 attempt 次重試前等 0 ~ min(cap, base·2^attempt) 秒"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after_seconds(headers):
+    """解析 Retry-After（秒數或 HTTP 日期）；沒給或看不懂回傳 None"""
+    if not headers:
+        return None
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        when = parsedate_to_datetime(str(value))
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def classify_response(url, resp):
+    """狀態碼 >= 400 的回應轉成 FetchError"""
+    status = resp.status_code
+    retryable = status == 429 or status >= 500
+    return FetchError(f"HTTP {status}：{url}", url, status, retryable,
+                      retry_after_seconds(resp.headers) if retryable else None)
+
+
+def classify_exception(url, exc):
+    """requests 拋出的例外轉成 FetchError：連線 / 逾時 / 讀取中斷可重試，其餘（網址錯誤等）不重試"""
+    retryable = isinstance(exc, (requests.ConnectionError, requests.Timeout,
+                                 requests.exceptions.ChunkedEncodingError))
+    kind = "逾時" if isinstance(exc, requests.Timeout) else "連線失敗"
+    return FetchError(f"{kind}：{exc}", url, None, retryable)
+
+
+class CircuitBreaker:
+    """每個主機各自計算連續失敗次數；到達門檻就熔斷到本次執行結束"""
+
+    def __init__(self, threshold=HTTP_BREAKER_THRESHOLD):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.opened = set()
+
+    def check(self, url):
+        host = host_of(url)
+        if host in self.opened:
+            raise CircuitOpenError(f"{host} 已熔斷，略過：{url}", url)
+
+    def success(self, url):
+        with self.lock:
+            self.failures.pop(host_of(url), None)
+
+    def failure(self, url):
+        """記一次失敗；這次剛好觸發熔斷時回傳 True"""
+        host = host_of(url)
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if host in self.opened or self.failures[host] < self.threshold:
+                return False
+            self.opened.add(host)
+        print(f"  ⛔ {host} 連續失敗 {self.threshold} 次，本次執行不再請求")
+        return True
+
+
+class ResilientClient:
+    """
+    send(method, url, **kwargs) 實際送出請求（預設 session.request；
+    fetch_analyze 傳入限流 + 計量過的 throttled_request）
+    on_retry(url) / on_open(url) 讓呼叫端記錄重試與熔斷
+    """
+
+    def __init__(self, session=None, send=None, retries=HTTP_RETRIES,
+                 base=HTTP_BACKOFF_BASE, cap=HTTP_BACKOFF_CAP, breaker=None,
+                 on_retry=None, on_open=None):
+        self.send = send or (session or requests.Session()).request
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+        self.breaker = breaker or CircuitBreaker()
+        self.on_retry = on_retry
+        self.on_open = on_open
+
+    def request(self, method, url, retries=None, **kwargs):
+        """回傳狀態碼 < 400 的回應（304 也算成功）；失敗拋 FetchError"""
+        retries = self.retries if retries is None else retries
+        err = None
+        for attempt in range(max(1, retries)):
+            self.breaker.check(url)
+            try:
+                resp = self.send(method, url, **kwargs)
+            except requests.RequestException as e:
+                err = classify_exception(url, e)
+            else:
+                if resp.status_code < 400:
+                    self.breaker.success(url)
+                    return resp
+                err = classify_response(url, resp)
+            if not err.retryable:
+                if err.status is not None:  # 主機有回應，只是這個請求不對
+                    self.breaker.success(url)
+                raise err
+            if attempt >= retries - 1:
+                break
+            wait = backoff_delay(attempt, self.base, self.cap)
+            if err.retry_after is not None:
+                if err.retry_after > self.cap:
+                    break  # 要求等太久，不如直接放棄
+                wait = max(wait, err.retry_after)
+            if self.on_retry:
+                self.on_retry(url)
+            time.sleep(wait)
+        if self.breaker.failure(url) and self.on_open:
+            self.on_open(url)
+        raise err
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def get_json(self, url, **kwargs):
+        """GET 並解析 JSON；回應不是 JSON（例如被擋時回的 HTML）不重試，直接拋 FetchError"""
+        resp = self.get(url, **kwargs)
+        try:
+            return resp.json()
+        except ValueError as e:
+            snippet = " ".join(str(getattr(resp, "text", ""))[:80].split())
+            raise FetchError(f"回應不是 JSON：{url}（{snippet}）", url,
+                             resp.status_code) from e
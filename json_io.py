@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+json_io.py — JSON 輸出的共用序列化層
+fetch_analyze.py 與 watchlist_store.py 共用
+
+- 有裝 orjson 就用 orjson，沒有就退回標準庫 json，兩者輸出格式相同（UTF-8、不跳脫中文；
+  唯一差別是 NaN：orjson 輸出 null）
+- NumPy / pandas 的純量（np.int64、np.float64、pd.Timestamp、pd.NA…）直接可序列化
+- 每份文件只編碼一次；寫到多個目的地時共用同一份 bytes
+- 寫檔一律先寫同目錄的暫存檔再 rename，中途失敗不會留下寫一半的 JSON
+"""
+import os
+import json
+import tempfile
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(o):
+    """json / orjson 不認得的型別：NumPy / pandas 純量、set、Path"""
+    try:
+        import pandas as pd
+        if o is pd.NA or o is pd.NaT:
+            return None
+    except ImportError:
+        pass
+    if hasattr(o, "item") and callable(o.item):  # NumPy 純量
+        return o.item()
+    if hasattr(o, "isoformat"):  # pd.Timestamp / datetime / date
+        return o.isoformat()
+    if isinstance(o, (set, frozenset)):
+        return sorted(o)
+    if isinstance(o, Path):
+        return str(o)
+    raise TypeError(f"無法序列化 {type(o).__name__}")
+
+
+def dumps(obj, pretty: bool = False, sort_keys: bool = False) -> bytes:
+    """編碼成 UTF-8 bytes；pretty=True 為 2 格縮排（與 json.dumps(indent=2) 相同），否則為最精簡格式"""
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=_default, option=option)
+    return json.dumps(obj, ensure_ascii=False, default=_default, sort_keys=sort_keys,
+                      indent=2 if pretty else None,
+                      separators=None if pretty else (",", ":")).encode("utf-8")
+
+
+def loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def write_bytes_atomic(path, data: bytes):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def write_json(paths, obj, pretty: bool = True, sort_keys: bool = False) -> bytes:
+    """obj 編碼一次後原子寫入 paths（單一路徑或路徑清單），回傳寫入的 bytes"""
+    data = dumps(obj, pretty=pretty, sort_keys=sort_keys)
+    for path in ([paths] if isinstance(paths, (str, Path)) else paths):
+        write_bytes_atomic(path, data)
+    return data
+
+
+def patch_last_key(path, key: str, value) -> bool:
+    """
+    2 格縮排文件的最後一個頂層 key 是 key 時，只重新編碼這個值並接回原檔，
+    不必整份 parse 再 dump；格式不符（不是最後一個 key、不是縮排格式）回傳 False
+    縮排輸出中的換行只會出現在結構之間（字串內的換行會被跳脫成 \\n），
+    所以 b'\\n  "' 一定是頂層 key 的開頭
+    """
+    path = Path(path)
+    old = path.read_bytes()
+    marker = b'\n  ' + dumps(key) + b': '
+    i = old.rfind(marker)
+    if i < 0 or b'\n  "' in old[i + len(marker):] or not old.rstrip().endswith(b"}"):
+        return False
+    encoded = dumps(value, pretty=True).replace(b"\n", b"\n  ")
+    write_bytes_atomic(path, old[:i] + marker + encoded + b"\n}")
+    return True
@@ -1,19 +1,46 @@
-const CACHE = "free-dash-v1";
+const CACHE = "free-dash-v2";
+const DATA_CACHE = "free-dash-data-v1";
 const ASSETS = [
   "/",
   "/index.html",
   "/app.js",
   "/public/manifest.json"
 ];
+// data/latest/ 的分片檔名帶內容 hash：內容不變就永遠用快取，同區塊有新檔時清掉舊的
+const SHARD_RE = /\/data\/latest\/([a-z]+)\.[0-9a-f]+\.json$/;
 
 self.addEventListener("install", e => {
   e.waitUntil(caches.open(CACHE).then(c => c.addAll(ASSETS)));
 });
 self.addEventListener("activate", e => {
-  e.waitUntil(self.clients.claim());
+  e.waitUntil(
+    caches.keys()
+      .then(keys => Promise.all(keys.filter(k => k !== CACHE && k !== DATA_CACHE).map(k => caches.delete(k))))
+      .then(() => self.clients.claim())
+  );
 });
 self.addEventListener("fetch", e => {
+  const m = new URL(e.request.url).pathname.match(SHARD_RE);
+  if (m) {
+    e.respondWith(cacheShard(e.request, m[1]));
+    return;
+  }
   e.respondWith(
     caches.match(e.request).then(resp => resp || fetch(e.request))
   );
 });
+
+async function cacheShard(request, section) {
+  const cache = await caches.open(DATA_CACHE);
+  const hit = await cache.match(request);
+  if (hit) return hit;
+  const resp = await fetch(request);
+  if (resp.ok) {
+    for (const key of await cache.keys()) {
+      const km = new URL(key.url).pathname.match(SHARD_RE);
+      if (km && km[1] === section) await cache.delete(key);
+    }
+    await cache.put(request, resp.clone());
+  }
+  return resp;
+}
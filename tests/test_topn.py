@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+tests/test_topn.py — 前10名邊界同分時的名次一致性
+
+交集 / scan_topn 用 topn_rank 的名次，每日前10名表用 _daily_top10，
+兩邊對同分的處理要一致：第 10、11 名張數相同（股數不同）、股數也相同（代號小的在前）
+
+需要 fetch_analyze.py 的相依套件（requests、pandas、pyarrow、feedparser、groq）
+用法：python -m pytest -q tests
+"""
+
+import importlib.util
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("feedparser")
+pytest.importorskip("groq")
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+IDS = [str(2000 + i) for i in range(14)]
+SHARES = [9_000_000 - i * 500_000 for i in range(9)] + [4_000_400, 3_999_600, 1_000_000, 900_000, 800_000]
+DAYS = {
+    "20260105": SHARES,                                                # 第 10、11 名同為 4000 張
+    "20260106": SHARES[:9] + [4_000_000, 4_000_000] + SHARES[11:],     # 股數也相同
+}
+
+
+@pytest.fixture(scope="module")
+def fa(monkeypatch_module):
+    monkeypatch_module.syspath_prepend(str(REPO_ROOT))
+    monkeypatch_module.setenv("GROQ_API_KEY", "test")
+    spec = importlib.util.spec_from_file_location("fetch_analyze", REPO_ROOT / "fetch_analyze.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="module")
+def monkeypatch_module():
+    mp = pytest.MonkeyPatch()
+    yield mp
+    mp.undo()
+
+
+@pytest.fixture(scope="module")
+def nets():
+    return {d: pd.DataFrame({"stock_id": IDS, "stock_name": [f"股{i}" for i in IDS],
+                             "buy_shares": v, "sell_shares": 0, "net_shares": v})
+            for d, v in DAYS.items()}
+
+
+@pytest.fixture(scope="module")
+def panel(fa, nets):
+    return pd.concat([fa._panel_rows(d, net) for d, net in nets.items()], ignore_index=True)
+
+
+@pytest.mark.parametrize("date", list(DAYS))
+def test_rank_matches_daily_top10(fa, nets, panel, date):
+    rank = fa.topn_rank(panel)
+    top = fa._daily_top10(nets[date])["stock_id"].tolist()
+    member = rank.columns[(rank.loc[date] <= 10).to_numpy()].tolist()
+    assert sorted(member) == sorted(top)
+    assert [rank.loc[date, s] for s in top] == list(range(1, 11))
+
+
+def test_scan_topn_tie_boundary(fa, panel):
+    hits = fa.scan_topn(panel, [2], [10])
+    assert sorted(hits["stock_id"]) == IDS[:10]
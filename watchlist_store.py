@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+watchlist_store.py — 追蹤清單的儲存層
+fetch_analyze.py 與 claudecode_pkg/watchlist_module.py 共用
+
+檔案：
+  data/watchlist.json           快照：每筆只存 (代號, 名稱, 進榜日, 進榜價)
+  data/prices.parquet           快照：(stock_id, date) → close，去重後的收盤價表
+  data/watchlist_journal.jsonl  快照之後的異動事件，每次執行只 append 新的幾行
+  data/price_overrides.parquet  (stock_id, entry_date, date) → close，舊格式轉換時凍結的逐筆收盤價：
+                                同一 (代號, 日期) 在不同進榜紀錄記了不同收盤價（或某筆沒記）時，
+                                價格表取最早記錄的，其餘紀錄與價格表不同的格子記在這裡（close 為 NaN
+                                表示該筆當天沒有收盤價），讓轉換後每筆的 prices / pct_changes 與原檔完全相同
+
+事件格式（一行一個 JSON）：
+  {"op": "enter", "stock_id", "stock_name", "entry_date", "entry_price"}
+  {"op": "entry_price", "stock_id", "entry_date", "entry_price"}
+  {"op": "remove", "stock_id", "entry_date"}
+  {"op": "close", "stock_id", "date", "close"}
+
+journal 累積到 WATCHLIST_COMPACT_EVERY 行時，併回快照並清空
+
+讀到舊格式（每筆自帶 prices dict）的 watchlist.json 會自動轉換一次（migrate_legacy_watchlist）
+
+用法：
+  python watchlist_store.py compact   # 手動把 journal 併回快照
+"""
+import os
+import sys
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from json_io import dumps, write_json
+
+OUT_WATCHLIST = Path("data/watchlist.json")
+PRICE_STORE = Path("data/prices.parquet")
+PRICE_OVERRIDES = Path("data/price_overrides.parquet")
+WATCHLIST_JOURNAL = Path("data/watchlist_journal.jsonl")
+WATCHLIST_FIELDS = ["stock_id", "stock_name", "entry_date", "entry_price"]
+WATCHLIST_COMPACT_EVERY = int(os.getenv("WATCHLIST_COMPACT_EVERY", "1500"))
+
+
+def load_price_table() -> pd.DataFrame:
+    """載入收盤價快照（欄位：stock_id, date, close）"""
+    if PRICE_STORE.exists():
+        try:
+            return pd.read_parquet(PRICE_STORE)
+        except Exception as e:
+            print(f"  ⚠️ {PRICE_STORE} 讀取失敗：{e}")
+    return pd.DataFrame({"stock_id": pd.Series(dtype=str),
+                         "date": pd.Series(dtype=str),
+                         "close": pd.Series(dtype=float)})
+
+
+def _write_parquet(df: pd.DataFrame, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def save_price_table(prices: pd.DataFrame):
+    prices = (prices.drop_duplicates(["stock_id", "date"], keep="last")
+                    .sort_values(["stock_id", "date"])
+                    .reset_index(drop=True))
+    _write_parquet(prices, PRICE_STORE)
+
+
+def load_price_overrides() -> pd.DataFrame:
+    """載入舊格式轉換時凍結的逐筆收盤價（欄位：stock_id, entry_date, date, close）"""
+    if PRICE_OVERRIDES.exists():
+        return pd.read_parquet(PRICE_OVERRIDES)
+    return pd.DataFrame({"stock_id": pd.Series(dtype=str), "entry_date": pd.Series(dtype=str),
+                         "date": pd.Series(dtype=str), "close": pd.Series(dtype=float)})
+
+
+def _entry_prices(entries: list, overrides: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    把舊格式 / 記憶體中的 prices dict 攤平成價格表；同一 (代號, 日期) 取最早進榜那筆記的收盤價
+    overrides 中的格子是該筆自己的凍結價格，不併進共用的價格表
+    """
+    rows = [(e["stock_id"], e["entry_date"], d, float(p))
+            for e in sorted(entries, key=lambda e: e["entry_date"])
+            for d, p in (e.get("prices") or {}).items() if p is not None]
+    df = pd.DataFrame(rows, columns=["stock_id", "entry_date", "date", "close"])
+    if overrides is not None and len(overrides):
+        keys = ["stock_id", "entry_date", "date"]
+        df = df.merge(overrides[keys], on=keys, how="left", indicator=True)
+        df = df[df["_merge"] == "left_only"]
+    return (df.drop_duplicates(["stock_id", "date"], keep="first")
+              [["stock_id", "date", "close"]].reset_index(drop=True))
+
+
+def returns_matrix(entries: pd.DataFrame, prices: pd.DataFrame, overrides: pd.DataFrame = None):
+    """
+    把所有追蹤紀錄一次展開成 entries × dates 矩陣
+    回傳 (dates, closes, pcts)：dates 為排序後的日期陣列；
+    closes / pcts 形狀為 (len(entries), len(dates))，進榜日之前或沒價格的格子為 NaN，
+    pcts 為相對進榜價的漲跌幅（%，四捨五入到小數 2 位）
+    overrides 預設讀 data/price_overrides.parquet，其中的格子取代價格表的值
+    """
+    if overrides is None:
+        overrides = load_price_overrides()
+    wide = prices.pivot(index="stock_id", columns="date", values="close").sort_index(axis=1)
+    dates = wide.columns.to_numpy(dtype=str)
+    closes = wide.reindex(entries["stock_id"].to_numpy()).to_numpy(dtype=float, copy=True)
+    if len(overrides) and len(entries):
+        keys = pd.Index(entries["stock_id"].astype(str) + "|" + entries["entry_date"].astype(str))
+        row = keys.get_indexer(overrides["stock_id"] + "|" + overrides["entry_date"])
+        col = pd.Index(dates).get_indexer(overrides["date"])
+        ok = (row >= 0) & (col >= 0)
+        closes[row[ok], col[ok]] = overrides["close"].to_numpy(dtype=float)[ok]
+    closes[dates[None, :] < entries["entry_date"].to_numpy(dtype=str)[:, None]] = np.nan
+    entry = entries["entry_price"].to_numpy(dtype=float, na_value=np.nan)
+    entry = np.where(entry > 0, entry, np.nan)[:, None]
+    pcts = np.round((closes - entry) / entry * 100, 2)
+    return dates, closes, pcts
+
+
+def _hydrate_watchlist(entries: pd.DataFrame, prices: pd.DataFrame,
+                       overrides: pd.DataFrame = None) -> list:
+    """
+    由價格表推回每筆的 prices / pct_changes（進榜日起的收盤價）
+    回傳格式與舊版 watchlist.json 相同，呼叫端不需要改
+    """
+    dates, closes, pcts = returns_matrix(entries, prices, overrides)
+    out = []
+    for i, e in enumerate(entries.to_dict("records")):
+        item = {k: (None if k == "entry_price" and pd.isna(e[k]) else e[k])
+                for k in WATCHLIST_FIELDS}
+        has_price, has_pct = ~np.isnan(closes[i]), ~np.isnan(pcts[i])
+        item["prices"] = dict(zip(dates[has_price].tolist(), closes[i, has_price].tolist()))
+        item["pct_changes"] = dict(zip(dates[has_pct].tolist(), pcts[i, has_pct].tolist()))
+        out.append(item)
+    return out
+
+
+def _read_journal() -> list:
+    if not WATCHLIST_JOURNAL.exists():
+        return []
+    events = []
+    for line in WATCHLIST_JOURNAL.read_text(encoding="utf-8").splitlines():
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            print(f"  ⚠️ 略過無法解析的 journal 行：{line[:60]}")
+    return events
+
+
+def _replay(entries: list, prices: pd.DataFrame, events: list):
+    """把 journal 事件套用到快照，回傳 (entries, prices)"""
+    by_key = {(e["stock_id"], e["entry_date"]): {k: e.get(k) for k in WATCHLIST_FIELDS}
+              for e in entries}
+    closes = []
+    for ev in events:
+        op = ev.get("op")
+        if op == "close":
+            closes.append((ev["stock_id"], ev["date"], float(ev["close"])))
+            continue
+        key = (ev["stock_id"], ev["entry_date"])
+        if op == "enter":
+            by_key[key] = {k: ev.get(k) for k in WATCHLIST_FIELDS}
+        elif op == "entry_price" and key in by_key:
+            by_key[key]["entry_price"] = ev["entry_price"]
+        elif op == "remove":
+            by_key.pop(key, None)
+    if closes:
+        prices = pd.concat([prices, pd.DataFrame(closes, columns=["stock_id", "date", "close"])],
+                           ignore_index=True)
+        prices = prices.drop_duplicates(["stock_id", "date"], keep="last")
+    return list(by_key.values()), prices
+
+
+def _legacy_overrides(legacy: list, entries: pd.DataFrame, prices: pd.DataFrame) -> pd.DataFrame:
+    """舊格式每筆的 prices 與共用價格表推回的結果不同的格子（原檔沒有的日期記 NaN）"""
+    empty = load_price_overrides().iloc[0:0]
+    dates, closes, _ = returns_matrix(entries, prices, empty)
+    rows = []
+    for i, e in enumerate(legacy):
+        own = {d: float(p) for d, p in (e.get("prices") or {}).items() if p is not None}
+        has = ~np.isnan(closes[i])
+        shared = dict(zip(dates[has].tolist(), closes[i, has].tolist()))
+        rows += [(e["stock_id"], e["entry_date"], d, p) for d, p in own.items() if shared.get(d) != p]
+        rows += [(e["stock_id"], e["entry_date"], d, np.nan) for d in shared if d not in own]
+    return pd.DataFrame(rows, columns=empty.columns) if rows else empty
+
+
+def migrate_legacy_watchlist(legacy: list):
+    """
+    舊格式（每筆自帶 prices / pct_changes）→ 快照 + 價格表 + 凍結的逐筆收盤價
+    寫檔前先確認每筆推回的 prices / pct_changes 與原檔完全相同，不同就拋錯、原檔不動
+    """
+    entries = pd.DataFrame([{k: e.get(k) for k in WATCHLIST_FIELDS} for e in legacy],
+                           columns=WATCHLIST_FIELDS)
+    prices = pd.concat([load_price_table(), _entry_prices(legacy)], ignore_index=True)
+    prices = prices.drop_duplicates(["stock_id", "date"], keep="last").reset_index(drop=True)
+    overrides = _legacy_overrides(legacy, entries, prices)
+    rebuilt = _hydrate_watchlist(entries, prices, overrides)
+    for old, new in zip(legacy, rebuilt):
+        own = {d: float(p) for d, p in (old.get("prices") or {}).items() if p is not None}
+        pct = {d: float(p) for d, p in (old.get("pct_changes") or {}).items() if p is not None}
+        if own != new["prices"] or pct != new["pct_changes"]:
+            raise RuntimeError(f"追蹤清單轉換結果與原檔不符：{old['stock_id']} {old['entry_date']}")
+    _write_parquet(overrides.sort_values(["stock_id", "entry_date", "date"]).reset_index(drop=True),
+                   PRICE_OVERRIDES)
+    compact_watchlist(entries, prices)
+    print(f"  🔄 追蹤清單已轉換為新格式（{len(entries)} 筆，{len(overrides)} 個逐筆凍結價格）")
+
+
+def _load_state():
+    """快照 + journal → (thin entries, prices, 是否還沒有快照)"""
+    entries = None
+    if OUT_WATCHLIST.exists():
+        try:
+            entries = json.loads(OUT_WATCHLIST.read_text(encoding="utf-8"))
+        except Exception:
+            pass
+    if entries and any("prices" in e for e in entries):  # 舊格式：每筆自帶 prices dict
+        migrate_legacy_watchlist(entries)
+        entries = json.loads(OUT_WATCHLIST.read_text(encoding="utf-8"))
+    entries, prices = _replay(entries or [], load_price_table(), _read_journal())
+    return entries, prices, not OUT_WATCHLIST.exists()
+
+
+def load_watchlist_frames():
+    """回傳 (entries, prices) 兩張表：entries 欄位為 WATCHLIST_FIELDS，依加入順序"""
+    entries, prices, _ = _load_state()
+    return (pd.DataFrame(entries, columns=WATCHLIST_FIELDS),
+            prices.reset_index(drop=True))
+
+
+def load_watchlist() -> list:
+    """
+    載入追蹤清單：快照 + journal，
+    收盤價與漲跌幅從價格表推出；讀到舊格式會自動轉換
+    """
+    return _hydrate_watchlist(*load_watchlist_frames())
+
+
+def _json_num(x):
+    return None if pd.isna(x) else float(x)
+
+
+def _diff_events(base_entries: pd.DataFrame, base_prices: pd.DataFrame,
+                 entries: pd.DataFrame, prices: pd.DataFrame) -> list:
+    """比較目前狀態與已存狀態，產生需要 append 的事件"""
+    keys = ["stock_id", "entry_date"]
+    m = entries.merge(base_entries[keys + ["entry_price"]], on=keys, how="outer",
+                      suffixes=("", "_old"), indicator=True, sort=False)
+    price_changed = ((m["entry_price"] != m["entry_price_old"])
+                     & ~(m["entry_price"].isna() & m["entry_price_old"].isna()))
+    events = [{"op": "enter", "stock_id": r["stock_id"], "stock_name": r["stock_name"],
+               "entry_date": r["entry_date"], "entry_price": _json_num(r["entry_price"])}
+              for r in m[m["_merge"] == "left_only"].to_dict("records")]
+    events += [{"op": "entry_price", "stock_id": r["stock_id"], "entry_date": r["entry_date"],
+                "entry_price": _json_num(r["entry_price"])}
+               for r in m[(m["_merge"] == "both") & price_changed].to_dict("records")]
+    events += [{"op": "remove", "stock_id": r["stock_id"], "entry_date": r["entry_date"]}
+               for r in m[m["_merge"] == "right_only"].to_dict("records")]
+
+    p = prices.merge(base_prices, on=["stock_id", "date"], how="left", suffixes=("", "_old"))
+    p = p[p["close"] != p["close_old"]]
+    events += [{"op": "close", "stock_id": sid, "date": date, "close": float(close)}
+               for sid, date, close in zip(p["stock_id"], p["date"], p["close"])]
+    return events
+
+
+def compact_watchlist(entries: pd.DataFrame = None, prices: pd.DataFrame = None):
+    """把 journal 併回快照（watchlist.json + prices.parquet）並清空 journal"""
+    if entries is None:
+        entries, prices = load_watchlist_frames()
+    save_price_table(prices)
+    thin = [{k: (None if k == "entry_price" and pd.isna(e[k]) else e[k])
+             for k in WATCHLIST_FIELDS} for e in entries.to_dict("records")]
+    write_json(OUT_WATCHLIST, thin)
+    WATCHLIST_JOURNAL.unlink(missing_ok=True)
+    print(f"  🗜️ 追蹤清單已壓縮回快照（{len(thin)} 筆）")
+
+
+def save_watchlist_frames(entries: pd.DataFrame, prices: pd.DataFrame):
+    """只把與已存狀態不同的部分 append 到 journal；累積夠多行才整理快照"""
+    base_entries, base_prices, fresh = _load_state()
+    if fresh:
+        compact_watchlist(entries, prices)  # 第一次寫入：直接寫快照
+        return
+    events = _diff_events(pd.DataFrame(base_entries, columns=WATCHLIST_FIELDS),
+                          base_prices, entries, prices)
+    if events:
+        WATCHLIST_JOURNAL.parent.mkdir(parents=True, exist_ok=True)
+        with WATCHLIST_JOURNAL.open("ab") as f:
+            f.write(b"".join(dumps(ev) + b"\n" for ev in events))
+    n_lines = len(WATCHLIST_JOURNAL.read_text(encoding="utf-8").splitlines()) \
+        if WATCHLIST_JOURNAL.exists() else 0
+    if n_lines >= WATCHLIST_COMPACT_EVERY:
+        compact_watchlist(entries, prices)
+
+
+def save_watchlist(items: list):
+    """存回 load_watchlist() 格式的清單（items 內的 prices 會併進價格表）"""
+    entries = pd.DataFrame([{k: w.get(k) for k in WATCHLIST_FIELDS} for w in items],
+                           columns=WATCHLIST_FIELDS)
+    prices = pd.concat([load_watchlist_frames()[1], _entry_prices(items, load_price_overrides())],
+                       ignore_index=True)
+    save_watchlist_frames(entries, prices.drop_duplicates(["stock_id", "date"], keep="last"))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["compact"]:
+        compact_watchlist()
+    else:
+        print(__doc__)